@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Signal receivers run after the response is sent.
+
+Receivers connected with connect_deferred() are not critical to the
+request, like emails or CRM syncs. In requests going through
+DeferredReceiversMiddleware, their calls are queued and run once the
+server has sent the response and closes it, so they do not add to the
+latency seen by users. Elsewhere, they run immediately.
+
+Each request queues at most LEAN_DEFERRED_QUEUE_SIZE calls (100 by
+default); further calls run immediately. Errors of deferred calls are
+logged and counted in the deferred_receiver_errors_total metric, and do
+not prevent the other calls from running.
+"""
+import logging
+l = logging.getLogger(__name__)
+
+import threading
+from functools import wraps
+
+from django import db
+from django.conf import settings
+
+from django_lean import metrics
+
+# Django 1.6 fix
+close_connections = (getattr(db, 'close_old_connections', None) or
+                     db.close_connection)
+
+_state = threading.local()
+
+
+def defer(receiver, *args, **kwargs):
+    """
+    Queues a call of `receiver` for after the response of the current
+    request. Returns False if there is no queue, or if it is full.
+    """
+    queue = getattr(_state, 'queue', None)
+    if queue is None:
+        return False
+    if len(queue) >= getattr(settings, 'LEAN_DEFERRED_QUEUE_SIZE', 100):
+        metrics.increment('deferred_calls_overflow_total')
+        l.warning("Running %s immediately, the deferred queue is full" %
+                  getattr(receiver, '__name__', receiver))
+        return False
+    queue.append((receiver, args, kwargs))
+    return True
+
+def deferred(receiver):
+    """Returns a receiver deferring the calls of `receiver`."""
+    @wraps(receiver)
+    def wrapper(*args, **kwargs):
+        if not defer(receiver, *args, **kwargs):
+            return receiver(*args, **kwargs)
+    wrapper.receiver = receiver
+    return wrapper
+
+def make_id(target):
+    """Returns the identity of `target`, that of a bound method's object."""
+    if getattr(target, 'im_self', None) is not None:
+        return (id(target.im_self), id(target.im_func))
+    return id(target)
+
+def connect_deferred(signal, receiver, sender=None, dispatch_uid=None):
+    """
+    Connects `receiver` to `signal`, deferring its calls. The wrapper is
+    strongly referenced, so use the returned `dispatch_uid` to disconnect
+    it. By default, it is made of the identities of `receiver` and
+    `sender`; pass one for receivers of modules that may be imported
+    twice. The responses of deferred calls are None.
+    """
+    if dispatch_uid is None:
+        dispatch_uid = 'deferred.%s.%s.%r.%r' % (
+            receiver.__module__, receiver.__name__, make_id(receiver),
+            make_id(sender))
+    signal.connect(deferred(receiver), sender=sender, weak=False,
+                   dispatch_uid=dispatch_uid)
+    return dispatch_uid
+
+def run_deferred(queue):
+    """Runs the queued calls, isolating their errors."""
+    for receiver, args, kwargs in queue:
+        try:
+            receiver(*args, **kwargs)
+        except Exception:
+            metrics.increment('deferred_receiver_errors_total')
+            l.exception("Deferred receiver %s failed" %
+                        getattr(receiver, '__name__', receiver))
+
+
+class DeferredReceiversMiddleware(object):
+    """
+    Runs the deferred receivers once the response is closed by the server.
+
+    Install it first in settings.MIDDLEWARE_CLASSES, so that it queues the
+    calls made by other middleware:
+
+    MIDDLEWARE_CLASSES = (
+        'django_lean.deferred.DeferredReceiversMiddleware',
+        ...
+    )
+    """
+    def process_request(self, request):
+        _state.queue = []
+
+    def process_response(self, request, response):
+        queue = getattr(_state, 'queue', None)
+        _state.queue = None
+        if not queue:
+            return response
+        close = response.close
+        def close_and_run():
+            # Since Django 1.5, close() sends request_finished, which
+            # receivers may then need to follow
+            try:
+                close()
+            finally:
+                run_deferred(queue)
+                # Receivers may have reopened the closed connections
+                close_connections()
+        response.close = close_and_run
+        return response
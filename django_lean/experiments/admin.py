@@ -2,7 +2,8 @@
 from django.contrib import admin
 
 from django_lean.experiments.models import (Experiment, Participant,
-                                            GoalType, AnonymousVisitor)
+                                            GoalType, AnonymousVisitor,
+                                            ReportWorkUnit)
 
 
 class GoalTypeOptions(admin.ModelAdmin):
@@ -19,7 +20,12 @@ class ParticipantOptions(admin.ModelAdmin):
     search_fields = ('user',)
     raw_id_fields = ('user', 'anonymous_visitor')
 
+class ReportWorkUnitOptions(admin.ModelAdmin):
+    list_display = ('experiment', 'report_type', 'date', 'state', 'attempts')
+    list_filter = ('state', 'report_type')
+
 admin.site.register(AnonymousVisitor)
 admin.site.register(GoalType, GoalTypeOptions)
 admin.site.register(Experiment, ExperimentOptions)
 admin.site.register(Participant, ParticipantOptions)
+admin.site.register(ReportWorkUnit, ReportWorkUnitOptions)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+WSGI middleware answering the goal and confirm_human beacons of
+experiments.js before the request reaches Django's handler and middleware.
+
+Wrap the Django application in the WSGI module of the project:
+
+    application = BeaconMiddleware(get_wsgi_application())
+
+Goal beacons only load the session to find the anonymous visitor, and the
+goal records are written in bulk by a background thread. Unlike
+GoalRecord.record(), no goal_recorded signal is sent for them.
+confirm_human beacons of visitors whose lean_human cookie matches their
+session are answered right away; the others go through Django.
+
+Like the goal view, goal beacons are not recorded when
+LEAN_GOAL_VIEW_WRITES is False, or over the rate limits of the ratelimit
+module.
+"""
+import logging
+l = logging.getLogger(__name__)
+
+import atexit
+from datetime import datetime
+from Queue import Empty, Full, Queue
+from threading import Thread
+from time import sleep
+
+from django.conf import settings
+from django.core import signals
+from django.http import parse_cookie
+from django.utils.crypto import constant_time_compare
+from django.utils.http import http_date
+
+from django_lean import metrics
+from django_lean.experiments.models import (AnonymousVisitor, GoalRecord,
+                                            GoalType)
+from django_lean.experiments.ratelimit import allow_goal
+from django_lean.experiments.utils import load_session
+from django_lean.experiments.views import (HUMAN_COOKIE_NAME,
+                                           TRANSPARENT_1X1_PNG, human_marker)
+from django_lean.utils import bulk_insert
+
+
+class GoalWriter(object):
+    """
+    Bounded queue of goal achievements, written as GoalRecords in batches
+    of up to `batch_size` by a background thread every `interval` seconds.
+    Achievements that do not fit in the queue are dropped.
+    """
+    def __init__(self, max_size=10000, batch_size=500, interval=1):
+        self.queue = Queue(max_size)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.goal_types = {}
+        self.thread = None
+
+    def put(self, goal_name, anonymous_id, created=None):
+        """Enqueues a goal achievement, returning False if it was dropped."""
+        try:
+            self.queue.put_nowait((goal_name, anonymous_id,
+                                   created or datetime.now()))
+        except Full:
+            metrics.increment('beacon_goals_dropped_total')
+            return False
+        return True
+
+    def get_goal_type_id(self, goal_name):
+        goal_type_id = self.goal_types.get(goal_name)
+        if goal_type_id is None:
+            if getattr(settings, 'LEAN_AUTOCREATE_GOAL_TYPES', False):
+                goal_type = GoalType.objects.get_or_create(name=goal_name)[0]
+            else:
+                try:
+                    goal_type = GoalType.objects.get(name=goal_name)
+                except GoalType.DoesNotExist:
+                    l.warning("Can't find the GoalType named %s" % goal_name)
+                    return None
+            goal_type_id = self.goal_types[goal_name] = goal_type.id
+        return goal_type_id
+
+    def write(self, achievements):
+        """Writes a batch of achievements, returning the records written."""
+        visitor_ids = set(AnonymousVisitor.objects.filter(
+            id__in=set(a[1] for a in achievements)
+        ).values_list('id', flat=True))
+        rows = []
+        for goal_name, anonymous_id, created in achievements:
+            goal_type_id = self.get_goal_type_id(goal_name)
+            if goal_type_id is None or anonymous_id not in visitor_ids:
+                continue
+            rows.append((created, anonymous_id, goal_type_id))
+            metrics.increment('goal_records_total', goal_type=goal_name)
+        return bulk_insert(GoalRecord,
+                           ('created', 'anonymous_visitor', 'goal_type'), rows)
+
+    def flush(self):
+        """Writes all the queued achievements, returning the records written."""
+        written = 0
+        while True:
+            achievements = []
+            try:
+                while len(achievements) < self.batch_size:
+                    achievements.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            if not achievements:
+                return written
+            written += self.write(achievements)
+
+    def run(self):
+        while self.thread is not None:
+            try:
+                self.flush()
+            except Exception:
+                l.exception("Could not write goal records")
+            sleep(self.interval)
+
+    def start(self):
+        self.thread = Thread(target=self.run, name='GoalWriter')
+        self.thread.setDaemon(True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def stop(self):
+        self.thread = None
+
+
+class BeaconMiddleware(object):
+    """
+    Serves the goal and confirm_human beacons under `prefix`, the path of
+    the experiments URLs, and passes other requests to `application`.
+    """
+    def __init__(self, application, prefix='/experiments/', writer=None):
+        self.application = application
+        self.prefix = prefix
+        if writer is None:
+            writer = GoalWriter()
+            writer.start()
+        self.writer = writer
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path.startswith(self.prefix):
+            path = path[len(self.prefix):]
+            if path.startswith('goal/'):
+                return self.goal(environ, start_response, path[len('goal/'):])
+            if path == 'confirm_human/' and self.is_verified_human(environ):
+                start_response('204 No Content', self.no_cache_headers())
+                return []
+        return self.application(environ, start_response)
+
+    def get_cookies(self, environ):
+        return parse_cookie(environ.get('HTTP_COOKIE', ''))
+
+    def is_verified_human(self, environ):
+        cookies = self.get_cookies(environ)
+        session_key = cookies.get(settings.SESSION_COOKIE_NAME)
+        marker = cookies.get(HUMAN_COOKIE_NAME)
+        if not (session_key and marker and
+                constant_time_compare(marker, human_marker(session_key))):
+            return False
+        # Stale markers are left to the view, which confirms the session
+        session_key, session = self.get_session(environ)
+        return bool(session and session.get('verified_human'))
+
+    def get_session(self, environ):
+        """Returns the session key and data of the visitor, or Nones."""
+        session_key = self.get_cookies(environ).get(
+            settings.SESSION_COOKIE_NAME)
+        if not session_key:
+            return None, None
+        try:
+            return session_key, load_session(session_key)
+        finally:
+            # Like Django's handler, release the database connection
+            signals.request_finished.send(sender=self.__class__)
+
+    def goal(self, environ, start_response, goal_name):
+        try:
+            if getattr(settings, 'LEAN_GOAL_VIEW_WRITES', True):
+                session_key, session = self.get_session(environ)
+                # Clients can send any session key, so unknown ones are
+                # limited by address
+                if session is None:
+                    visitor = environ.get('REMOTE_ADDR')
+                else:
+                    visitor = session_key
+                if allow_goal(goal_name, visitor):
+                    anonymous_id = (session or {}).get('anonymous_id')
+                    if anonymous_id:
+                        self.writer.put(goal_name, anonymous_id)
+        except Exception:
+            l.exception("Could not record goal %s" % goal_name)
+        start_response('200 OK', self.no_cache_headers() + [
+            ('Content-Type', 'image/png'),
+            ('Content-Length', str(len(TRANSPARENT_1X1_PNG))),
+        ])
+        return [TRANSPARENT_1X1_PNG]
+
+    def no_cache_headers(self):
+        return [('Cache-Control', 'max-age=0'), ('Expires', http_date())]
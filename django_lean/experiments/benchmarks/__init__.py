@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks measuring the cost of django-lean, meant to be run against a
+scratch database through the benchmark_* management commands.
+"""
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import logging
+l = logging.getLogger(__name__)
+
+import random
+from datetime import date, datetime, time, timedelta
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+
+from django_lean.experiments.models import (AnonymousVisitor, Experiment,
+                                            DailyConversionReport,
+                                            DailyConversionReportGoalData,
+                                            DailyEngagementReport,
+                                            GoalRecord, GoalType, Participant,
+                                            ReportWorkUnit)
+from django_lean.utils import bulk_insert
+
+
+CHUNK_SIZE = 10000
+
+ONE_DAY = timedelta(days=1)
+
+
+class BenchmarkData(object):
+    """
+    Seeded generator of a synthetic experiment, that ran for `days` days
+    up until yesterday, with `participants` participants of which a
+    `registered` fraction are registered users.
+
+    Anonymous participants convert on each of `goal_types` goal types
+    with their own base rate, test participants slightly more often, and
+    some of them achieve the same goal several times.
+    """
+    TEST_GROUP_LIFT = 1.1
+    REPEAT_PROBABILITY = 0.3
+
+    def __init__(self, participants, goal_types=5, days=14, registered=0.1,
+                 seed=0):
+        self.participants = participants
+        self.goal_types = goal_types
+        self.days = days
+        self.registered = registered
+        self.seed = seed
+        self.name = 'benchmark-%d-%d' % (participants, seed)
+        self.experiment = None
+
+    @property
+    def start_date(self):
+        return date.today() - timedelta(days=self.days)
+
+    @property
+    def end_date(self):
+        return date.today() - ONE_DAY
+
+    def report_dates(self):
+        current_date = self.start_date
+        while current_date <= self.end_date:
+            yield current_date
+            current_date += ONE_DAY
+
+    def create(self):
+        """Creates the experiment and all of its data."""
+        self.random = random.Random(self.seed)
+        self.experiment = Experiment.objects.create(name=self.name)
+        self.experiment.state = Experiment.ENABLED_STATE
+        self.experiment.save()
+        self.experiment.start_date = self.start_date
+        self.experiment.save()
+        self.goal_type_rates = [
+            (GoalType.objects.get_or_create(name='benchmark goal %d' % i)[0],
+             self.random.uniform(0.01, 0.2))
+            for i in range(self.goal_types)
+        ]
+        registered = int(self.participants * self.registered)
+        self.create_users(registered)
+        self.create_anonymous_visitors(self.participants - registered)
+        l.info("Created %d participants for %s" %
+               (self.participants, self.experiment))
+        return self.experiment
+
+    def create_users(self, count):
+        prefix = '%s-' % self.name
+        now = datetime.now()
+        bulk_insert(User, ['username', 'first_name', 'last_name', 'email',
+                           'password', 'is_staff', 'is_active',
+                           'is_superuser', 'last_login', 'date_joined'],
+                    (('%s%d' % (prefix, i), '', '', '', '!', False, True,
+                      False, now, now) for i in xrange(count)))
+        user_ids = User.objects.filter(
+            username__startswith=prefix
+        ).order_by('id').values_list('id', flat=True)
+        self.create_participants(list(user_ids), 'user')
+
+    def create_anonymous_visitors(self, count):
+        first_id = (AnonymousVisitor.objects.order_by('-id')
+                    .values_list('id', flat=True)[:1] or [0])[0] + 1
+        created = datetime.combine(self.start_date, time())
+        bulk_insert(AnonymousVisitor, ['created'],
+                    ((created,) for i in xrange(count)))
+        visitor_ids = AnonymousVisitor.objects.filter(
+            id__gte=first_id
+        ).order_by('id').values_list('id', flat=True)
+        self.create_participants(list(visitor_ids), 'anonymous_visitor')
+
+    def create_participants(self, ids, field):
+        """
+        Enrolls the users or anonymous visitors with the given `ids`, by
+        chunks to bound memory use, along with their goal records.
+        """
+        for start in xrange(0, len(ids), CHUNK_SIZE):
+            participants = []
+            goal_records = []
+            for id in ids[start:start + CHUNK_SIZE]:
+                group = self.random.choice((Participant.CONTROL_GROUP,
+                                            Participant.TEST_GROUP))
+                enrollment_date = (self.start_date +
+                                   timedelta(days=self.random.randrange(self.days)))
+                participants.append((self.experiment.id, group,
+                                     enrollment_date, id))
+                if field == 'anonymous_visitor':
+                    goal_records.extend(
+                        self.goal_records(id, group, enrollment_date))
+            bulk_insert(Participant, ['experiment', 'group',
+                                      'enrollment_date', field],
+                        participants)
+            bulk_insert(GoalRecord, ['created', 'anonymous_visitor',
+                                     'goal_type'],
+                        goal_records)
+
+    def goal_records(self, anonymous_visitor_id, group, enrollment_date):
+        start = datetime.combine(enrollment_date, time())
+        seconds = ((self.end_date - enrollment_date).days + 1) * 24 * 3600
+        for goal_type, rate in self.goal_type_rates:
+            if group == Participant.TEST_GROUP:
+                rate *= self.TEST_GROUP_LIFT
+            if self.random.random() >= rate:
+                continue
+            while True:
+                created = start + timedelta(
+                    seconds=self.random.randrange(seconds))
+                yield (created, anonymous_visitor_id, goal_type.id)
+                if self.random.random() >= self.REPEAT_PROBABILITY:
+                    break
+
+    def delete(self):
+        """
+        Deletes the experiment along with its participants, their goal
+        records and its reports, without loading them.
+        """
+        experiment = self.experiment or Experiment.objects.get(name=self.name)
+        qn = connection.ops.quote_name
+        def enrolled(column):
+            return 'IN (SELECT %s FROM %s WHERE %s = %%s)' % (
+                qn(column), qn(Participant._meta.db_table),
+                qn('experiment_id'))
+        def reports(model):
+            return 'IN (SELECT %s FROM %s WHERE %s = %%s)' % (
+                qn('id'), qn(model._meta.db_table), qn('experiment_id'))
+        statements = [
+            (GoalRecord, 'anonymous_visitor_id', enrolled('anonymous_visitor_id')),
+            (AnonymousVisitor, 'id', enrolled('anonymous_visitor_id')),
+            (User, 'id', enrolled('user_id')),
+            (DailyConversionReportGoalData, 'report_id',
+             reports(DailyConversionReport)),
+        ] + [(model, 'experiment_id', '= %s')
+             for model in (Participant, DailyConversionReport,
+                           DailyEngagementReport, ReportWorkUnit)]
+        # Foreign keys are only checked on commit, where they are enforced.
+        cursor = connection.cursor()
+        for model, column, condition in statements:
+            cursor.execute('DELETE FROM %s WHERE %s %s' % (
+                qn(model._meta.db_table), qn(column), condition),
+                [experiment.id])
+        transaction.commit_unless_managed()
+        experiment.delete()
+        self.experiment = None
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import logging
+l = logging.getLogger(__name__)
+
+from django_lean.experiments.instrumentation import Measurement, PeakMemory
+
+
+class ConstantEngagementCalculator(object):
+    """Engagement calculator that only costs the generator's overhead."""
+    def calculate_user_engagement_score(self, user, start_date, end_date):
+        return 1
+
+
+class ReportBenchmarkResult(object):
+    def __init__(self, participants, report_type, scope, measurement,
+                 peak_memory):
+        self.participants = participants
+        self.report_type = report_type
+        self.scope = scope
+        self.duration = measurement.duration
+        self.queries = measurement.queries
+        self.peak_memory = peak_memory
+
+    def __unicode__(self):
+        return '%10d %-10s %-10s %9.3fs %9d queries %9.1f MB' % (
+            self.participants, self.report_type, self.scope, self.duration,
+            self.queries, (self.peak_memory or 0) / 1048576.)
+
+
+def benchmark_reports(data, generators):
+    """
+    Generates every daily report of the BenchmarkData's experiment with
+    each of the `generators`, measuring each day and the whole range.
+    Returns a list of ReportBenchmarkResults.
+    """
+    results = []
+    for generator in generators:
+        total = Measurement()
+        peak = None
+        for report_date in data.report_dates():
+            measurement = Measurement()
+            with total.measure():
+                with PeakMemory() as memory:
+                    with measurement.measure():
+                        generator.generate_daily_report_for_experiment(
+                            experiment=data.experiment,
+                            report_date=report_date)
+            peak = max(peak, memory.peak)
+            results.append(ReportBenchmarkResult(
+                data.participants, generator.report_type, str(report_date),
+                measurement, memory.peak))
+        results.append(ReportBenchmarkResult(
+            data.participants, generator.report_type, 'range', total, peak))
+    return results
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import logging
+l = logging.getLogger(__name__)
+
+from contextlib import contextmanager
+from math import ceil
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import clear_url_caches, reverse
+from django.test.client import Client
+
+from django_lean.experiments.benchmarks.views import experiment_name
+from django_lean.experiments.instrumentation import Measurement
+from django_lean.experiments.models import Experiment, GoalType
+
+
+URLCONF = 'django_lean.experiments.benchmarks.urls'
+
+TAGS = ('experiment', 'clientsideexperiment')
+BLOCK_COUNTS = (1, 5, 20)
+# Anonymous visitors that did not call confirm_human yet only have
+# temporary enrollments in their session.
+USER_TYPES = ('unverified', 'anonymous', 'registered')
+GOAL_NAME = 'benchmark-request-goal'
+# Blocks on the page visited before hitting the goal and confirm_human views
+VISITED_BLOCKS = 5
+
+
+class RequestBenchmarkResult(object):
+    def __init__(self, scenario, user_type):
+        self.scenario = scenario
+        self.user_type = user_type
+        self.durations = []
+        self.queries = []
+
+    def add(self, measurement):
+        self.durations.append(measurement.duration)
+        self.queries.append(measurement.queries)
+
+    def percentile(self, percent):
+        """Returns the nearest-rank `percent` percentile of the durations."""
+        values = sorted(self.durations)
+        rank = int(ceil(percent / 100. * len(values)))
+        return values[max(rank - 1, 0)]
+
+    def __unicode__(self):
+        return ('%-26s %-10s %5d   p50 %7.2fms  p90 %7.2fms  p99 %7.2fms'
+                '   queries %5.1f avg %4d max' % (
+                self.scenario, self.user_type, len(self.durations),
+                self.percentile(50) * 1000, self.percentile(90) * 1000,
+                self.percentile(99) * 1000,
+                float(sum(self.queries)) / len(self.queries),
+                max(self.queries)))
+
+
+@contextmanager
+def urlconf(name):
+    """Serves requests made through the test client with urlconf `name`."""
+    original = settings.ROOT_URLCONF
+    settings.ROOT_URLCONF = name
+    clear_url_caches()
+    try:
+        yield
+    finally:
+        settings.ROOT_URLCONF = original
+        clear_url_caches()
+
+
+class RequestBenchmark(object):
+    """
+    Measures the latency and queries of requests going through django-lean:
+    pages rendering several experiment template tags, the goal pixel and
+    confirm_human, for each type of user.
+
+    Every sample is made by a new visitor, so that enrollments are included
+    in the measures. It creates experiments and users, and is meant to be
+    run against a scratch database.
+    """
+    def __init__(self, iterations=100, block_counts=BLOCK_COUNTS,
+                 user_types=USER_TYPES):
+        self.iterations = iterations
+        self.block_counts = block_counts
+        self.user_types = user_types
+        self.users = 0
+
+    def setup(self):
+        for i in range(max(tuple(self.block_counts) + (VISITED_BLOCKS,))):
+            experiment, created = Experiment.objects.get_or_create(
+                name=experiment_name(i))
+            if experiment.state != Experiment.ENABLED_STATE:
+                experiment.state = Experiment.ENABLED_STATE
+                experiment.save()
+        GoalType.objects.get_or_create(name=GOAL_NAME)
+
+    def render_url(self, tag, blocks):
+        return reverse('django_lean.experiments.benchmarks.views.render_blocks',
+                       urlconf=URLCONF, kwargs={'tag': tag,
+                                                'blocks': str(blocks)})
+
+    def create_client(self, user_type):
+        client = Client()
+        if user_type == 'registered':
+            self.users += 1
+            username = 'benchmark-request-user-%d' % self.users
+            User.objects.create_user(username, '%s@example.com' % username,
+                                     'password')
+            if not client.login(username=username, password='password'):
+                raise Exception("login failure")
+        elif user_type == 'anonymous':
+            self.get(client, reverse(
+                    'django_lean.experiments.views.confirm_human',
+                    urlconf=URLCONF))
+        return client
+
+    def get(self, client, url, result=None):
+        measurement = Measurement()
+        with measurement.measure():
+            response = client.get(url)
+        if response.status_code >= 400:
+            raise Exception("%s returned %d" % (url, response.status_code))
+        if result is not None:
+            result.add(measurement)
+
+    def run(self):
+        """Returns a list of RequestBenchmarkResults, one per scenario."""
+        self.setup()
+        results = []
+        visited_url = self.render_url('experiment', VISITED_BLOCKS)
+        with urlconf(URLCONF):
+            for tag in TAGS:
+                for blocks in self.block_counts:
+                    url = self.render_url(tag, blocks)
+                    for user_type in self.user_types:
+                        result = RequestBenchmarkResult(
+                            '%s x%d' % (tag, blocks), user_type)
+                        for i in range(self.iterations):
+                            self.get(self.create_client(user_type), url, result)
+                        results.append(result)
+            for view, kwargs in (('record_experiment_goal',
+                                  {'goal_name': GOAL_NAME}),
+                                 ('confirm_human', {})):
+                url = reverse('django_lean.experiments.views.%s' % view,
+                              urlconf=URLCONF, kwargs=kwargs)
+                for user_type in self.user_types:
+                    result = RequestBenchmarkResult(view, user_type)
+                    for i in range(self.iterations):
+                        client = self.create_client(user_type)
+                        self.get(client, visited_url)
+                        self.get(client, url, result)
+                    results.append(result)
+        return results
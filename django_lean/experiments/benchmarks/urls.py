@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+# Django 1.6 fix
+try:
+    from django.conf.urls import *
+except ImportError:
+    from django.conf.urls.defaults import *
+
+
+urlpatterns = patterns('django_lean.experiments.benchmarks.views',
+    url(r'^render/(?P<tag>\w+)/(?P<blocks>\d+)/$', 'render_blocks'),
+)
+
+urlpatterns += patterns('',
+    url(r'^experiments/', include('django_lean.experiments.urls')),
+)
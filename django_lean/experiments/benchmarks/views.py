@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import logging
+l = logging.getLogger(__name__)
+
+from django.http import HttpResponse
+from django.template import Template, RequestContext
+from django.views.decorators.cache import never_cache
+
+
+BLOCK_TEMPLATES = {
+    'experiment': ('{%% experiment %(name)s test %%}test{%% endexperiment %%}'
+                   '{%% experiment %(name)s control %%}control'
+                   '{%% endexperiment %%}\n'),
+    'clientsideexperiment': '{%% clientsideexperiment %(name)s %%}\n',
+}
+
+_templates = {}
+
+
+def experiment_name(i):
+    return 'benchmark-request-%d' % i
+
+def get_template(tag, blocks):
+    """
+    Returns a compiled template with `blocks` blocks of the `tag` template
+    tag, each on its own experiment. Templates are only compiled once, so
+    that parsing is not measured.
+    """
+    key = (tag, blocks)
+    if key not in _templates:
+        source = '{% load experiments %}\n' + ''.join(
+            BLOCK_TEMPLATES[tag] % {'name': experiment_name(i)}
+            for i in range(blocks))
+        _templates[key] = Template(source)
+    return _templates[key]
+
+@never_cache
+def render_blocks(request, tag, blocks):
+    t = get_template(tag, int(blocks))
+    return HttpResponse(t.render(RequestContext(request, {'request': request})))
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Records goals from the access logs of the web servers, instead of writing
+a GoalRecord for each request of the goal view.
+"""
+from __future__ import with_statement
+
+import logging
+l = logging.getLogger(__name__)
+
+import gzip
+import re
+from datetime import datetime
+from hashlib import md5
+from urllib import unquote
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import transaction
+
+from django_lean import metrics
+from django_lean.experiments.models import (AnonymousVisitor, GoalLogOffset,
+                                            GoalRecord, GoalType)
+from django_lean.experiments.utils import load_session
+from django_lean.utils import bulk_insert
+
+# Django 1.6 fix
+atomic = getattr(transaction, 'atomic', None) or transaction.commit_on_success
+
+# Matches lines of the nginx log format
+#   '$remote_addr - $remote_user [$time_local] "$request" $status '
+#   '$body_bytes_sent "$http_referer" "$http_user_agent" "$cookie_sessionid"'
+# The visitor is identified by the `session` key or the `anonymous_id`
+# group. The `time` and `status` groups are optional.
+DEFAULT_PATTERN = (r'^\S+ \S+ \S+ \[(?P<time>[^\]\s]+)[^\]]*\] '
+                   r'"(?:GET|HEAD) (?P<path>\S+)[^"]*" (?P<status>\d{3}) '
+                   r'.*"(?P<session>[^"]*)"$')
+DEFAULT_TIME_FORMAT = '%d/%b/%Y:%H:%M:%S'
+
+
+def get_goal_prefix():
+    """Returns the path of the goal view, without goal name."""
+    return reverse('django_lean.experiments.views.record_experiment_goal',
+                   args=[''])
+
+
+class GoalLogIngester(object):
+    """
+    Reads the goal view hits out of access logs, and stores them as
+    GoalRecords in batches of `batch_size`, along with the offset reached
+    in each log. The anonymous ids of at most `max_sessions` sessions are
+    kept in memory.
+    """
+    def __init__(self, pattern=DEFAULT_PATTERN, time_format=DEFAULT_TIME_FORMAT,
+                 goal_prefix=None, batch_size=1000, max_sessions=10000):
+        self.pattern = re.compile(pattern)
+        if not ('session' in self.pattern.groupindex or
+                'anonymous_id' in self.pattern.groupindex):
+            raise ValueError("The log pattern needs a session or "
+                             "anonymous_id group")
+        if 'path' not in self.pattern.groupindex:
+            raise ValueError("The log pattern needs a path group")
+        self.time_format = time_format
+        self.goal_prefix = goal_prefix or get_goal_prefix()
+        self.batch_size = batch_size
+        self.max_sessions = max_sessions
+        self.goal_types = {}
+        self.anonymous_ids = {}
+
+    def parse(self, line):
+        """
+        Returns the goal name, anonymous visitor id and time of a hit to
+        the goal view, or None.
+        """
+        match = self.pattern.match(line.rstrip('\r\n'))
+        if match is None:
+            return None
+        hit = match.groupdict()
+        path = hit['path'].split('?', 1)[0]
+        if not path.startswith(self.goal_prefix):
+            return None
+        if not (hit.get('status') or '200').startswith('2'):
+            return None
+        if (hit.get('anonymous_id') or '').isdigit():
+            anonymous_id = int(hit['anonymous_id'])
+        else:
+            anonymous_id = self.get_anonymous_id(hit.get('session'))
+        if not anonymous_id:
+            return None
+        if hit.get('time'):
+            created = datetime.strptime(hit['time'], self.time_format)
+        else:
+            created = datetime.now()
+        return (unquote(path[len(self.goal_prefix):]), anonymous_id, created)
+
+    def get_anonymous_id(self, session_key):
+        if not session_key or session_key == '-':
+            return None
+        # Unknown sessions are cached too, and never created
+        if session_key not in self.anonymous_ids:
+            if len(self.anonymous_ids) >= self.max_sessions:
+                self.anonymous_ids.clear()
+            session = load_session(session_key)
+            self.anonymous_ids[session_key] = (session or {}).get(
+                'anonymous_id')
+        return self.anonymous_ids[session_key]
+
+    def get_goal_type_id(self, goal_name):
+        if goal_name not in self.goal_types:
+            if getattr(settings, 'LEAN_AUTOCREATE_GOAL_TYPES', False):
+                goal_type = GoalType.objects.get_or_create(name=goal_name)[0]
+            else:
+                try:
+                    goal_type = GoalType.objects.get(name=goal_name)
+                except GoalType.DoesNotExist:
+                    l.warning("Can't find the GoalType named %s" % goal_name)
+                    goal_type = None
+            self.goal_types[goal_name] = goal_type and goal_type.id
+        return self.goal_types[goal_name]
+
+    def write(self, hits, log_offset):
+        """Stores `hits` along with the offset reached in their log."""
+        visitor_ids = set(AnonymousVisitor.objects.filter(
+            id__in=set(hit[1] for hit in hits)
+        ).values_list('id', flat=True))
+        rows = []
+        for goal_name, anonymous_id, created in hits:
+            goal_type_id = self.get_goal_type_id(goal_name)
+            if goal_type_id is not None and anonymous_id in visitor_ids:
+                rows.append((created, anonymous_id, goal_type_id))
+                metrics.increment('goal_records_total', goal_type=goal_name)
+        with atomic():
+            written = bulk_insert(GoalRecord, ('created', 'anonymous_visitor',
+                                               'goal_type'), rows)
+            log_offset.save()
+        return written
+
+    def open(self, path):
+        if path.endswith('.gz'):
+            return gzip.open(path, 'rb')
+        return open(path, 'rb')
+
+    def ingest(self, path):
+        """
+        Records the goals of the log at `path` since the last call, and
+        returns the number of GoalRecords written.
+        """
+        log_offset, created = GoalLogOffset.objects.get_or_create(path=path)
+        written = 0
+        fp = self.open(path)
+        try:
+            signature = md5(fp.readline()).hexdigest()
+            if signature != log_offset.signature:
+                # A new file, or a rotated one
+                log_offset.offset = 0
+                log_offset.signature = signature
+            fp.seek(log_offset.offset)
+            hits = []
+            while True:
+                line = fp.readline()
+                if not line.endswith('\n'):
+                    # The end of the log, or a line still being written
+                    break
+                log_offset.offset += len(line)
+                try:
+                    hit = self.parse(line)
+                except ValueError, e:
+                    l.warning("Skipping line of %s: %s" % (path, e))
+                    continue
+                if hit is not None:
+                    hits.append(hit)
+                    if len(hits) >= self.batch_size:
+                        written += self.write(hits, log_offset)
+                        hits = []
+            written += self.write(hits, log_offset)
+        finally:
+            fp.close()
+        l.info("Recorded %d goals from %s, up to offset %d" %
+               (written, path, log_offset.offset))
+        return written
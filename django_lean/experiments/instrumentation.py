@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import logging
+l = logging.getLogger(__name__)
+
+import cProfile
+import os
+import re
+import resource
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from time import time
+
+from django.conf import settings
+from django.db import connection
+
+from django_lean.experiments.signals import report_measured
+
+# Statements Django runs around saves on some versions and databases.
+# The sqlite backend of Django 1.5 and 1.6 records queries as
+# "QUERY = u'...' - PARAMS = (...)".
+SAVEPOINT_RE = re.compile(r'^(QUERY = u?[\'"])?\s*(SAVEPOINT|RELEASE '
+                          r'SAVEPOINT|ROLLBACK TO SAVEPOINT)\b', re.IGNORECASE)
+
+
+class QueryCounter(object):
+    """
+    Context manager counting the database queries run inside its block.
+
+    Queries are recorded even when settings.DEBUG is False. In that case
+    the recorded queries are discarded on exit, so that long-running
+    processes do not accumulate them. They remain available in the
+    `queries` attribute of the counter.
+
+    Savepoint statements are not counted, so that counts are the same on
+    every version of Django.
+    """
+    def __init__(self):
+        self.count = 0
+        self.queries = []
+
+    def __enter__(self):
+        self.previous = getattr(connection, 'use_debug_cursor', None)
+        self.discard = not (self.previous or settings.DEBUG)
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.queries = [query for query in connection.queries[self.start:]
+                        if not SAVEPOINT_RE.match(query['sql'])]
+        self.count = len(self.queries)
+        if self.discard:
+            del connection.queries[self.start:]
+        connection.use_debug_cursor = self.previous
+
+
+class Measurement(object):
+    """Accumulates the wall time and queries of the blocks it measures."""
+    def __init__(self):
+        self.duration = 0.0
+        self.queries = 0
+
+    @contextmanager
+    def measure(self):
+        start = time()
+        counter = QueryCounter()
+        try:
+            with counter:
+                yield self
+        finally:
+            self.duration += time() - start
+            self.queries += counter.count
+
+
+def send_report_measurement(report_type, experiment, report_date, goal_type,
+                            measurement):
+    """
+    Logs the cost of generating a report, or of the part of it concerning
+    `goal_type`, and sends the `report_measured` signal.
+    """
+    if goal_type is None:
+        subject = '%s report' % report_type
+    else:
+        subject = '%s report goal type %s' % (report_type, goal_type)
+    l.info("%s for %s on %s: %.3fs, %d queries" %
+           (subject, experiment, report_date, measurement.duration,
+            measurement.queries))
+    report_measured.send(sender=Measurement, report_type=report_type,
+                         experiment=experiment, report_date=report_date,
+                         goal_type=goal_type, duration=measurement.duration,
+                         queries=measurement.queries)
+
+
+@contextmanager
+def profile(directory, name):
+    """
+    Profiles the block with cProfile, writing the stats to `directory`.
+
+    If the tracemalloc module is available, a snapshot of the memory
+    allocations made in the block is written alongside.
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    prefix = os.path.join(directory, '%s-%s' % (
+        name, datetime.now().strftime('%Y%m%d-%H%M%S')))
+    profiler = cProfile.Profile()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(prefix + '.prof')
+        l.info("Wrote profile to %s.prof" % prefix)
+        if tracemalloc is not None:
+            tracemalloc.take_snapshot().dump(prefix + '.tracemalloc')
+            tracemalloc.stop()
+            l.info("Wrote memory snapshot to %s.tracemalloc" % prefix)
+
+
+class PeakMemory(object):
+    """
+    Context manager measuring the peak memory used inside its block, in
+    bytes.
+
+    The tracemalloc module is used when it is available. Otherwise, the
+    process' maximum resident set size is reported, which cannot go down
+    between blocks.
+    """
+    def __init__(self):
+        self.peak = None
+
+    def __enter__(self):
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        self.tracemalloc = tracemalloc
+        if tracemalloc is not None:
+            self.started = not tracemalloc.is_tracing()
+            if self.started:
+                tracemalloc.start()
+            tracemalloc.clear_traces()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.tracemalloc is not None:
+            self.peak = self.tracemalloc.get_traced_memory()[1]
+            if self.started:
+                self.tracemalloc.stop()
+        else:
+            # ru_maxrss is in kilobytes on Linux
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+_local = threading.local()
+
+
+class RequestOverhead(object):
+    """
+    What django-lean cost during a request: experiment checks, enrollments
+    and goal records, along with the time and queries spent in them.
+    """
+    def __init__(self):
+        self.checks = 0
+        self.enrollments = 0
+        self.goals = 0
+        self.queries = 0
+        self.duration = 0.0
+        self.depth = 0
+
+def start_request_overhead():
+    """Starts accounting django-lean's overhead in the current thread."""
+    _local.overhead = RequestOverhead()
+    return _local.overhead
+
+def stop_request_overhead():
+    """Stops accounting and returns the RequestOverhead, if any."""
+    overhead = getattr(_local, 'overhead', None)
+    _local.overhead = None
+    return overhead
+
+def count_request_overhead(kind):
+    """Counts one more `kind` of event towards the current request."""
+    overhead = getattr(_local, 'overhead', None)
+    if overhead is not None:
+        setattr(overhead, kind, getattr(overhead, kind) + 1)
+
+@contextmanager
+def request_overhead(kind=None):
+    """
+    Accounts the time and queries of the block to the current request,
+    counting it as one more `kind` of event if given. Nested blocks are
+    only counted, so that nothing is accounted twice.
+    """
+    overhead = getattr(_local, 'overhead', None)
+    if overhead is None:
+        yield
+        return
+    if kind is not None:
+        setattr(overhead, kind, getattr(overhead, kind) + 1)
+    if overhead.depth:
+        yield
+        return
+    overhead.depth += 1
+    start = time()
+    counter = QueryCounter()
+    try:
+        with counter:
+            yield
+    finally:
+        overhead.depth -= 1
+        overhead.duration += time() - start
+        overhead.queries += counter.count
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import logging
+l=logging.getLogger(__name__)
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from django_lean.experiments.benchmarks.data import BenchmarkData
+from django_lean.experiments.benchmarks.reports import (
+    ConstantEngagementCalculator, benchmark_reports)
+from django_lean.experiments.management.commands.update_experiment_reports \
+    import _load_function
+from django_lean.experiments.reports import (EngagementReportGenerator,
+                                             ConversionReportGenerator)
+
+
+DEFAULT_SCALES = (10000, 100000, 1000000)
+
+
+class Command(BaseCommand):
+    help = ('benchmark_experiment_reports : Time the daily report generators'
+            ' against synthetic experiments of increasing size')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--participants', action='append', type='int', metavar='N',
+            help=('Benchmark an experiment with N participants; may be given '
+                  'several times. Defaults to %s.' %
+                  '/'.join(str(n) for n in DEFAULT_SCALES))
+        ),
+        make_option(
+            '--goal-types', type='int', default=5, dest='goal_types',
+            help='Number of goal types to record conversions for.'
+        ),
+        make_option(
+            '--days', type='int', default=14,
+            help='Number of days the experiments ran for.'
+        ),
+        make_option(
+            '--registered', type='float', default=0.1, metavar='FRACTION',
+            help='Fraction of the participants that are registered users.'
+        ),
+        make_option(
+            '--seed', type='int', default=0,
+            help='Seed of the data generator.'
+        ),
+        make_option(
+            '--keep', action='store_true', default=False,
+            help='Do not delete the synthetic experiments afterwards.'
+        ),
+        make_option(
+            '--noinput', action='store_false', dest='interactive',
+            default=True,
+            help='Do not ask for confirmation before writing to the database.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if len(args):
+            raise CommandError("This command does not take any arguments")
+        scales = options.get('participants') or DEFAULT_SCALES
+        if options.get('interactive', True):
+            confirm = raw_input(
+                "This will create synthetic experiments with up to %d "
+                "participants in the database.\nType 'yes' to continue: " %
+                max(scales))
+            if confirm != 'yes':
+                raise CommandError("Benchmark cancelled.")
+        engagement_calculator = getattr(settings, 'LEAN_ENGAGEMENT_CALCULATOR', None)
+        if engagement_calculator:
+            engagement_calculator = _load_function(engagement_calculator)()
+        else:
+            engagement_calculator = ConstantEngagementCalculator()
+        for participants in scales:
+            data = BenchmarkData(participants,
+                                 goal_types=options['goal_types'],
+                                 days=options['days'],
+                                 registered=options['registered'],
+                                 seed=options['seed'])
+            data.create()
+            try:
+                generators = [
+                    ConversionReportGenerator(),
+                    EngagementReportGenerator(
+                        engagement_score_calculator=engagement_calculator),
+                ]
+                for result in benchmark_reports(data, generators):
+                    print unicode(result)
+            finally:
+                if not options.get('keep'):
+                    data.delete()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import logging
+l=logging.getLogger(__name__)
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from django_lean.experiments.benchmarks.request_path import (BLOCK_COUNTS,
+                                                             RequestBenchmark)
+
+
+class Command(BaseCommand):
+    help = ('benchmark_experiment_requests : Measure the latency and queries'
+            ' of experiment template tags, the goal pixel and confirm_human'
+            ' on a scratch test database')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--iterations', type='int', default=100,
+            help='Number of requests to make in each scenario.'
+        ),
+        make_option(
+            '--blocks', action='append', type='int', metavar='N',
+            help=('Render pages with N experiment blocks; may be given '
+                  'several times. Defaults to %s.' %
+                  '/'.join(str(n) for n in BLOCK_COUNTS))
+        ),
+        make_option(
+            '--noinput', action='store_false', dest='interactive',
+            default=True,
+            help='Destroy a leftover test database without asking.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if len(args):
+            raise CommandError("This command does not take any arguments")
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=not options.get('interactive', True))
+        try:
+            benchmark = RequestBenchmark(
+                iterations=options['iterations'],
+                block_counts=options.get('blocks') or BLOCK_COUNTS)
+            for result in benchmark.run():
+                print unicode(result)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import logging
+l=logging.getLogger(__name__)
+
+from fcntl import LOCK_EX
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_lean.experiments.goal_logs import (DEFAULT_PATTERN,
+                                               DEFAULT_TIME_FORMAT,
+                                               GoalLogIngester)
+from django_lean.lockfile import lockfile
+
+
+LOCKFILE = 'ingest_goal_logs.lock'
+
+
+class Command(BaseCommand):
+    args = 'LOG [LOG ...]'
+    help = ('ingest_goal_logs : Record the goals found in web server access '
+            'logs, plain or gzipped, resuming where the last run stopped.')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--pattern', default=DEFAULT_PATTERN, metavar='REGEX',
+            help=('Regular expression matching log lines, with a path group '
+                  'and a session or anonymous_id group, and optional time '
+                  'and status groups.')
+        ),
+        make_option(
+            '--time-format', default=DEFAULT_TIME_FORMAT, metavar='FORMAT',
+            help='strptime() format of the time group.'
+        ),
+        make_option(
+            '--goal-prefix', metavar='PATH',
+            help=('Path of the goal view, without goal name. Defaults to the '
+                  'one of the URL configuration.')
+        ),
+        make_option(
+            '--batch-size', type='int', default=1000,
+            help='Number of goals written per transaction.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("This command takes the paths of the logs")
+        try:
+            ingester = GoalLogIngester(pattern=options['pattern'],
+                                       time_format=options['time_format'],
+                                       goal_prefix=options.get('goal_prefix'),
+                                       batch_size=options['batch_size'])
+        except Exception, e:
+            raise CommandError("Invalid --pattern: %s" % e)
+        with lockfile(LOCKFILE, LOCK_EX, wait=False):
+            for path in args:
+                ingester.ingest(path)
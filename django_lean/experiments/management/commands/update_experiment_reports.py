@@ -1,29 +1,104 @@
 # -*- coding: utf-8 -*-
+from __future__ import with_statement
+
 import logging
 l=logging.getLogger(__name__)
 
+from fcntl import LOCK_EX
+from optparse import make_option
+
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
+from django_lean.experiments.instrumentation import profile
 from django_lean.experiments.reports import (EngagementReportGenerator,
                                              ConversionReportGenerator)
+from django_lean.experiments.worker import ReportWorker
+from django_lean.lockfile import lockfile
+
+
+LOCKFILE = 'update_experiment_reports.lock'
 
 
 class Command(BaseCommand):
     help = ('update_experiment_reports : Generate all the daily reports for'
             ' for the SplitTesting experiments')
 
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--sample', type='float', metavar='FRACTION',
+            help=('Print preview reports computed from a FRACTION (0 to 1) '
+                  'of the participants, without storing them.')
+        ),
+        make_option(
+            '--daemon', action='store_true', default=False,
+            help=('Keep running, generating reports from a durable queue '
+                  'as days close.')
+        ),
+        make_option(
+            '--interval', type='int', default=300, metavar='SECONDS',
+            help='Seconds between queue checks in daemon mode.'
+        ),
+        make_option(
+            '--profile', metavar='DIRECTORY',
+            help=('Write cProfile stats, and tracemalloc snapshots when '
+                  'available, for this run to DIRECTORY.')
+        ),
+    )
+
     def __init__(self):
         super(self.__class__, self).__init__()
 
     def handle(self, *args, **options):
         if len(args):
             raise CommandError("This command does not take any arguments")
+        sample = options.get('sample')
+        if sample is not None and not 0 < sample <= 1:
+            raise CommandError("--sample must be between 0 and 1")
+        if options.get('profile'):
+            with profile(options['profile'], 'update_experiment_reports'):
+                self.generate(**options)
+        else:
+            self.generate(**options)
+
+    def generate(self, **options):
+        sample = options.get('sample')
+        generators = {}
         engagement_calculator = getattr(settings, 'LEAN_ENGAGEMENT_CALCULATOR', None)
         if engagement_calculator:
             engagement_calculator = _load_function(engagement_calculator)()
-            EngagementReportGenerator(engagement_score_calculator=engagement_calculator).generate_all_daily_reports()
-        ConversionReportGenerator().generate_all_daily_reports()
+            generators['engagement'] = EngagementReportGenerator(
+                engagement_score_calculator=engagement_calculator,
+                sample=sample)
+        generators['conversion'] = ConversionReportGenerator(sample=sample)
+        if sample is not None:
+            for generator in generators.values():
+                for report in generator.generate_preview_reports():
+                    print format_preview(report)
+            return
+        with lockfile(LOCKFILE, LOCK_EX, wait=False):
+            if options.get('daemon'):
+                ReportWorker(generators).run(interval=options['interval'])
+            else:
+                for generator in generators.values():
+                    generator.generate_all_daily_reports()
+
+def format_preview(report):
+    """Returns a one-line summary of a preview report."""
+    if hasattr(report, 'overall_test_conversion'):
+        scores = 'control %d/%d, test %d/%d converted' % (
+            report.overall_control_conversion, report.control_group_size,
+            report.overall_test_conversion, report.test_group_size)
+    else:
+        scores = 'control %s (%d), test %s (%d) engagement' % (
+            report.control_score, report.control_group_size,
+            report.test_score, report.test_group_size)
+    confidence = report.confidence
+    if confidence is not None:
+        confidence = '%.0f %%' % confidence
+    return 'PREVIEW (%g %% sample) %s %s %s: %s, confidence %s' % (
+        report.sample * 100, report.__class__.__name__, report.experiment,
+        report.date, scores, confidence)
 
 def _load_function(fully_qualified_name):
     i = fully_qualified_name.rfind('.')
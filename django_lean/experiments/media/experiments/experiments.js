@@ -4,11 +4,14 @@
  *       experiments.control("experiments_name");
  *   and
  *       experiments.test("experiments_name");
+ *   On pages served from a shared cache, the groups are fetched with:
+ *       experiments.load(["experiment_name"], function() { ... });
  *   Relies on JQuery
 **/
 experiments = function() {
     // experiment_enrollment should have the following format { experiment_name : group }
     var experiment_enrollment = {};
+    var human_confirmation_sent = false;
 
     return {
         record_enrollment: function(experiment_name, group) {
@@ -34,8 +37,37 @@ experiments = function() {
                 return false;
             }
         },
-        confirm_human: function() {
+        confirm_human: function(stale) {
+            // Sent at most once per visitor: the lean_human cookie marks
+            // visitors that were confirmed, or are being confirmed. The
+            // server passes stale when the session of its marker is gone.
+            var marker = /(^|;\s*)lean_human=([^;]*)/.exec(document.cookie);
+            if (human_confirmation_sent || (marker && !stale)) {
+                return;
+            }
+            human_confirmation_sent = true;
+            document.cookie = "lean_human=pending; max-age=60; path=/";
             $.get("/experiments/confirm_human/");
+        },
+        load: function(experiment_names, callback) {
+            // Fetches the groups of the experiments asynchronously, then
+            // calls callback. If the request fails, the experiments remain
+            // unknown and the user sees the control case.
+            $.ajax({
+                url: "/experiments/assignments/",
+                data: {experiments: experiment_names.join(",")},
+                dataType: "json",
+                success: function(assignments) {
+                    $.each(assignments, function(experiment_name, group) {
+                        experiment_enrollment[experiment_name] = group;
+                    });
+                },
+                complete: function() {
+                    if (callback) {
+                        callback();
+                    }
+                }
+            });
         }
     };
 }();
\ No newline at end of file
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+import logging
+l = logging.getLogger(__name__)
+
+from urllib import unquote
+
+from django.conf import settings
+from django.core.signing import BadSignature, Signer
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.decorators import decorator_from_middleware_with_args
+from django.utils.http import urlquote
+
+from django_lean.experiments.instrumentation import (start_request_overhead,
+                                                     stop_request_overhead)
+from django_lean.experiments.models import Experiment, Participant
+from django_lean.experiments.utils import WebUser
+
+
+class ExperimentOverheadMiddleware(object):
+    """
+    Measures what django-lean costs each request: experiment checks,
+    enrollments, goal records, and the time and queries spent in them.
+
+    The measures are sent in a `Server-Timing` header, and logged as a
+    warning when the time exceeds LEAN_OVERHEAD_LOG_THRESHOLD milliseconds
+    (100 by default; None disables logging).
+
+    To use, install it first in settings.MIDDLEWARE_CLASSES, so that it
+    also measures the work done by other middleware:
+
+    MIDDLEWARE_CLASSES = (
+        'django_lean.experiments.middleware.ExperimentOverheadMiddleware',
+        ...
+    )
+    """
+    def process_request(self, request):
+        start_request_overhead()
+
+    def process_response(self, request, response):
+        overhead = stop_request_overhead()
+        if overhead is None:
+            return response
+        summary = '%d checks, %d enrollments, %d goals, %d queries' % (
+            overhead.checks, overhead.enrollments, overhead.goals,
+            overhead.queries)
+        timing = 'django-lean;dur=%.1f;desc="%s"' % (overhead.duration * 1000,
+                                                     summary)
+        if response.has_header('Server-Timing'):
+            timing = '%s, %s' % (response['Server-Timing'], timing)
+        response['Server-Timing'] = timing
+        threshold = getattr(settings, 'LEAN_OVERHEAD_LOG_THRESHOLD', 100)
+        if threshold is not None and overhead.duration * 1000 > threshold:
+            l.warning("django-lean spent %.1fms on %s: %s" %
+                      (overhead.duration * 1000, request.path, summary))
+        return response
+
+
+BUCKET_HEADER = 'X-Experiment-Bucket'
+BUCKET_META = 'HTTP_X_EXPERIMENT_BUCKET'
+BUCKET_SALT = 'django_lean.experiments.buckets'
+
+GROUP_CODES = {Participant.CONTROL_GROUP: 'c', Participant.TEST_GROUP: 't'}
+
+
+def format_bucket(groups):
+    """
+    Returns the bucket naming the `groups` of a user, a dict of groups by
+    experiment name, like 'experiment%201:t~other:c'.
+    """
+    return '~'.join('%s:%s' % (urlquote(name, safe=''), GROUP_CODES[group])
+                    for name, group in sorted(groups.items()))
+
+def parse_bucket(bucket):
+    """Returns the dict of groups by experiment name named by `bucket`."""
+    codes = dict((code, group) for group, code in GROUP_CODES.items())
+    groups = {}
+    for item in bucket.split('~'):
+        name, code = item.rsplit(':', 1)
+        groups[unquote(name).decode('utf-8')] = codes[code]
+    return groups
+
+
+class ExperimentBucketMiddleware(object):
+    """
+    Makes pages depending on experiments cacheable, by resolving the groups
+    of the user in these experiments before the view runs.
+
+    The groups are summed up in a bucket, which is stored in a signed
+    cookie and sent in the X-Experiment-Bucket response header. The bucket
+    is also put in the X-Experiment-Bucket request header, along with a
+    `Vary` on it, so that Django's cache middleware keeps one page per
+    bucket rather than per user. Reverse proxies can do the same, taking
+    the bucket from the cookie, whose value is '<bucket>:<signature>'.
+
+    While the cookie covers all the experiments, it is trusted for pages
+    served from the cache, and checked before the view runs, so that
+    rendered pages always match their bucket. The experiment template tags
+    reuse the resolved groups. Responses that set the cookie are marked
+    private, so that they are not cached.
+
+    Pages keep varying on the session cookie, unless their view is shared:
+    it renders nothing private from the session besides the experiment
+    groups. Shared views are listed by name, like 'app.views.home', in
+    LEAN_BUCKET_SHARED_VIEWS. Even then, only the pages of anonymous users
+    whose session is left unchanged are shared by the bucket, and those
+    creating or modifying a session are marked private.
+
+    The experiments are listed in LEAN_BUCKET_EXPERIMENTS, and the cookie
+    is named by LEAN_BUCKET_COOKIE_NAME ('lean_bucket' by default).
+    Install it after the session and authentication middleware, and before
+    FetchFromCacheMiddleware:
+
+    MIDDLEWARE_CLASSES = (
+        'django.middleware.cache.UpdateCacheMiddleware',
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'django_lean.experiments.middleware.ExperimentBucketMiddleware',
+        'django.middleware.cache.FetchFromCacheMiddleware',
+    )
+
+    The experiment_buckets decorator does the same for a single view; put
+    it above cache_page.
+    """
+    def __init__(self, experiment_names=None, shared=False):
+        if experiment_names is None:
+            experiment_names = getattr(settings, 'LEAN_BUCKET_EXPERIMENTS', ())
+        self.experiment_names = tuple(experiment_names)
+        self.shared = shared
+        self.shared_views = frozenset(getattr(settings,
+                                              'LEAN_BUCKET_SHARED_VIEWS', ()))
+        self.cookie_name = getattr(settings, 'LEAN_BUCKET_COOKIE_NAME',
+                                   'lean_bucket')
+        self.signer = Signer(salt=BUCKET_SALT)
+
+    def read_cookie(self, request):
+        value = request.COOKIES.get(self.cookie_name)
+        if not value:
+            return None
+        try:
+            groups = parse_bucket(self.signer.unsign(value))
+        except (BadSignature, ValueError, KeyError):
+            return None
+        if set(groups) != set(self.experiment_names):
+            return None
+        return groups
+
+    def resolve(self, request):
+        user = WebUser(request)
+        groups = dict((name, Experiment.group(name, user))
+                      for name in self.experiment_names)
+        self.set_groups(request, groups, resolved=True)
+
+    def is_shared_view(self, view_func):
+        name = '%s.%s' % (getattr(view_func, '__module__', None),
+                          getattr(view_func, '__name__', None))
+        return self.shared or name in self.shared_views
+
+    def is_shared(self, request):
+        """
+        Returns whether the page may be shared by all the visitors of its
+        bucket: those of shared views, for anonymous users whose session
+        was neither created nor modified by the request.
+        """
+        if not getattr(request, 'experiment_bucket_shared', False):
+            return False
+        session = getattr(request, 'session', None)
+        if session is None:
+            return True
+        if session.modified or getattr(settings, 'SESSION_SAVE_EVERY_REQUEST',
+                                       False):
+            return False
+        if (session.session_key !=
+            request.COOKIES.get(settings.SESSION_COOKIE_NAME)):
+            # An expired or evicted session was replaced
+            return False
+        user = getattr(request, 'user', None)
+        return user is None or user.is_anonymous()
+
+    def set_groups(self, request, groups, resolved):
+        request.experiment_groups = groups
+        request.experiment_groups_resolved = resolved
+        request.META[BUCKET_META] = format_bucket(groups)
+
+    def process_request(self, request):
+        if not self.experiment_names:
+            return None
+        groups = self.read_cookie(request)
+        request.experiment_bucket_cookie = groups
+        if groups is None:
+            self.resolve(request)
+        else:
+            self.set_groups(request, groups, resolved=False)
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.experiment_bucket_shared = self.is_shared_view(view_func)
+        if not getattr(request, 'experiment_groups_resolved', True):
+            self.resolve(request)
+        return None
+
+    def process_response(self, request, response):
+        groups = getattr(request, 'experiment_groups', None)
+        if not self.experiment_names or groups is None:
+            return response
+        bucket = format_bucket(groups)
+        if groups != request.experiment_bucket_cookie:
+            response.set_cookie(self.cookie_name, self.signer.sign(bucket),
+                                max_age=settings.SESSION_COOKIE_AGE,
+                                httponly=True)
+            # Responses setting the cookie are specific to this user
+            patch_cache_control(response, private=True, max_age=0)
+        response[BUCKET_HEADER] = bucket
+        patch_vary_headers(response, (BUCKET_HEADER,))
+        session = getattr(request, 'session', None)
+        if self.is_shared(request):
+            # The groups read from the session are accounted for by the
+            # bucket, so the page does not vary on the session cookie.
+            if session is not None:
+                session.accessed = False
+        elif session is not None and session.modified:
+            # The response sets the session cookie
+            patch_cache_control(response, private=True, max_age=0)
+        return response
+
+def experiment_buckets(experiment_names=None, shared=True):
+    """
+    Decorates a view like ExperimentBucketMiddleware. The view is shared
+    unless `shared` is False.
+    """
+    return decorator_from_middleware_with_args(ExperimentBucketMiddleware)(
+        experiment_names, shared=shared)
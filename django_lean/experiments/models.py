@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
+from __future__ import with_statement
+
 import logging
 l = logging.getLogger(__name__)
 
 from datetime import date
+from time import time
 import random
 
 from django.conf import settings
 from django.db import models
 from django.core.exceptions import ObjectDoesNotExist
 
-from django_lean.experiments.signals import goal_recorded, user_enrolled
+from django_lean import metrics
+from django_lean.experiments.instrumentation import (count_request_overhead,
+                                                     request_overhead)
+from django_lean.experiments.signals import (goal_recorded, report_measured,
+                                             user_enrolled)
 
 AUTH_USER_MODEL = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
 
@@ -57,7 +64,8 @@ class GoalRecord(models.Model):
     @classmethod
     def record(cls, goal_name, experiment_user):
         try:
-            return cls._record(goal_name, experiment_user)
+            with request_overhead('goals'):
+                return cls._record(goal_name, experiment_user)
         except GoalType.DoesNotExist:
             if settings.DEBUG:
                 raise
@@ -207,8 +215,8 @@ class Experiment(models.Model):
         the passed experiment. If the user is not enrolled in this
         experiment, and the experiment is enabled, it will enroll the user.
         """
-        return Experiment.__test_group(experiment_name, experiment_user,
-                                       Participant.CONTROL_GROUP)
+        return (Experiment.group(experiment_name, experiment_user) ==
+                Participant.CONTROL_GROUP)
 
     @staticmethod
     def test(experiment_name, experiment_user):
@@ -217,11 +225,30 @@ class Experiment(models.Model):
         the passed experiment. If the user is not enrolled in this
         experiment, and the experiment is enabled, it will enroll the user.
         """
-        return Experiment.__test_group(experiment_name, experiment_user,
-                                       Participant.TEST_GROUP)
+        return (Experiment.group(experiment_name, experiment_user) ==
+                Participant.TEST_GROUP)
+
+    @classmethod
+    def group(cls, experiment_name, experiment_user):
+        """
+        Returns the group of the user in the passed experiment, either
+        Participant.CONTROL_GROUP or Participant.TEST_GROUP. If the user
+        is not enrolled in this experiment, and the experiment is enabled,
+        it will enroll the user.
+
+        Disabled and unknown experiments put everyone in the control
+        group, and promoted ones everyone in the test group.
+        """
+        start = time()
+        try:
+            with request_overhead('checks'):
+                return cls.__get_group(experiment_name, experiment_user)
+        finally:
+            metrics.observe('experiment_check_seconds', time() - start,
+                            experiment=experiment_name)
 
     @classmethod
-    def __test_group(cls, experiment_name, experiment_user, queried_group):
+    def __get_group(cls, experiment_name, experiment_user):
         """does the real work"""
         from django_lean.experiments.loader import ExperimentLoader
         ExperimentLoader.load_all_experiments()
@@ -236,11 +263,11 @@ class Experiment(models.Model):
             else:
                 l.warning("Can't find the Experiment named %s" %
                           experiment_name)
-                return queried_group == Participant.CONTROL_GROUP
+                return Participant.CONTROL_GROUP
         if experiment.state == Experiment.DISABLED_STATE:
-            return queried_group == Participant.CONTROL_GROUP
+            return Participant.CONTROL_GROUP
         elif experiment.state == Experiment.PROMOTED_STATE:
-            return queried_group == Participant.TEST_GROUP
+            return Participant.TEST_GROUP
 
         if experiment.state != Experiment.ENABLED_STATE:
             raise Exception("Invalid experiment state !")
@@ -254,7 +281,7 @@ class Experiment(models.Model):
                                             Participant.TEST_GROUP))
             user.set_enrollment(experiment, assigned_group)
 
-        return queried_group == assigned_group
+        return assigned_group
 
 
 class Participant(models.Model):
@@ -321,3 +348,70 @@ class  DailyConversionReportGoalData(models.Model):
     test_conversion = models.IntegerField()
     control_conversion = models.IntegerField()
     confidence = models.FloatField(null=True)
+
+
+class ReportWorkUnit(models.Model):
+    """
+    A report to generate for an experiment on a given day. Used as a
+    durable work queue by `update_experiment_reports --daemon`.
+    """
+    PENDING_STATE = 0
+    DONE_STATE = 1
+    FAILED_STATE = 2
+
+    STATES = (
+        (PENDING_STATE, 'Pending'),
+        (DONE_STATE, 'Done'),
+        (FAILED_STATE, 'Failed'))
+
+    experiment = models.ForeignKey(Experiment)
+    report_type = models.CharField(max_length=32)
+    date = models.DateField(db_index=True)
+    state = models.IntegerField(default=PENDING_STATE, choices=STATES,
+                                db_index=True)
+    attempts = models.IntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('experiment', 'report_type', 'date'),)
+
+    def __unicode__(self):
+        return "%s %s %s" % (self.experiment, self.report_type, self.date)
+
+
+class GoalLogOffset(models.Model):
+    """
+    How far `ingest_goal_logs` has read an access log, so that it resumes
+    where it left off. The signature of the first line of the log tells
+    when the file was replaced by a new one.
+    """
+    path = models.CharField(max_length=255, unique=True)
+    offset = models.BigIntegerField(default=0)
+    signature = models.CharField(max_length=32, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return "%s:%d" % (self.path, self.offset)
+
+
+def count_enrollment(sender, experiment, experiment_user, group_id,
+                     *args, **kwargs):
+    metrics.increment('enrollments_total', experiment=experiment.name,
+                      group=dict(Participant.GROUPS)[group_id])
+    count_request_overhead('enrollments')
+
+user_enrolled.connect(count_enrollment)
+
+def count_goal_record(sender, goal_record, experiment_user, *args, **kwargs):
+    metrics.increment('goal_records_total',
+                      goal_type=goal_record.goal_type.name)
+
+goal_recorded.connect(count_goal_record)
+
+def observe_report_duration(sender, report_type, goal_type, duration,
+                            *args, **kwargs):
+    if goal_type is None:
+        metrics.observe('report_generation_seconds', duration,
+                        report_type=report_type)
+
+report_measured.connect(observe_report_duration)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Rate limiting of goal hits, so that a buggy client or a bot cannot flood
+the GoalRecord table.
+
+LEAN_GOAL_RATE_LIMITS maps each scope to a (capacity, period) pair: at
+most `capacity` hits are recorded in a burst, and the allowance refills
+over `period` seconds. The 'visitor' scope limits the hits of each
+visitor to all goals, and the 'goal_type' scope those of each visitor to
+each goal. A scope set to None is not limited. Defaults to
+{'visitor': (60, 60)}.
+"""
+import logging
+l = logging.getLogger(__name__)
+
+from hashlib import md5
+from time import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from django_lean import metrics
+
+
+DEFAULT_GOAL_RATE_LIMITS = {'visitor': (60, 60)}
+
+
+class TokenBucket(object):
+    """
+    Token bucket kept in the cache backend: each key holds up to `capacity`
+    tokens, refilled at `capacity` tokens per `period` seconds.
+
+    Buckets are read and written without locking, so concurrent hits of a
+    key may consume the same token. This is an acceptable error for flood
+    protection, and keeps each check to a cache get and set.
+    """
+    def __init__(self, name, capacity, period):
+        self.name = name
+        self.capacity = float(capacity)
+        self.period = period
+
+    def cache_key(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return 'experiments.ratelimit.%s.%s' % (self.name,
+                                                md5(str(key)).hexdigest())
+
+    def consume(self, key, tokens=1, now=None):
+        """Takes `tokens` from the bucket of `key`, if it has them."""
+        if now is None:
+            now = time()
+        cache_key = self.cache_key(key)
+        state = cache.get(cache_key)
+        if state is None:
+            level = self.capacity
+        else:
+            level, updated = state
+            level = min(self.capacity, level + (now - updated) *
+                        self.capacity / self.period)
+        allowed = level >= tokens
+        if allowed:
+            level -= tokens
+        # The bucket would be full again after the period
+        cache.set(cache_key, (level, now), self.period)
+        return allowed
+
+
+def get_goal_buckets():
+    limits = getattr(settings, 'LEAN_GOAL_RATE_LIMITS',
+                     DEFAULT_GOAL_RATE_LIMITS)
+    buckets = []
+    for scope in ('visitor', 'goal_type'):
+        if limits.get(scope):
+            capacity, period = limits[scope]
+            buckets.append(TokenBucket('goal.%s' % scope, capacity, period))
+        else:
+            buckets.append(None)
+    return buckets
+
+def allow_goal(goal_name, visitor):
+    """
+    Returns whether a hit of `goal_name` by `visitor`, such as a session
+    key or remote address, may be recorded. Dropped hits are counted in
+    the goal_hits_dropped_total metric.
+    """
+    visitor_bucket, goal_type_bucket = get_goal_buckets()
+    for scope, bucket, key in (('visitor', visitor_bucket, visitor),
+                               ('goal_type', goal_type_bucket,
+                                (visitor, goal_name))):
+        if bucket is not None and key and not bucket.consume(key):
+            metrics.increment('goal_hits_dropped_total', scope=scope)
+            l.debug("Dropped a hit of goal %s over the %s rate limit" %
+                    (goal_name, scope))
+            return False
+    return True
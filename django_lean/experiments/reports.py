@@ -1,16 +1,28 @@
 # -*- coding: utf-8 -*-
+from __future__ import with_statement
+
 import logging
 l = logging.getLogger(__name__)
 
+from collections import namedtuple
 from datetime import datetime, timedelta
+from itertools import imap, islice
 
 from django_lean.experiments.models import (DailyEngagementReport,
                                             DailyConversionReport,
                                             DailyConversionReportGoalData,
                                             Experiment, Participant,
                                             GoalRecord, GoalType)
+from django_lean.experiments.instrumentation import (Measurement,
+                                                     send_report_measurement)
 from django_lean.experiments.significance import chi_square_p_value
+from django_lean.utils import in_sample
+
 
+PARTICIPANT_CHUNK_SIZE = 1000
+
+ParticipantRow = namedtuple('ParticipantRow', ['id', 'anonymous_visitor_id',
+                                               'user_id', 'enrollment_date'])
 
 def calculate_participant_conversion(participant, goal_type, report_date):
     """
@@ -22,13 +34,13 @@ def calculate_participant_conversion(participant, goal_type, report_date):
         count = GoalRecord.objects.filter(
             created__gte=participant.enrollment_date,
             created__lt=(report_date + timedelta(days=1)),
-            anonymous_visitor=participant.anonymous_visitor).count()
+            anonymous_visitor=participant.anonymous_visitor_id).count()
     else:
         count = GoalRecord.objects.filter(
             goal_type=goal_type,
             created__gte=participant.enrollment_date,
             created__lt=(report_date + timedelta(days=1)),
-            anonymous_visitor=participant.anonymous_visitor).count()
+            anonymous_visitor=participant.anonymous_visitor_id).count()
     
     return count and 1 or 0
 
@@ -56,6 +68,24 @@ def find_experiment_group_participants(group, experiment, report_date):
                                       experiment=experiment,
                                       anonymous_visitor__isnull=False)
 
+def iter_participant_chunks(participants, chunk_size=PARTICIPANT_CHUNK_SIZE):
+    """
+    Streams participants as lists of at most `chunk_size` ParticipantRow
+    tuples, so that memory stays bounded regardless of the group size.
+    A QuerySet of participants is evaluated once, without loading model
+    instances; any other iterable is consumed as is.
+    """
+    if hasattr(participants, 'values_list'):
+        participants = imap(ParticipantRow._make,
+                            participants.order_by('id').values_list(
+                                *ParticipantRow._fields).iterator())
+    participants = iter(participants)
+    while True:
+        chunk = list(islice(participants, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
 def __rate(a, b):
     if not b or a == None:
         return None
@@ -146,32 +176,97 @@ def get_conversion_data(experiment, date):
     return data
 
 class BaseReportGenerator(object):
-    def __init__(self, report_model_class):
+    report_type = None
+    
+    def __init__(self, report_model_class, sample=None):
+        """
+        If `sample` is a fraction between 0 and 1, reports are computed
+        from a deterministic, hash-based sample of the participants and
+        returned as unsaved preview reports instead of being stored.
+        """
         self.report_model_class = report_model_class
+        self.sample = sample
+    
+    def report_dates(self, experiment):
+        """ Returns the first and last days that can be reported on """
+        yesterday = (datetime.today() - timedelta(days=1)).date()
+        end_date = experiment.end_date or yesterday
+        return experiment.start_date, min(end_date, yesterday)
     
     def generate_all_daily_reports(self):
         """ Generates all missing reports up until yesterday """
         experiments = Experiment.objects.filter(start_date__isnull=False)
-        yesterday = (datetime.today() - timedelta(days=1)).date()
         for experiment in experiments:
-            start_date = experiment.start_date
-            current_date = start_date
-            end_date = experiment.end_date or yesterday
-            end_date = min(end_date, yesterday)
+            current_date, end_date = self.report_dates(experiment)
             
             # get or create the report for all the days of the experiment
             while current_date <= end_date:
                 if (self.report_model_class.objects.filter(
                         experiment=experiment, date=current_date).count() == 0):
-                    daily_report = self.generate_daily_report_for_experiment(
+                    daily_report = self.generate_report(
                         experiment=experiment, report_date=current_date)
                 current_date = current_date + timedelta(days=1)
     
+    def generate_preview_reports(self):
+        """
+        Returns sampled preview reports for the last reportable day of
+        every experiment. Since reports are cumulative, the last day
+        summarizes the whole experiment so far.
+        """
+        reports = []
+        experiments = Experiment.objects.filter(start_date__isnull=False)
+        for experiment in experiments:
+            start_date, end_date = self.report_dates(experiment)
+            if start_date <= end_date:
+                reports.append(self.generate_report(
+                    experiment=experiment, report_date=end_date))
+        return reports
+    
+    def generate_report(self, experiment, report_date):
+        """
+        Generates a single report, measuring its cost.
+        """
+        measurement = Measurement()
+        with measurement.measure():
+            report = self.generate_daily_report_for_experiment(
+                experiment=experiment, report_date=report_date)
+        send_report_measurement(self.report_type, experiment, report_date,
+                                None, measurement)
+        return report
+    
+    def sample_participants(self, participants, key):
+        """
+        Returns the participants whose `key` attribute falls in the
+        sample, or all of them when not sampling.
+        """
+        if self.sample is None:
+            return participants
+        return [p for p in participants
+                if in_sample(getattr(p, key), self.sample)]
+    
+    def save_report(self, report, goal_data=()):
+        """
+        Saves the report along with its goal data, unless it is a preview,
+        in which case they are labelled and left unsaved.
+        """
+        if self.sample is not None:
+            report.sample = self.sample
+            report.preview_goal_data = list(goal_data)
+            return report
+        report.save()
+        for data in goal_data:
+            data.report = report
+            data.save()
+        return report
+    
 
 class ConversionReportGenerator(BaseReportGenerator):
+    report_type = 'conversion'
+    
     def __init__(self, goal_type_conversion_calculator=calculate_goal_type_conversion,
-                 participant_finder=find_experiment_group_participants):
-        BaseReportGenerator.__init__(self, DailyConversionReport)
+                 participant_finder=find_experiment_group_participants,
+                 sample=None):
+        BaseReportGenerator.__init__(self, DailyConversionReport, sample=sample)
         self.goal_type_conversion_calculator = goal_type_conversion_calculator
         self.participant_finder = participant_finder
     
@@ -185,24 +280,45 @@ class ConversionReportGenerator(BaseReportGenerator):
         else:
             return None
     
+    def __count_conversions(self, group, experiment, report_date, goal_types,
+                            measurements):
+        """
+        Scans the participants of a group once, chunk by chunk, and returns
+        the group size along with a dict of conversion counts per goal
+        type, where the None key counts conversions for any goal type.
+        The cost of each goal type is accumulated into `measurements`.
+        """
+        size = 0
+        conversions = dict((goal_type, 0) for goal_type in [None] + goal_types)
+        participants = self.participant_finder(group, experiment, report_date)
+        for chunk in iter_participant_chunks(participants):
+            chunk = self.sample_participants(chunk, 'anonymous_visitor_id')
+            size += len(chunk)
+            for goal_type in conversions:
+                with measurements[goal_type].measure():
+                    conversions[goal_type] += self.goal_type_conversion_calculator(
+                        goal_type, chunk, report_date)
+        return size, conversions
+    
     def generate_daily_report_for_experiment(self, experiment, report_date):
         """ Generates a single conversion report """
-        control_participants = self.participant_finder(Participant.CONTROL_GROUP,
-                                                       experiment, report_date)
-        test_participants = self.participant_finder(Participant.TEST_GROUP,
-                                                    experiment, report_date)
-        control_participant_count = control_participants.count()
-        test_participant_count = test_participants.count()
+        goal_types = list(GoalType.objects.all())
+        measurements = dict((goal_type, Measurement())
+                            for goal_type in [None] + goal_types)
+        control_participant_count, control_conversions = self.__count_conversions(
+            Participant.CONTROL_GROUP, experiment, report_date, goal_types,
+            measurements)
+        test_participant_count, test_conversions = self.__count_conversions(
+            Participant.TEST_GROUP, experiment, report_date, goal_types,
+            measurements)
         
-        total_control_conversion = self.goal_type_conversion_calculator(
-            None, control_participants, report_date)
-        total_test_conversion = self.goal_type_conversion_calculator(
-            None, test_participants, report_date)
+        total_control_conversion = control_conversions[None]
+        total_test_conversion = test_conversions[None]
         
         confidence = self.__confidence(test_participant_count, total_test_conversion,
                                        control_participant_count, total_control_conversion)
         
-        report = DailyConversionReport.objects.create(
+        report = DailyConversionReport(
             experiment=experiment,
             date=report_date,
             test_group_size=test_participant_count,
@@ -211,25 +327,27 @@ class ConversionReportGenerator(BaseReportGenerator):
             overall_control_conversion=total_control_conversion,
             confidence=confidence)
         
-        for goal_type in GoalType.objects.all():
-            control_count = self.goal_type_conversion_calculator(goal_type,
-                                                                 control_participants,
-                                                                 report_date)
-            test_count = self.goal_type_conversion_calculator(goal_type,
-                                                              test_participants,
-                                                              report_date)
+        goal_data = []
+        for goal_type in goal_types:
+            control_count = control_conversions[goal_type]
+            test_count = test_conversions[goal_type]
             confidence = self.__confidence(test_participant_count, test_count,
                                            control_participant_count, control_count)
-            DailyConversionReportGoalData.objects.create(
-                report=report, goal_type=goal_type,
+            goal_data.append(DailyConversionReportGoalData(
+                goal_type=goal_type,
                 test_conversion=test_count,
                 control_conversion=control_count,
-                confidence=confidence)
+                confidence=confidence))
+            send_report_measurement(self.report_type, experiment, report_date,
+                                    goal_type, measurements[goal_type])
+        return self.save_report(report, goal_data)
     
 
 class EngagementReportGenerator(BaseReportGenerator):
-    def __init__(self, engagement_score_calculator):
-        BaseReportGenerator.__init__(self, DailyEngagementReport)
+    report_type = 'engagement'
+    
+    def __init__(self, engagement_score_calculator, sample=None):
+        BaseReportGenerator.__init__(self, DailyEngagementReport, sample=sample)
         self.engagement_score_calculator = engagement_score_calculator
     
     def __generate_scores(self, experiment, group, report_date):
@@ -241,12 +359,17 @@ class EngagementReportGenerator(BaseReportGenerator):
                             experiment=experiment,
                             group=group,
                             enrollment_date__lte=report_date).exclude(user=None)
+        user_model = Participant._meta.get_field('user').rel.to
         scores = []
-        for participant in participants:
-            scores.append(self.engagement_score_calculator.
-                          calculate_user_engagement_score(participant.user,
-                                                          participant.enrollment_date,
-                                                          report_date))
+        for chunk in iter_participant_chunks(participants):
+            chunk = self.sample_participants(chunk, 'user_id')
+            users = user_model.objects.in_bulk([p.user_id for p in chunk])
+            for participant in chunk:
+                scores.append(self.engagement_score_calculator.
+                              calculate_user_engagement_score(
+                                  users[participant.user_id],
+                                  participant.enrollment_date,
+                                  report_date))
         return scores
     
     def generate_daily_report_for_experiment(self, experiment, report_date):
@@ -276,12 +399,12 @@ class EngagementReportGenerator(BaseReportGenerator):
             else:
                 confidence = (1 - p_value) * 100
         
-        DailyEngagementReport.objects.create(
+        return self.save_report(DailyEngagementReport(
             experiment=experiment,
             date=report_date,
             test_score=test_group_mean,
             control_score=control_group_mean,
             test_group_size=len(test_group_scores),
             control_group_size=len(control_group_scores),
-            confidence=confidence)
+            confidence=confidence))
     
@@ -5,3 +5,7 @@ goal_recorded = Signal(providing_args=['goal_record', 'experiment_user'])
 
 user_enrolled = Signal(providing_args=['experiment', 'experiment_user',
                                        'group_id'])
+
+report_measured = Signal(providing_args=['report_type', 'experiment',
+                                         'report_date', 'goal_type',
+                                         'duration', 'queries'])
@@ -4,14 +4,24 @@ from __future__ import absolute_import
 import logging
 l = logging.getLogger(__name__)
 
+from hashlib import md5
+
 from django import template
+from django.core.cache import cache
+from django.utils.http import urlquote
 
-from django_lean.experiments.models import Experiment
+from django_lean import metrics
+from django_lean.experiments.models import Experiment, Participant
 from django_lean.experiments.utils import WebUserFactory
 
 
 register = template.Library()
 
+GROUPS = {
+    'control': Participant.CONTROL_GROUP,
+    'test': Participant.TEST_GROUP,
+}
+
 class BaseExperimentNode(template.Node):
     def __init__(self, user_factory=WebUserFactory()):
         self.__user_factory = user_factory
@@ -27,6 +37,17 @@ class BaseExperimentNode(template.Node):
             request.experiment_user = self.create_user(context)
         return request.experiment_user
 
+    def get_group(self, context, experiment_name):
+        """
+        Returns the group of the user in the experiment, reusing the groups
+        resolved by ExperimentBucketMiddleware.
+        """
+        request = context.get('request', None)
+        groups = getattr(request, 'experiment_groups', None) or {}
+        if experiment_name in groups:
+            return groups[experiment_name]
+        return Experiment.group(experiment_name, self.get_user(context))
+
 
 class ExperimentNode(BaseExperimentNode):
     def __init__(self, node_list, experiment_name, group_name, user_factory):
@@ -36,23 +57,35 @@ class ExperimentNode(BaseExperimentNode):
         self.group_name = group_name
 
     def render(self, context):
-        user = self.get_user(context)
-        should_render = False
-        
-        if self.group_name == "test":
-            should_render = Experiment.test(self.experiment_name, user)
-        elif self.group_name == "control":
-            should_render = Experiment.control(self.experiment_name, user)
-        else:
+        if self.group_name not in GROUPS:
             raise Exception("Unknown Experiment group name : %s" %
                             self.group_name)
         
-        if should_render:
+        group = self.get_group(context, self.experiment_name)
+        if group == GROUPS[self.group_name]:
             return self.node_list.render(context)
         else:
             return ""
     
 
+class ExperimentBranchesNode(BaseExperimentNode):
+    def __init__(self, branches, experiment_name, user_factory):
+        """
+        `branches` is a list of (groups, node_list) pairs, where `groups`
+        is None for the {% else %} branch.
+        """
+        BaseExperimentNode.__init__(self, user_factory)
+        self.branches = branches
+        self.experiment_name = experiment_name
+
+    def render(self, context):
+        group = self.get_group(context, self.experiment_name)
+        for groups, node_list in self.branches:
+            if groups is None or group in groups:
+                return node_list.render(context)
+        return ""
+
+
 @register.tag('experiment')
 def experiment(parser, token, user_factory=WebUserFactory()):
     """
@@ -64,9 +97,33 @@ def experiment(parser, token, user_factory=WebUserFactory()):
     
     If the group name is neither 'test' nor 'control' an exception is raised
     during rendering.
+    
+    To render one of several contents with a single enrollment check, leave
+    out the group name. The first content is for the test group, and the
+    one after {% else %} for the control group :
+    
+    {% experiment <experiment_name> %}
+    test content
+    {% else %}
+    control content
+    {% endexperiment %}
+    
+    Or name the groups of each content, with an optional {% else %}
+    fallback :
+    
+    {% experiment <experiment_name> %}
+    {% group test %}
+    test content
+    {% group control %}
+    control content
+    {% endexperiment %}
     """
+    bits = token.split_contents()
+    if len(bits) == 2:
+        return ExperimentBranchesNode(parse_experiment_branches(parser),
+                                      bits[1], user_factory)
     try:
-        tag_name, experiment_name, group_name = token.split_contents()
+        tag_name, experiment_name, group_name = bits
         node_list = parser.parse(('endexperiment', ))
         parser.delete_first_token()
     except ValueError:
@@ -75,6 +132,44 @@ def experiment(parser, token, user_factory=WebUserFactory()):
     
     return ExperimentNode(node_list, experiment_name, group_name, user_factory)
 
+def parse_experiment_branches(parser):
+    """
+    Parses the contents of a two-argument {% experiment %} tag into a
+    list of (groups, node_list) branches.
+    """
+    branches = []
+    node_list = parser.parse(('group', 'else', 'endexperiment'))
+    token = parser.next_token()
+    if token.contents.split()[0] == 'group':
+        # Only whitespace may come before the first {% group %}
+        for node in node_list:
+            if not isinstance(node, template.TextNode) or node.s.strip():
+                raise template.TemplateSyntaxError(
+                    "Content of {% experiment %} must be in a {% group %}")
+    else:
+        branches.append(((Participant.TEST_GROUP,), node_list))
+    while token.contents != 'endexperiment':
+        bits = token.split_contents()
+        if bits[0] == 'else':
+            if len(bits) != 1:
+                raise template.TemplateSyntaxError("Syntax should be like :"
+                        "{% else %}")
+            node_list = parser.parse(('endexperiment', ))
+            branches.append((None, node_list))
+        else:
+            if len(bits) < 2:
+                raise template.TemplateSyntaxError("Syntax should be like :"
+                        "{% group group_name [group_name ...] %}")
+            try:
+                groups = tuple(GROUPS[name] for name in bits[1:])
+            except KeyError, e:
+                raise template.TemplateSyntaxError(
+                    "Unknown Experiment group name : %s" % e.args[0])
+            node_list = parser.parse(('group', 'else', 'endexperiment'))
+            branches.append((groups, node_list))
+        token = parser.next_token()
+    return branches
+
 class ClientSideExperimentNode(BaseExperimentNode):
     CONTEXT_KEY = "client_side_experiments"
     
@@ -92,16 +187,11 @@ class ClientSideExperimentNode(BaseExperimentNode):
             context[self.CONTEXT_KEY]= {}
         
         if self.experiment_name not in context[self.CONTEXT_KEY]:
-            user = self.create_user(context)
-            group = None
-            
-            if Experiment.test(self.experiment_name, user):
+            group = self.get_group(context, self.experiment_name)
+            if group == Participant.TEST_GROUP:
                 group = "test"
-            elif Experiment.control(self.experiment_name, user):
-                group = "control"
             else:
-                raise Exception("Unexpected test group for experiment %s" %
-                                self.experiment_name)
+                group = "control"
             
             context[self.CONTEXT_KEY][self.experiment_name] = group
         return ""
@@ -125,6 +215,10 @@ def clientsideexperiment(parser, token, user_factory=WebUserFactory()):
     The template tag populates the context with a dict at
     'client_side_experiments' with entries for each experiment name that map to
     either 'test' or 'control'.
+    
+    This makes the page specific to the user. Pages served from a shared
+    cache should fetch the groups instead, with
+    experiments.load(["<experiment_name>"], callback).
     """
     try:
         tag_name, experiment_name = token.split_contents()
@@ -133,3 +227,68 @@ def clientsideexperiment(parser, token, user_factory=WebUserFactory()):
                 "{% clientsideexperiment experiment_name  %}")
     
     return ClientSideExperimentNode(experiment_name, user_factory)
+
+
+class ExperimentCacheNode(BaseExperimentNode):
+    def __init__(self, node_list, expire_time, experiment_name, fragment_name,
+                 vary_on, user_factory):
+        BaseExperimentNode.__init__(self, user_factory)
+        self.node_list = node_list
+        self.expire_time_var = template.Variable(expire_time)
+        self.experiment_name = experiment_name
+        self.fragment_name = fragment_name
+        self.vary_on = [template.Variable(v) for v in vary_on]
+
+    def cache_key(self, group, context):
+        args = [self.experiment_name, str(group), self.fragment_name]
+        args.extend(var.resolve(context) for var in self.vary_on)
+        digest = md5(u':'.join(urlquote(arg) for arg in args)).hexdigest()
+        return 'experiments.cache.%s' % digest
+
+    def render(self, context):
+        try:
+            expire_time = int(self.expire_time_var.resolve(context))
+        except template.VariableDoesNotExist:
+            raise template.TemplateSyntaxError(
+                '"experimentcache" tag got an unknown variable: %r' %
+                self.expire_time_var.var)
+        except (ValueError, TypeError):
+            raise template.TemplateSyntaxError(
+                '"experimentcache" tag got a non-integer timeout value')
+        group = self.get_group(context, self.experiment_name)
+        cache_key = self.cache_key(group, context)
+        value = cache.get(cache_key)
+        labels = {'experiment': self.experiment_name,
+                  'fragment': self.fragment_name}
+        if value is None:
+            metrics.increment('fragment_cache_misses_total', **labels)
+            value = self.node_list.render(context)
+            cache.set(cache_key, value, expire_time)
+        else:
+            metrics.increment('fragment_cache_hits_total', **labels)
+        return value
+
+
+@register.tag('experimentcache')
+def experimentcache(parser, token, user_factory=WebUserFactory()):
+    """
+    Caches a template fragment that depends on the group of the user in an
+    experiment, like {% cache %} does for other fragments :
+    
+    {% experimentcache <expire_time> <experiment_name> <fragment_name> [var1] [var2] .. %}
+    {% experiment <experiment_name> %}test content{% else %}control content{% endexperiment %}
+    {% endexperimentcache %}
+    
+    Each group of the experiment gets its own entry for each set of
+    arguments, shared by all the users in that group. The fragment must
+    not depend on anything else, such as the groups of other experiments.
+    """
+    node_list = parser.parse(('endexperimentcache',))
+    parser.delete_first_token()
+    bits = token.split_contents()
+    if len(bits) < 4:
+        raise template.TemplateSyntaxError("Syntax should be like :"
+                "{% experimentcache expire_time experiment_name "
+                "fragment_name [var ...] %}")
+    return ExperimentCacheNode(node_list, bits[1], bits[2], bits[3], bits[4:],
+                               user_factory)
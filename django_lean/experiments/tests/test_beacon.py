@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+
+from django_lean import metrics
+from django_lean.experiments.beacon import BeaconMiddleware, GoalWriter
+from django_lean.experiments.models import (AnonymousVisitor, Experiment,
+                                            GoalRecord, GoalType)
+from django_lean.experiments.tests.utils import TestCase, patch
+from django_lean.experiments.views import TRANSPARENT_1X1_PNG
+
+
+class TestBeaconMiddleware(TestCase):
+    urls = 'django_lean.experiments.tests.urls'
+
+    def setUp(self):
+        self.experiment = Experiment(name="test-experiment")
+        self.experiment.save()
+        self.experiment.state = Experiment.ENABLED_STATE
+        self.experiment.save()
+        self.goal_type = GoalType.objects.create(name='test-goal')
+        self.calls = []
+        self.writer = GoalWriter(max_size=3, batch_size=2)
+        self.middleware = BeaconMiddleware(self.application,
+                                           prefix='/main-app/',
+                                           writer=self.writer)
+
+    def application(self, environ, start_response):
+        self.calls.append(environ['PATH_INFO'])
+        start_response('200 OK', [])
+        return ['django']
+
+    def call(self, path, client=None, **environ):
+        environ['PATH_INFO'] = path
+        if client is not None:
+            environ['HTTP_COOKIE'] = client.cookies.output(header='',
+                                                           sep='; ')
+        responses = []
+        def start_response(status, headers):
+            responses.append((status, dict(headers)))
+        body = ''.join(self.middleware(environ, start_response))
+        return responses[0][0], responses[0][1], body
+
+    def enrolled_client(self):
+        client = Client()
+        client.get(reverse("django_lean.experiments.views.confirm_human"))
+        client.get(reverse("django_lean.experiments.tests.views.experiment_test",
+                           args=[self.experiment.name]))
+        return client
+
+    def testGoal(self):
+        client = self.enrolled_client()
+        with self.assertNumQueries(1):
+            status, headers, body = self.call('/main-app/goal/test-goal',
+                                              client)
+        self.assertEquals('200 OK', status)
+        self.assertEquals('image/png', headers['Content-Type'])
+        self.assertEquals('max-age=0', headers['Cache-Control'])
+        self.assertEquals(TRANSPARENT_1X1_PNG, body)
+        self.assertEquals([], self.calls)
+        self.assertEquals(0, GoalRecord.objects.count())
+
+        self.call('/main-app/goal/test-goal', client)
+        self.call('/main-app/goal/unknown-goal', client)
+        self.assertEquals(2, self.writer.flush())
+        self.assertEquals(0, self.writer.flush())
+        records = GoalRecord.objects.filter(goal_type=self.goal_type)
+        self.assertEquals(2, records.count())
+        visitor = AnonymousVisitor.objects.get()
+        self.assertEquals([visitor, visitor],
+                          [r.anonymous_visitor for r in records])
+
+    def testGoalOfUnknownVisitor(self):
+        # Without session or anonymous visitor, nothing is recorded
+        for client in (None, Client()):
+            status, headers, body = self.call('/main-app/goal/test-goal',
+                                              client)
+            self.assertEquals(TRANSPARENT_1X1_PNG, body)
+        self.assertEquals(0, self.writer.flush())
+
+    def testGoalOfUnknownSession(self):
+        # Unknown session keys create no session, and are limited by address
+        metrics.reset()
+        sessions = Session.objects.count()
+        with patch(settings, 'LEAN_GOAL_RATE_LIMITS', {'visitor': (1, 60)}):
+            for key in ('unknown1', 'unknown2'):
+                status, headers, body = self.call(
+                    '/main-app/goal/test-goal',
+                    HTTP_COOKIE='%s=%s' % (settings.SESSION_COOKIE_NAME, key),
+                    REMOTE_ADDR='10.0.0.1')
+                self.assertEquals(TRANSPARENT_1X1_PNG, body)
+        self.assertEquals(sessions, Session.objects.count())
+        self.assertEquals(0, self.writer.flush())
+        self.assertEquals(1, metrics.registry.counter(
+            'goal_hits_dropped_total', scope='visitor').value)
+
+    def testQueueOverflow(self):
+        client = self.enrolled_client()
+        for i in range(5):
+            self.call('/main-app/goal/test-goal', client)
+        self.assertEquals(3, self.writer.flush())
+
+    def testConfirmHuman(self):
+        client = Client()
+        self.call('/main-app/confirm_human/', client)
+        self.assertEquals(['/main-app/confirm_human/'], self.calls)
+        client.get(reverse("django_lean.experiments.views.confirm_human"))
+        with self.assertNumQueries(1):
+            status, headers, body = self.call('/main-app/confirm_human/',
+                                              client)
+        self.assertEquals('204 No Content', status)
+        self.assertEquals(1, len(self.calls))
+
+    def testOtherPaths(self):
+        status, headers, body = self.call('/main-app/metrics/')
+        self.assertEquals('django', body)
+        self.call('/goal/test-goal')
+        self.assertEquals(['/main-app/metrics/', '/goal/test-goal'],
+                          self.calls)
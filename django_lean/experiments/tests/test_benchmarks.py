@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from django.contrib.auth.models import User
+
+from django_lean.experiments.benchmarks.data import BenchmarkData
+from django_lean.experiments.benchmarks.reports import (
+    ConstantEngagementCalculator, benchmark_reports)
+from django_lean.experiments.benchmarks.request_path import RequestBenchmark
+from django_lean.experiments.models import (AnonymousVisitor, Experiment,
+                                            DailyConversionReport,
+                                            GoalRecord, Participant)
+from django_lean.experiments.reports import (EngagementReportGenerator,
+                                             ConversionReportGenerator)
+from django_lean.experiments.tests.utils import TestCase
+
+
+class TestBenchmarkData(TestCase):
+    def testCreate(self):
+        data = BenchmarkData(200, goal_types=3, days=4, registered=0.25)
+        experiment = data.create()
+        participants = Participant.objects.filter(experiment=experiment)
+        self.assertEquals(200, participants.count())
+        self.assertEquals(50, participants.filter(user__isnull=False).count())
+        self.assertEquals(150, participants.filter(
+                anonymous_visitor__isnull=False).count())
+        self.assertEquals(0, participants.exclude(
+                enrollment_date__range=(data.start_date, data.end_date)).count())
+        self.assertTrue(GoalRecord.objects.count() > 0)
+        self.assertEquals(4, len(list(data.report_dates())))
+
+    def testDeterministic(self):
+        def summary(seed):
+            data = BenchmarkData(100, seed=seed)
+            experiment = data.create()
+            groups = list(Participant.objects.filter(
+                    experiment=experiment).order_by('id').values_list(
+                    'group', 'enrollment_date'))
+            goals = GoalRecord.objects.count()
+            data.delete()
+            return groups, goals
+        self.assertEquals(summary(1), summary(1))
+        self.assertNotEquals(summary(1), summary(2))
+
+    def testDelete(self):
+        data = BenchmarkData(100, registered=0.5)
+        data.create()
+        data.delete()
+        self.assertEquals(0, Experiment.objects.count())
+        self.assertEquals(0, Participant.objects.count())
+        self.assertEquals(0, AnonymousVisitor.objects.count())
+        self.assertEquals(0, GoalRecord.objects.count())
+        self.assertEquals(0, User.objects.count())
+
+
+class TestBenchmarkReports(TestCase):
+    def testBenchmarkReports(self):
+        data = BenchmarkData(100, goal_types=2, days=3)
+        data.create()
+        results = benchmark_reports(data, [
+                ConversionReportGenerator(),
+                EngagementReportGenerator(
+                    engagement_score_calculator=ConstantEngagementCalculator()),
+                ])
+        self.assertEquals(8, len(results))
+        self.assertEquals(['conversion'] * 4 + ['engagement'] * 4,
+                          [result.report_type for result in results])
+        self.assertEquals('range', results[3].scope)
+        self.assertEquals(sum(result.queries for result in results[:3]),
+                          results[3].queries)
+        for result in results:
+            self.assertTrue(result.queries > 0)
+            self.assertTrue(result.peak_memory > 0)
+        self.assertEquals(3, DailyConversionReport.objects.filter(
+                experiment=data.experiment).count())
+        data.delete()
+
+
+class TestRequestBenchmark(TestCase):
+    def testRun(self):
+        results = RequestBenchmark(iterations=3, block_counts=(1, 2)).run()
+        # 2 tags x 2 block counts + the goal and confirm_human views,
+        # for each user type
+        self.assertEquals(18, len(results))
+        self.assertEquals(
+            ['unverified', 'anonymous', 'registered'] * 6,
+            [result.user_type for result in results])
+        self.assertEquals('experiment x2', results[3].scenario)
+        for result in results:
+            self.assertEquals(3, len(result.durations))
+            self.assertTrue(result.percentile(50) <= result.percentile(99))
+        # Verified visitors were enrolled by the rendered pages
+        self.assertTrue(Participant.objects.filter(
+                experiment__name='benchmark-request-1').count() > 0)
+        self.assertTrue(min(results[1].queries) > 0)
+        self.assertTrue(GoalRecord.objects.count() > 0)
@@ -1,21 +1,27 @@
 # -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.test.client import Client
+from django.utils import simplejson
 
 from django_lean.experiments.models import (AnonymousVisitor, Experiment,
-                                            GoalRecord, GoalType)
-from django_lean.experiments.tests.utils import TestCase
-from django_lean.experiments.views import TRANSPARENT_1X1_PNG
+                                            GoalRecord, GoalType, Participant)
+from django_lean.experiments.tests.utils import TestCase, get_session
+from django_lean.experiments.views import (HUMAN_COOKIE_NAME, MAX_ASSIGNMENTS,
+                                           TRANSPARENT_1X1_PNG, human_marker)
 
 
 class BugViewTest(TestCase):
     urls = 'django_lean.experiments.tests.urls'
     
-    def call_goal(self, client, goal):
+    def call_goal(self, client, goal, user_type):
         url = reverse('django_lean.experiments.views.record_experiment_goal',
                       args=[goal])
-        response = client.get(url)
+        with self.assertQueryBudget('record_experiment_goal view', user_type):
+            response = client.get(url)
         self.assertEquals(response.status_code, 200)
         self.assertEquals(response['Content-Type'], 'image/png')
         self.assertEquals(response['Cache-Control'], 'max-age=0')
@@ -37,18 +43,19 @@ class BugViewTest(TestCase):
         client = Client()
         
         # we can call with invalid or inexisting names, the response is the same
-        self.call_goal(client, '')
-        self.call_goal(client, 'unknown-goal')
+        self.call_goal(client, '', 'unverified')
+        self.call_goal(client, 'unknown-goal', 'unverified')
         
         # this is an anonymous visitor not enrolled in an experiment,
         # so no records should be created
-        self.call_goal(client, goal_type.name)
+        self.call_goal(client, goal_type.name, 'unverified')
         
         self.assertEquals(0, GoalRecord.objects.filter(goal_type=goal_type).count())
         
         nb_anonymous_visitors = AnonymousVisitor.objects.count()
         # force the user to be a verified human
-        response = client.get(confirm_human_url)
+        with self.assertQueryBudget('confirm_human view', 'unverified'):
+            response = client.get(confirm_human_url)
         self.assertEquals(response.status_code, 204)
         
         # force the anonymous visitor to be enrolled in an experiment
@@ -61,11 +68,11 @@ class BugViewTest(TestCase):
                           AnonymousVisitor.objects.count())
         
         # now call an existing goal again - it should be recorded
-        self.call_goal(client, goal_type.name)
+        self.call_goal(client, goal_type.name, 'anonymous')
         self.assertEquals(1, GoalRecord.objects.filter(goal_type=goal_type).count())
         
         # should be recorded again
-        self.call_goal(client, goal_type.name)
+        self.call_goal(client, goal_type.name, 'anonymous')
         self.assertEquals(2, GoalRecord.objects.filter(goal_type=goal_type).count())
         
         # validate that both of the records have the same anonymous_visitor
@@ -85,7 +92,121 @@ class BugViewTest(TestCase):
         # force the registered user to be enrolled in an experiment
         client.get('/test-experiment/%s' % experiment.name)
         
-        self.call_goal(client, goal_type.name)
+        self.call_goal(client, goal_type.name, 'registered')
         # since the user was registered, no new records should be created
         self.assertEquals(2, GoalRecord.objects.filter(goal_type=goal_type).count())
     
+
+
+class AssignmentsViewTest(TestCase):
+    urls = 'django_lean.experiments.tests.urls'
+
+    def setUp(self):
+        for name in ("first-experiment", "second-experiment"):
+            experiment = Experiment(name=name)
+            experiment.save()
+            experiment.state = Experiment.ENABLED_STATE
+            experiment.save()
+        self.url = reverse(
+            'django_lean.experiments.views.experiment_assignments')
+
+    def get_assignments(self, client, **params):
+        response = client.get(self.url, params)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Type'], 'application/json')
+        self.assertTrue('private' in response['Cache-Control'])
+        self.assertTrue('max-age=60' in response['Cache-Control'])
+        self.assertEquals(response['Vary'], 'Cookie')
+        return simplejson.loads(response.content)
+
+    def testAssignments(self):
+        client = Client()
+        client.get(reverse("django_lean.experiments.views.confirm_human"))
+        assignments = self.get_assignments(
+            client, experiments="first-experiment,second-experiment,unknown")
+        self.assertEquals(set(["first-experiment", "second-experiment"]),
+                          set(assignments.keys()))
+        for group in assignments.values():
+            self.assertTrue(group in ("test", "control"))
+        # The visitor was enrolled, and keeps the same groups
+        self.assertEquals(2, Participant.objects.count())
+        self.assertEquals(assignments, self.get_assignments(
+                client, experiments="second-experiment,first-experiment"))
+        self.assertEquals(2, Participant.objects.count())
+        # Experiments can also be named by repeated parameters
+        response = client.get(self.url + "?experiments=first-experiment"
+                                         "&experiments=second-experiment")
+        self.assertEquals(assignments, simplejson.loads(response.content))
+
+    def testPromotedExperiment(self):
+        experiment = Experiment.objects.get(name="first-experiment")
+        experiment.state = Experiment.PROMOTED_STATE
+        experiment.save()
+        self.assertEquals({"first-experiment": "test"},
+                          self.get_assignments(Client(),
+                                               experiments="first-experiment"))
+
+    def testNoExperiments(self):
+        self.assertEquals({}, self.get_assignments(Client()))
+
+    def testTooManyExperiments(self):
+        names = ",".join("experiment-%d" % i
+                         for i in range(MAX_ASSIGNMENTS + 1))
+        response = Client().get(self.url, {'experiments': names})
+        self.assertEquals(response.status_code, 400)
+
+
+class ConfirmHumanViewTest(TestCase):
+    urls = 'django_lean.experiments.tests.urls'
+
+    def setUp(self):
+        self.url = reverse("django_lean.experiments.views.confirm_human")
+
+    def testMarkerCookie(self):
+        client = Client()
+        response = client.get(self.url)
+        self.assertEquals(response.status_code, 204)
+        session_key = client.cookies[settings.SESSION_COOKIE_NAME].value
+        self.assertEquals(human_marker(session_key),
+                          client.cookies[HUMAN_COOKIE_NAME].value)
+        self.assertTrue(get_session(session_key)['verified_human'])
+
+        # Confirmed visitors are answered without saving their session
+        with self.assertQueryBudget('confirm_human view confirmed',
+                                    'anonymous'):
+            response = client.get(self.url)
+        self.assertEquals(response.status_code, 204)
+        self.assertFalse(response.has_header('Vary'))
+        self.assertFalse(response.cookies)
+
+    def testStaleMarker(self):
+        client = Client()
+        client.get(self.url)
+        marker = client.cookies[HUMAN_COOKIE_NAME].value
+        # The session is gone, e.g. after a logout
+        client.cookies.pop(settings.SESSION_COOKIE_NAME)
+        response = client.get(self.url)
+        self.assertEquals(response.status_code, 204)
+        session_key = client.cookies[settings.SESSION_COOKIE_NAME].value
+        self.assertTrue(get_session(session_key)['verified_human'])
+        self.assertNotEquals(marker, client.cookies[HUMAN_COOKIE_NAME].value)
+
+    def testUnconfirmedSession(self):
+        client = Client()
+        client.get(self.url)
+        session_key = client.cookies[settings.SESSION_COOKIE_NAME].value
+        # The marker is valid, but the session was not confirmed
+        session = get_session(session_key)
+        del session['verified_human']
+        session.save()
+        client.get(self.url)
+        self.assertTrue(get_session(session_key)['verified_human'])
+
+    def testPendingMarker(self):
+        client = Client()
+        client.cookies[HUMAN_COOKIE_NAME] = 'pending'
+        client.get(self.url)
+        session_key = client.cookies[settings.SESSION_COOKIE_NAME].value
+        self.assertTrue(get_session(session_key)['verified_human'])
+        self.assertEquals(human_marker(session_key),
+                          client.cookies[HUMAN_COOKIE_NAME].value)
@@ -16,8 +16,11 @@ from django_lean.experiments.reports import (EngagementReportGenerator,
                                              calculate_participant_conversion,
                                              get_conversion_data,
                                              calculate_goal_type_conversion,
-                                             find_experiment_group_participants)
+                                             find_experiment_group_participants,
+                                             iter_participant_chunks,
+                                             ParticipantRow)
 from django_lean.experiments.tests.utils import create_user_in_group, TestCase
+from django_lean.utils import in_sample
 
 
 class TestDailyReports(TestCase):
@@ -250,6 +253,29 @@ class TestDailyReports(TestCase):
         
         mocker.VerifyAll()
     
+    def testIterParticipantChunks(self):
+        anonymous_visitors = [AnonymousVisitor.objects.create() for i in range(5)]
+        participants = [self.create_participant(
+                            anonymous_visitor=anonymous_visitor,
+                            experiment=self.experiment,
+                            enrollment_date=self.experiment.start_date,
+                            group=Participant.CONTROL_GROUP)
+                        for anonymous_visitor in anonymous_visitors]
+        queryset = find_experiment_group_participants(
+            Participant.CONTROL_GROUP, self.experiment, date.today())
+        
+        chunks = list(iter_participant_chunks(queryset, chunk_size=2))
+        self.assertEquals([2, 2, 1], [len(chunk) for chunk in chunks])
+        self.assertEquals(
+            [ParticipantRow(p.id, p.anonymous_visitor_id, None,
+                            self.experiment.start_date)
+             for p in participants],
+            [row for chunk in chunks for row in chunk])
+        
+        self.assertEquals([[1, 2], [3]],
+                          list(iter_participant_chunks([1, 2, 3], chunk_size=2)))
+        self.assertEquals([], list(iter_participant_chunks([])))
+    
     def testExperimentGroupParticipantFinder(self):
         days = [datetime.combine(date.today() + timedelta(days=i), time(hour=12))
                 for i in range(-7, 0)]
@@ -506,9 +532,13 @@ class TestDailyReports(TestCase):
                 data = day_4_data
             
             for group in (Participant.TEST_GROUP, Participant.CONTROL_GROUP):
-                mock_participants = mocker.CreateMockAnything()
+                mock_participants = [
+                    ParticipantRow(i, i, None, day.date())
+                    for i in range(data[group]["count"])]
                 finder(group, experiment, day.date()).InAnyOrder().AndReturn(mock_participants)
-                mock_participants.count().MultipleTimes().AndReturn(data[group]["count"])
+                if not mock_participants:
+                    # empty groups are never passed to the calculator
+                    continue
                 for goal_type in goal_types:
                     calculator(goal_type, mock_participants, day.date()).InAnyOrder().AndReturn(data[group]["conversions"][int(goal_type.name)])
                 calculator(None, mock_participants, day.date()).InAnyOrder().AndReturn(sum(data[group]["conversions"]))
@@ -559,3 +589,49 @@ class TestDailyReports(TestCase):
             goal_type=goal_types[0])[0].confidence
         self.assertAlmostEqual(98.935467172597029, day_5_goal_0_confidence, places=6)
     
+    
+    def testSampledPreviewReport(self):
+        goal_type = GoalType.objects.create(name="goal")
+        report_date = date.today() - timedelta(days=1)
+        anonymous_visitors = [AnonymousVisitor.objects.create()
+                              for i in range(40)]
+        for i, anonymous_visitor in enumerate(anonymous_visitors):
+            self.create_participant(anonymous_visitor=anonymous_visitor,
+                                    experiment=self.experiment,
+                                    enrollment_date=self.experiment.start_date,
+                                    group=i % 2)
+            self.create_goal_record(datetime.combine(report_date, time(hour=12)),
+                                    anonymous_visitor, goal_type)
+        
+        sampled = [v for v in anonymous_visitors if in_sample(v.id, 0.5)]
+        self.assertTrue(0 < len(sampled) < len(anonymous_visitors))
+        
+        generator = ConversionReportGenerator(sample=0.5)
+        report = generator.generate_daily_report_for_experiment(
+            self.experiment, report_date)
+        
+        # previews are labelled and never stored
+        self.assertEquals(0.5, report.sample)
+        self.assertEquals(None, report.pk)
+        self.assertEquals(0, DailyConversionReport.objects.count())
+        self.assertEquals(0, DailyConversionReportGoalData.objects.count())
+        
+        participants = Participant.objects.filter(experiment=self.experiment)
+        self.assertEquals(len([p for p in participants
+                               if in_sample(p.anonymous_visitor_id, 0.5)]),
+                          report.test_group_size + report.control_group_size)
+        self.assertEquals(len(sampled), report.overall_test_conversion +
+                          report.overall_control_conversion)
+        self.assertEquals([goal_type],
+                          [d.goal_type for d in report.preview_goal_data])
+        
+        # sampling is deterministic
+        again = generator.generate_daily_report_for_experiment(
+            self.experiment, report_date)
+        self.assertEquals(report.test_group_size, again.test_group_size)
+        self.assertEquals(report.control_group_size, again.control_group_size)
+        
+        previews = generator.generate_preview_reports()
+        self.assertEquals(set([self.experiment, self.other_experiment]),
+                          set(r.experiment for r in previews))
+        self.assertEquals(0, DailyConversionReport.objects.count())
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+from django.conf import settings
+from django.dispatch import Signal
+from django.http import HttpRequest, HttpResponse
+
+from django_lean import metrics
+from django_lean.deferred import (connect_deferred, deferred,
+                                  DeferredReceiversMiddleware)
+from django_lean.experiments.tests.utils import patch, TestCase
+
+
+class TestDeferredReceivers(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.signal = Signal(providing_args=['value'])
+        self.calls = []
+        self.middleware = DeferredReceiversMiddleware()
+
+    def tearDown(self):
+        metrics.reset()
+
+    def receiver(self, sender, value, **kwargs):
+        self.calls.append(value)
+
+    def failing_receiver(self, sender, value, **kwargs):
+        raise ValueError(value)
+
+    def serve(self, *values):
+        """Sends the signal with `values` while serving a request."""
+        request = HttpRequest()
+        self.middleware.process_request(request)
+        for value in values:
+            self.signal.send(sender=None, value=value)
+        response = HttpResponse()
+        response.close = lambda: self.calls.append('closed')
+        return self.middleware.process_response(request, response)
+
+    def testDeferred(self):
+        connect_deferred(self.signal, self.receiver)
+        response = self.serve(1, 2)
+        self.assertEqual([], self.calls)
+        # The receivers run after the response is closed
+        response.close()
+        self.assertEqual(['closed', 1, 2], self.calls)
+        # Outside of requests, receivers run immediately
+        self.signal.send(sender=None, value=3)
+        self.assertEqual(['closed', 1, 2, 3], self.calls)
+
+    def testReceiverIdentity(self):
+        # Receivers with the same name are told apart
+        other = TestDeferredReceivers('testDeferred')
+        other.calls = self.calls
+        uids = [connect_deferred(self.signal, self.receiver),
+                connect_deferred(self.signal, self.receiver),
+                connect_deferred(self.signal, other.receiver),
+                connect_deferred(self.signal, self.receiver, sender=self)]
+        self.assertEqual(3, len(set(uids)))
+        self.signal.send(sender=None, value=1)
+        self.assertEqual([1, 1], self.calls)
+        self.signal.disconnect(dispatch_uid=uids[2])
+        self.signal.send(sender=self, value=2)
+        self.assertEqual([1, 1, 2, 2], self.calls)
+
+    def testErrors(self):
+        self.signal.connect(deferred(self.failing_receiver), weak=False)
+        connect_deferred(self.signal, self.receiver)
+        self.serve(1, 2).close()
+        self.assertEqual(['closed', 1, 2], self.calls)
+        self.assertEqual(2, metrics.registry.counter(
+                'deferred_receiver_errors_total').value)
+
+    def testQueueSize(self):
+        connect_deferred(self.signal, self.receiver)
+        with patch(settings, 'LEAN_DEFERRED_QUEUE_SIZE', 2):
+            response = self.serve(1, 2, 3)
+        self.assertEqual([3], self.calls)
+        response.close()
+        self.assertEqual([3, 'closed', 1, 2], self.calls)
+        self.assertEqual(1, metrics.registry.counter(
+                'deferred_calls_overflow_total').value)
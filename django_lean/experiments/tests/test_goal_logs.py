@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import gzip
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+
+from django_lean.experiments import goal_logs, utils
+from django_lean.experiments.goal_logs import GoalLogIngester
+from django_lean.experiments.management.commands import ingest_goal_logs
+from django_lean.experiments.models import (AnonymousVisitor, Experiment,
+                                            GoalLogOffset, GoalRecord,
+                                            GoalType)
+from django_lean.experiments.tests.utils import patch, TestCase
+
+
+LINE = ('10.0.0.1 - - [%(time)s +0200] "GET %(path)s HTTP/1.1" %(status)s 95 '
+        '"http://example.com/" "Mozilla/5.0" "%(session)s"\n')
+
+
+class TestGoalLogIngester(TestCase):
+    urls = 'django_lean.experiments.tests.urls'
+
+    def setUp(self):
+        experiment = Experiment(name="test-experiment")
+        experiment.save()
+        experiment.state = Experiment.ENABLED_STATE
+        experiment.save()
+        self.goal_type = GoalType.objects.create(name='test-goal')
+        client = Client()
+        client.get(reverse("django_lean.experiments.views.confirm_human"))
+        client.get(reverse("django_lean.experiments.tests.views.experiment_test",
+                           args=[experiment.name]))
+        self.session_key = client.cookies[settings.SESSION_COOKIE_NAME].value
+        self.goal_url = reverse(
+            'django_lean.experiments.views.record_experiment_goal',
+            args=['test-goal'])
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'access.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def line(self, path=None, status=200, session=None,
+             time='18/Oct/2026:10:00:00'):
+        return LINE % {'path': path or self.goal_url, 'status': status,
+                       'session': session or self.session_key, 'time': time}
+
+    def write_log(self, lines, mode='a', path=None):
+        fp = open(path or self.path, mode)
+        try:
+            fp.write(''.join(lines))
+        finally:
+            fp.close()
+
+    def testIngest(self):
+        self.write_log([
+            self.line(),
+            self.line(path=self.goal_url + '?x=1', time='18/Oct/2026:11:00:00'),
+            self.line(path='/other/page'),
+            self.line(status=404),
+            self.line(session='-'),
+            self.line(session='unknown-session'),
+            self.line(path=self.goal_url.replace('test-goal', 'unknown-goal')),
+            self.line(session='unknown-session'),
+            'garbage\n',
+        ])
+        sessions = Session.objects.count()
+        loaded = []
+        def load_session(session_key):
+            loaded.append(session_key)
+            return utils.load_session(session_key)
+        ingester = GoalLogIngester(batch_size=1)
+        with patch(goal_logs, 'load_session', load_session):
+            self.assertEquals(2, ingester.ingest(self.path))
+        # Unknown sessions are neither created nor loaded twice
+        self.assertEquals(sessions, Session.objects.count())
+        self.assertEquals([self.session_key, 'unknown-session'], loaded)
+        visitor = AnonymousVisitor.objects.get()
+        self.assertEquals(
+            [(datetime(2026, 10, 18, 10), visitor),
+             (datetime(2026, 10, 18, 11), visitor)],
+            [(r.created, r.anonymous_visitor)
+             for r in GoalRecord.objects.order_by('created')])
+        self.assertEquals(os.path.getsize(self.path),
+                          GoalLogOffset.objects.get(path=self.path).offset)
+
+    def testMaxSessions(self):
+        self.write_log([self.line(session='session%d' % i) for i in range(5)])
+        ingester = GoalLogIngester(max_sessions=2)
+        ingester.ingest(self.path)
+        self.assertEquals(1, len(ingester.anonymous_ids))
+
+    def testResume(self):
+        self.write_log([self.line()])
+        self.assertEquals(1, GoalLogIngester().ingest(self.path))
+        # A line still being written is left for the next run
+        self.write_log([self.line(), self.line().rstrip('\n')])
+        self.assertEquals(1, GoalLogIngester().ingest(self.path))
+        self.write_log(['\n'])
+        self.assertEquals(1, GoalLogIngester().ingest(self.path))
+        self.assertEquals(0, GoalLogIngester().ingest(self.path))
+        self.assertEquals(3, GoalRecord.objects.count())
+
+    def testRotation(self):
+        self.write_log([self.line(), self.line()])
+        GoalLogIngester().ingest(self.path)
+        self.write_log([self.line(time='19/Oct/2026:10:00:00')], mode='w')
+        self.assertEquals(1, GoalLogIngester().ingest(self.path))
+        self.assertEquals(3, GoalRecord.objects.count())
+
+    def testGzippedLog(self):
+        path = self.path + '.1.gz'
+        fp = gzip.open(path, 'wb')
+        fp.write(self.line() + self.line())
+        fp.close()
+        self.assertEquals(2, GoalLogIngester().ingest(path))
+        self.assertEquals(0, GoalLogIngester().ingest(path))
+
+    def testAnonymousIdPattern(self):
+        visitor = AnonymousVisitor.objects.get()
+        self.write_log(['%s %s\n' % (self.goal_url, visitor.id),
+                        '%s -\n' % self.goal_url])
+        ingester = GoalLogIngester(pattern=r'(?P<path>\S+) (?P<anonymous_id>\S+)')
+        self.assertEquals(1, ingester.ingest(self.path))
+
+    def testCommand(self):
+        self.write_log([self.line()])
+        call_command('ingest_goal_logs', self.path)
+        self.assertEquals(1, GoalRecord.objects.count())
+        command = ingest_goal_logs.Command()
+        self.assertRaises(CommandError, command.handle)
+        self.assertRaises(CommandError, command.handle, self.path,
+                          pattern='(?P<path>.*)', time_format='%Y',
+                          batch_size=1)
+
+    def testViewWritesDisabled(self):
+        client = Client()
+        client.cookies[settings.SESSION_COOKIE_NAME] = self.session_key
+        with patch(settings, 'LEAN_GOAL_VIEW_WRITES', False):
+            response = client.get(self.goal_url)
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(0, GoalRecord.objects.count())
+        client.get(self.goal_url)
+        self.assertEquals(1, GoalRecord.objects.count())
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+from datetime import date, timedelta
+
+from django.db import connection
+
+from django_lean.experiments.instrumentation import (Measurement,
+                                                     QueryCounter, profile)
+from django_lean.experiments.models import Experiment, GoalType
+from django_lean.experiments.reports import ConversionReportGenerator
+from django_lean.experiments.signals import report_measured
+from django_lean.experiments.tests.utils import TestCase, patch
+from django_lean.experiments.tests import utils
+
+
+class TestInstrumentation(TestCase):
+    def setUp(self):
+        self.experiment = Experiment(name="test_experiment")
+        self.experiment.save()
+        self.experiment.state = Experiment.ENABLED_STATE
+        self.experiment.save()
+        self.experiment.start_date = (self.experiment.start_date -
+                                      timedelta(days=2))
+        self.experiment.save()
+
+    def testQueryCounter(self):
+        queries = len(connection.queries)
+        with QueryCounter() as outer:
+            Experiment.objects.count()
+            with QueryCounter() as inner:
+                Experiment.objects.count()
+                Experiment.objects.count()
+        self.assertEquals(2, inner.count)
+        self.assertEquals(3, outer.count)
+        self.assertEquals(3, len(outer.queries))
+        # Queries are not kept around when DEBUG is off
+        self.assertEquals(queries, len(connection.queries))
+
+    def testSavepoints(self):
+        with QueryCounter() as counter:
+            # As recorded by the sqlite backends of Django 1.4 and 1.6
+            connection.queries.append({'sql': 'SAVEPOINT "s1"', 'time': '0'})
+            Experiment.objects.count()
+            connection.queries.append({
+                    'sql': 'QUERY = u\'RELEASE SAVEPOINT "s1"\' - PARAMS = ()',
+                    'time': '0'})
+        self.assertEquals(1, counter.count)
+
+    def testQueryBudget(self):
+        with patch(utils, 'QUERY_BUDGETS', {'count': {'anonymous': 1}}):
+            with self.assertQueryBudget('count', 'anonymous'):
+                Experiment.objects.count()
+            try:
+                with self.assertQueryBudget('count', 'anonymous'):
+                    Experiment.objects.count()
+                    Experiment.objects.count()
+            except AssertionError, e:
+                self.assertTrue('ran 2 queries' in str(e))
+            else:
+                self.fail("The query budget was not enforced")
+
+    def testMeasurement(self):
+        measurement = Measurement()
+        for i in range(2):
+            with measurement.measure():
+                Experiment.objects.count()
+        self.assertEquals(2, measurement.queries)
+        self.assertTrue(measurement.duration > 0)
+
+    def testReportMeasured(self):
+        goal_types = [GoalType.objects.create(name=str(i)) for i in range(2)]
+        measured = []
+        def receiver(sender, **kwargs):
+            measured.append(kwargs)
+        report_measured.connect(receiver)
+        try:
+            ConversionReportGenerator().generate_all_daily_reports()
+        finally:
+            report_measured.disconnect(receiver)
+        # One measurement per goal type and one for the whole report,
+        # for each of the two days.
+        self.assertEquals(6, len(measured))
+        self.assertEquals(
+            set([(None, date.today() - timedelta(days=i)) for i in (1, 2)] +
+                [(g, date.today() - timedelta(days=i))
+                 for g in goal_types for i in (1, 2)]),
+            set((m['goal_type'], m['report_date']) for m in measured))
+        for m in measured:
+            self.assertEquals('conversion', m['report_type'])
+            self.assertEquals(self.experiment, m['experiment'])
+            if m['goal_type'] is None:
+                self.assertTrue(m['queries'] > 0)
+
+    def testProfile(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with profile(directory, 'test'):
+                Experiment.objects.count()
+            self.assertTrue([f for f in os.listdir(directory)
+                             if f.startswith('test-') and f.endswith('.prof')])
+        finally:
+            shutil.rmtree(directory)
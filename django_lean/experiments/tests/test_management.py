@@ -46,3 +46,12 @@ class TestManagement(TestCase):
             self.assertEquals(5, DailyConversionReport.objects.filter(
                     experiment=self.experiment).count())
     
+
+    def testSampledPreview(self):
+        command = update_experiment_reports.Command()
+        self.assertRaises(CommandError, command.handle, sample=0)
+        self.assertRaises(CommandError, command.handle, sample=1.5)
+        command.handle(sample=0.5)
+        # Previews are not stored
+        self.assertEquals(0, DailyConversionReport.objects.filter(
+                experiment=self.experiment).count())
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import socket
+from threading import Thread
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+
+from django_lean import metrics
+from django_lean.experiments.models import (AnonymousVisitor, Experiment,
+                                            GoalRecord, GoalType)
+from django_lean.experiments.reports import ConversionReportGenerator
+from django_lean.experiments.tests.utils import patch, TestCase, TestUser
+
+
+class TestMetrics(TestCase):
+    urls = 'django_lean.experiments.tests.urls'
+
+    def setUp(self):
+        metrics.reset()
+        self.registry = metrics.Registry()
+
+    def tearDown(self):
+        metrics.reset()
+
+    def testCounter(self):
+        counter = self.registry.counter('hits', page='home')
+        self.assertTrue(counter is self.registry.counter('hits', page='home'))
+        def hit():
+            for i in range(1000):
+                counter.inc()
+        threads = [Thread(target=hit) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(4000, counter.value)
+        # Each thread updated its own stripe
+        self.assertEquals(4, len([c for c in counter._cells if c]))
+        self.assertRaises(ValueError, self.registry.histogram, 'hits')
+
+    def testStripes(self):
+        stripes = []
+        def record():
+            stripes.append(metrics.get_stripe())
+            self.assertEquals(stripes[-1], metrics.get_stripe())
+        threads = [Thread(target=record) for i in range(metrics.STRIPES)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        self.assertEquals(range(metrics.STRIPES), sorted(stripes))
+
+    def testHistogram(self):
+        histogram = self.registry.histogram('latency', buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        self.assertEquals(([2, 3, 4], 14.5), histogram.snapshot())
+        self.assertEquals(4, histogram.count)
+
+    def testExposition(self):
+        self.registry.counter('hits', page='say "hi"').inc(2)
+        self.registry.histogram('latency', buckets=(1,)).observe(0.5)
+        self.assertEquals(
+            '# TYPE django_lean_hits counter\n'
+            'django_lean_hits{page="say \\"hi\\""} 2\n'
+            '# TYPE django_lean_latency histogram\n'
+            'django_lean_latency_bucket{le="1"} 1\n'
+            'django_lean_latency_bucket{le="+Inf"} 1\n'
+            'django_lean_latency_sum 0.5\n'
+            'django_lean_latency_count 1\n',
+            self.registry.exposition())
+
+    def testStatsdPusher(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        try:
+            pusher = metrics.StatsdPusher(self.registry,
+                                          listener.getsockname(),
+                                          prefix='test')
+            self.registry.counter('hits', page='/home').inc(3)
+            self.registry.histogram('latency').observe(0.25)
+            pusher.push()
+            self.assertEquals(['test.hits.page._home:3|c',
+                               'test.latency.count:1|c',
+                               'test.latency.sum:0.25|c'],
+                              sorted(listener.recv(4096).split('\n')))
+            # Only changes are pushed
+            self.registry.counter('hits', page='/home').inc()
+            pusher.push()
+            self.assertEquals('test.hits.page._home:1|c',
+                              listener.recv(4096))
+        finally:
+            listener.close()
+
+    def testDisabled(self):
+        with patch(settings, 'LEAN_METRICS', False):
+            metrics.increment('hits')
+        self.assertEquals([], metrics.registry.collect())
+
+    def testHooks(self):
+        experiment = Experiment(name="test_experiment")
+        experiment.save()
+        experiment.state = Experiment.ENABLED_STATE
+        experiment.save()
+        anonymous_visitor = AnonymousVisitor.objects.create()
+        GoalType.objects.create(name='test-goal')
+        user = TestUser(anonymous_visitor=anonymous_visitor)
+        in_test = Experiment.test(experiment.name, user)
+        Experiment.test(experiment.name, user)
+        GoalRecord.record('test-goal', user)
+        ConversionReportGenerator().generate_report(experiment,
+                                                    experiment.start_date)
+        group = in_test and 'Test' or 'Control'
+        registry = metrics.registry
+        self.assertEquals(1, registry.counter(
+                'enrollments_total', experiment=experiment.name,
+                group=group).value)
+        self.assertEquals(2, registry.histogram(
+                'experiment_check_seconds', experiment=experiment.name).count)
+        self.assertEquals(1, registry.counter(
+                'goal_records_total', goal_type='test-goal').value)
+        self.assertEquals(1, registry.histogram(
+                'report_generation_seconds', report_type='conversion').count)
+
+    def testExpositionView(self):
+        url = reverse('django_lean.experiments.views.metrics_exposition')
+        self.assertEquals(404, self.client.get(url).status_code)
+        metrics.increment('hits')
+        with patch(settings, 'LEAN_METRICS_EXPOSITION', True):
+            # The metrics are not public
+            self.assertEquals(403, self.client.get(url).status_code)
+            with patch(settings, 'LEAN_METRICS_ALLOWED_IPS', ['127.0.0.1']):
+                self.assertEquals(200, self.client.get(url).status_code)
+            staff = User.objects.create_user('staff', 'staff@example.com',
+                                             'password')
+            staff.is_staff = True
+            staff.save()
+            self.client.login(username='staff', password='password')
+            response = self.client.get(url)
+        self.assertEquals(200, response.status_code)
+        self.assertTrue('django_lean_hits 1\n' in response.content)
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import logging
+import re
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse
+from django.test.client import Client, RequestFactory
+
+from django_lean.experiments import middleware
+from django_lean.experiments.middleware import (BUCKET_HEADER,
+                                                experiment_buckets,
+                                                format_bucket, parse_bucket)
+from django_lean.experiments.models import Experiment, GoalType, Participant
+from django_lean.experiments.tests.utils import patch, TestCase
+from django_lean.experiments.tests.views import bucket_test
+
+
+class LogRecorder(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestExperimentOverheadMiddleware(TestCase):
+    urls = 'django_lean.experiments.tests.urls'
+
+    def setUp(self):
+        self.experiment = Experiment(name="test_experiment")
+        self.experiment.save()
+        self.experiment.state = Experiment.ENABLED_STATE
+        self.experiment.save()
+        GoalType.objects.create(name='test-goal')
+        self.original_MIDDLEWARE_CLASSES = settings.MIDDLEWARE_CLASSES
+        settings.MIDDLEWARE_CLASSES = (
+            ('django_lean.experiments.middleware.'
+             'ExperimentOverheadMiddleware',) +
+            tuple(settings.MIDDLEWARE_CLASSES))
+        self.recorder = LogRecorder()
+        middleware.l.addHandler(self.recorder)
+
+    def tearDown(self):
+        middleware.l.removeHandler(self.recorder)
+        settings.MIDDLEWARE_CLASSES = self.original_MIDDLEWARE_CLASSES
+
+    def get_overhead(self, url):
+        response = self.client.get(url)
+        match = re.match(r'django-lean;dur=([\d.]+);desc="(\d+) checks, '
+                         r'(\d+) enrollments, (\d+) goals, (\d+) queries"$',
+                         response['Server-Timing'])
+        self.assertTrue(match, response['Server-Timing'])
+        return [float(match.group(1))] + [int(g) for g in match.groups()[1:]]
+
+    def testServerTiming(self):
+        experiment_url = reverse(
+            'django_lean.experiments.tests.views.experiment_test',
+            args=[self.experiment.name])
+        confirm_human_url = reverse(
+            'django_lean.experiments.views.confirm_human')
+        goal_url = reverse(
+            'django_lean.experiments.views.record_experiment_goal',
+            args=['test-goal'])
+        # The template checks the test and the control groups, and the
+        # unverified visitor gets a temporary enrollment.
+        duration, checks, enrollments, goals, queries = \
+            self.get_overhead(experiment_url)
+        self.assertEquals((2, 1, 0), (checks, enrollments, goals))
+        self.assertTrue(queries > 0)
+        self.assertTrue(duration > 0)
+        self.assertEquals([0, 1, 0],
+                          self.get_overhead(confirm_human_url)[1:4])
+        self.assertEquals([2, 0, 0], self.get_overhead(experiment_url)[1:4])
+        self.assertEquals([0, 0, 1], self.get_overhead(goal_url)[1:4])
+
+    def testThreshold(self):
+        url = reverse('django_lean.experiments.tests.views.experiment_test',
+                      args=[self.experiment.name])
+        self.client.get(url)
+        self.assertEquals([], self.recorder.messages)
+        with patch(settings, 'LEAN_OVERHEAD_LOG_THRESHOLD', 0):
+            self.client.get(url)
+        self.assertEquals(1, len(self.recorder.messages))
+        self.assertTrue(url in self.recorder.messages[0])
+
+
+class TestExperimentBucketMiddleware(TestCase):
+    urls = 'django_lean.experiments.tests.urls'
+
+    def setUp(self):
+        self.experiment = Experiment(name="bucket_experiment")
+        self.experiment.save()
+        self.experiment.state = Experiment.ENABLED_STATE
+        self.experiment.save()
+        self.original_MIDDLEWARE_CLASSES = settings.MIDDLEWARE_CLASSES
+        settings.MIDDLEWARE_CLASSES = (
+            'django.middleware.cache.UpdateCacheMiddleware',
+            'django.contrib.sessions.middleware.SessionMiddleware',
+            'django.contrib.auth.middleware.AuthenticationMiddleware',
+            'django_lean.experiments.middleware.ExperimentBucketMiddleware',
+            'django.middleware.cache.FetchFromCacheMiddleware',
+        )
+        self.original_LEAN_BUCKET_EXPERIMENTS = getattr(
+            settings, 'LEAN_BUCKET_EXPERIMENTS', NotImplemented)
+        settings.LEAN_BUCKET_EXPERIMENTS = [self.experiment.name]
+        self.original_LEAN_BUCKET_SHARED_VIEWS = getattr(
+            settings, 'LEAN_BUCKET_SHARED_VIEWS', NotImplemented)
+        settings.LEAN_BUCKET_SHARED_VIEWS = [
+            'django_lean.experiments.tests.views.bucket_test']
+        cache.clear()
+        bucket_test.renders = 0
+        self.url = reverse('django_lean.experiments.tests.views.bucket_test',
+                           args=[self.experiment.name])
+
+    def tearDown(self):
+        settings.MIDDLEWARE_CLASSES = self.original_MIDDLEWARE_CLASSES
+        if self.original_LEAN_BUCKET_EXPERIMENTS is NotImplemented:
+            del settings.LEAN_BUCKET_EXPERIMENTS
+        else:
+            settings.LEAN_BUCKET_EXPERIMENTS = \
+                self.original_LEAN_BUCKET_EXPERIMENTS
+        if self.original_LEAN_BUCKET_SHARED_VIEWS is NotImplemented:
+            del settings.LEAN_BUCKET_SHARED_VIEWS
+        else:
+            settings.LEAN_BUCKET_SHARED_VIEWS = \
+                self.original_LEAN_BUCKET_SHARED_VIEWS
+
+    def testBuckets(self):
+        self.assertEquals('test%20experiment:t~x:c',
+                          format_bucket({'x': Participant.CONTROL_GROUP,
+                                         'test experiment':
+                                         Participant.TEST_GROUP}))
+        self.assertEquals({u'x': Participant.CONTROL_GROUP,
+                           u'test experiment': Participant.TEST_GROUP},
+                          parse_bucket('test%20experiment:t~x:c'))
+
+    def testFirstVisit(self):
+        client = Client()
+        response = client.get(self.url)
+        bucket = response[BUCKET_HEADER]
+        content = response.content.strip()
+        self.assertEquals({'t': 'TEST', 'c': 'CONTROL'}[bucket[-1]], content)
+        self.assertTrue(BUCKET_HEADER in response['Vary'])
+        # The temporary enrollment is stored in a new session
+        self.assertTrue('Cookie' in response['Vary'])
+        self.assertTrue('private' in response['Cache-Control'])
+        self.assertTrue(client.cookies['lean_bucket'].value.startswith(
+                bucket + ':'))
+
+    def testCachedPerBucket(self):
+        buckets = {}
+        for i in range(20):
+            client = Client()
+            first = client.get(self.url)
+            bucket = first[BUCKET_HEADER]
+            # The page is served from the cache for the visitor's bucket
+            response = client.get(self.url)
+            self.assertEquals(bucket, response[BUCKET_HEADER])
+            self.assertEquals(first.content, response.content)
+            self.assertTrue(response.has_header('Expires'))
+            buckets[bucket] = response.content
+        self.assertEquals(2, len(buckets))
+        # Each bucket was only rendered for its first visitor, whose
+        # response set the cookie and was not cached, and for their
+        # second visit, which was cached for everyone in the bucket.
+        self.assertEquals(4, bucket_test.renders)
+
+    def testPrivateView(self):
+        # Views that are not shared keep varying on the session cookie
+        settings.LEAN_BUCKET_SHARED_VIEWS = []
+        client = Client()
+        client.get(self.url)
+        response = client.get(self.url)
+        self.assertTrue('Cookie' in response['Vary'])
+        renders = bucket_test.renders
+        other = Client()
+        other.cookies['lean_bucket'] = client.cookies['lean_bucket'].value
+        other.get(self.url)
+        self.assertEquals(renders + 1, bucket_test.renders)
+
+    def testAuthenticatedUser(self):
+        for username in ('first', 'second'):
+            User.objects.create_user(username, '%s@example.com' % username,
+                                     'password')
+        first = Client()
+        first.login(username='first', password='password')
+        bucket = first.get(self.url)[BUCKET_HEADER]
+        response = first.get(self.url)
+        self.assertTrue('Cookie' in response['Vary'])
+        # The page of a user is not served to the others of the bucket
+        Participant.objects.create(
+            user=User.objects.get(username='second'),
+            experiment=self.experiment,
+            group=parse_bucket(bucket)[self.experiment.name])
+        second = Client()
+        second.login(username='second', password='password')
+        second.cookies['lean_bucket'] = first.cookies['lean_bucket'].value
+        renders = bucket_test.renders
+        response = second.get(self.url)
+        self.assertEquals(bucket, response[BUCKET_HEADER])
+        self.assertEquals(renders + 1, bucket_test.renders)
+
+    def testExpiredSession(self):
+        client = Client()
+        client.get(self.url)
+        bucket_cookie = client.cookies['lean_bucket'].value
+        for i in range(2):
+            client = Client()
+            client.cookies['lean_bucket'] = bucket_cookie
+            client.cookies[settings.SESSION_COOKIE_NAME] = 'expired%d' % i
+            renders = bucket_test.renders
+            response = client.get(self.url)
+            self.assertEquals(renders + 1, bucket_test.renders)
+            self.assertTrue('private' in response['Cache-Control'])
+            self.assertNotEqual(
+                'expired%d' % i,
+                client.cookies[settings.SESSION_COOKIE_NAME].value)
+
+    def testForgedCookie(self):
+        client = Client()
+        response = client.get(self.url)
+        bucket = response[BUCKET_HEADER]
+        other = bucket[:-1] + {'t': 'c', 'c': 't'}[bucket[-1]]
+        client.cookies['lean_bucket'] = other + ':forged'
+        response = client.get(self.url)
+        self.assertEquals(bucket, response[BUCKET_HEADER])
+
+    def testDecorator(self):
+        settings.MIDDLEWARE_CLASSES = (
+            'django.contrib.sessions.middleware.SessionMiddleware',
+            'django.contrib.auth.middleware.AuthenticationMiddleware',
+        )
+        view = experiment_buckets([self.experiment.name])(
+            lambda request: HttpResponse('OK'))
+        request = RequestFactory().get('/')
+        SessionMiddleware().process_request(request)
+        request.user = AnonymousUser()
+        response = view(request)
+        self.assertEquals(request.META['HTTP_X_EXPERIMENT_BUCKET'],
+                          response[BUCKET_HEADER])
+        self.assertTrue(request.experiment_bucket_shared)
+        private = experiment_buckets([self.experiment.name], shared=False)(
+            lambda request: HttpResponse('OK'))
+        request = RequestFactory().get('/')
+        SessionMiddleware().process_request(request)
+        request.user = AnonymousUser()
+        private(request)
+        self.assertFalse(request.experiment_bucket_shared)
@@ -250,11 +250,18 @@ class TestExperimentModels(TestCase):
         goal_record2.save()
         
         nb_records = GoalRecord.objects.all().count()
-        GoalRecord.record('test-goal', TestUser())
+        # Visitors without an anonymous id did not confirm they are human
+        user = TestUser()
+        with self.assertQueryBudget('GoalRecord.record', 'unverified'):
+            GoalRecord.record('test-goal', user)
         self.assertEquals(nb_records, GoalRecord.objects.all().count())
-        GoalRecord.record('test-goal', TestUser(username='test'))
+        user = TestUser(username='test')
+        with self.assertQueryBudget('GoalRecord.record', 'registered'):
+            GoalRecord.record('test-goal', user)
         self.assertEquals(nb_records, GoalRecord.objects.all().count())
-        GoalRecord.record('test-goal', TestUser(anonymous_visitor=anonymous_visitor))
+        user = TestUser(anonymous_visitor=anonymous_visitor)
+        with self.assertQueryBudget('GoalRecord.record', 'anonymous'):
+            GoalRecord.record('test-goal', user)
         self.assertEquals(nb_records + 1, GoalRecord.objects.all().count())
         GoalRecord.record('test-goal', TestUser(anonymous_visitor=anonymous_visitor))
         self.assertEquals(nb_records + 2, GoalRecord.objects.all().count())
@@ -267,9 +274,12 @@ class TestExperimentModels(TestCase):
         
         user = TestUser(verified_human=False)
         participants_count = Participant.objects.all().count()
-        in_test = Experiment.test(experiment.name, user)
+        with self.assertQueryBudget('Experiment.test', 'unverified'):
+            in_test = Experiment.test(experiment.name, user)
         self.assertEquals(None, user.get_anonymous_id())
         self.assertEquals(participants_count, Participant.objects.all().count())
+        with self.assertQueryBudget('Experiment.test enrolled', 'unverified'):
+            self.assertEquals(in_test, Experiment.test(experiment.name, user))
         
         enrollments = user.get_added_enrollments()
         self.assertEquals(len(enrollments.keys()), 1)
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
+from __future__ import with_statement
+
 from django.conf import settings
 
-from django_lean.experiments.models import Experiment
+from django_lean.experiments.models import Experiment, Participant
 from django_lean.experiments.tests.utils import TestCase, TestUser
 
 
@@ -48,13 +50,16 @@ class TestParticipants(TestCase):
         experiment.save()
         for i in range(100):
             user = TestUser()
-            in_test = Experiment.test("enabled", user)
+            with self.assertQueryBudget('Experiment.test', 'anonymous'):
+                in_test = Experiment.test("enabled", user)
             anonymous_id = user.get_anonymous_id()
             self.assertNotEquals(None, anonymous_id)
             in_control = Experiment.control("enabled", user)
             self.assertEquals(user.get_anonymous_id(), anonymous_id)
             self.assertNotEquals(in_test, in_control)
-            self.assertEquals(in_test, Experiment.test("enabled", user))
+            with self.assertQueryBudget('Experiment.test enrolled',
+                                        'anonymous'):
+                self.assertEquals(in_test, Experiment.test("enabled", user))
             self.assertEquals(user.get_anonymous_id(), anonymous_id)
             self.assertEquals(in_control, Experiment.control("enabled", user))
             self.assertEquals(user.get_anonymous_id(), anonymous_id)
@@ -82,10 +87,13 @@ class TestParticipants(TestCase):
         control_user = None
         for i in range(100):
             user = TestUser(username="user%s" % i)
-            in_test = Experiment.test("enabled", user)
+            with self.assertQueryBudget('Experiment.test', 'registered'):
+                in_test = Experiment.test("enabled", user)
             in_control = Experiment.control("enabled", user)
             self.assertNotEquals(in_test, in_control)
-            self.assertEquals(in_test, Experiment.test("enabled", user))
+            with self.assertQueryBudget('Experiment.test enrolled',
+                                        'registered'):
+                self.assertEquals(in_test, Experiment.test("enabled", user))
             self.assertEquals(in_control, Experiment.control("enabled", user))
             if in_test:
                 test_user = user
@@ -115,4 +123,30 @@ class TestParticipants(TestCase):
         self.assertTrue(Experiment.control("enabled", test_user))
         self.assertFalse(Experiment.test("enabled", control_user))
         self.assertFalse(Experiment.test("enabled", test_user))
-    
+
+    def testGroup(self):
+        experiment = Experiment(name="enabled")
+        experiment.save()
+        experiment.state = Experiment.ENABLED_STATE
+        experiment.save()
+        groups = set()
+        for i in range(100):
+            user = TestUser(username="user%s" % i)
+            group = Experiment.group("enabled", user)
+            self.assertEquals(group, Experiment.group("enabled", user))
+            self.assertEquals(group == Participant.TEST_GROUP,
+                              Experiment.test("enabled", user))
+            groups.add(group)
+        self.assertEquals(set([Participant.CONTROL_GROUP,
+                               Participant.TEST_GROUP]), groups)
+
+        experiment.state = Experiment.PROMOTED_STATE
+        experiment.save()
+        self.assertEquals(Participant.TEST_GROUP,
+                          Experiment.group("enabled", user))
+        experiment.state = Experiment.DISABLED_STATE
+        experiment.save()
+        self.assertEquals(Participant.CONTROL_GROUP,
+                          Experiment.group("enabled", user))
+        self.assertEquals(Participant.CONTROL_GROUP,
+                          Experiment.group("undefined", user))
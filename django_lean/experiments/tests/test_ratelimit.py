@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+
+from django_lean import metrics
+from django_lean.experiments.models import Experiment, GoalRecord, GoalType
+from django_lean.experiments.ratelimit import TokenBucket, allow_goal
+from django_lean.experiments.tests.utils import patch, TestCase
+
+
+class TestTokenBucket(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def testConsume(self):
+        bucket = TokenBucket('test', 3, 30)
+        for i in range(3):
+            self.assertTrue(bucket.consume('key', now=100))
+        self.assertFalse(bucket.consume('key', now=100))
+        # Other keys have their own bucket
+        self.assertTrue(bucket.consume(u'other ké', now=100))
+        # One token every 10 seconds
+        self.assertFalse(bucket.consume('key', now=109))
+        self.assertTrue(bucket.consume('key', now=110))
+        self.assertFalse(bucket.consume('key', now=110))
+        # Refills up to the capacity
+        for i in range(3):
+            self.assertTrue(bucket.consume('key', now=1000))
+        self.assertFalse(bucket.consume('key', now=1000))
+
+
+class TestAllowGoal(TestCase):
+    urls = 'django_lean.experiments.tests.urls'
+
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+
+    def dropped(self, scope):
+        return metrics.registry.counter('goal_hits_dropped_total',
+                                        scope=scope).value
+
+    def testLimits(self):
+        with patch(settings, 'LEAN_GOAL_RATE_LIMITS',
+                   {'visitor': (4, 60), 'goal_type': (2, 60)}):
+            self.assertTrue(allow_goal('goal', 'visitor'))
+            self.assertTrue(allow_goal('goal', 'visitor'))
+            self.assertFalse(allow_goal('goal', 'visitor'))
+            self.assertEquals(1, self.dropped('goal_type'))
+            self.assertTrue(allow_goal('other goal', 'visitor'))
+            self.assertFalse(allow_goal('third goal', 'visitor'))
+            self.assertEquals(1, self.dropped('visitor'))
+            # Other visitors have their own allowances
+            self.assertTrue(allow_goal('goal', 'other visitor'))
+            self.assertTrue(allow_goal('goal', 'other visitor'))
+
+    def testNoLimits(self):
+        with patch(settings, 'LEAN_GOAL_RATE_LIMITS', {'visitor': None}):
+            for i in range(100):
+                self.assertTrue(allow_goal('goal', 'visitor'))
+
+    def testGoalView(self):
+        experiment = Experiment(name="test-experiment")
+        experiment.save()
+        experiment.state = Experiment.ENABLED_STATE
+        experiment.save()
+        GoalType.objects.create(name='test-goal')
+        client = Client()
+        client.get(reverse("django_lean.experiments.views.confirm_human"))
+        client.get(reverse("django_lean.experiments.tests.views.experiment_test",
+                           args=[experiment.name]))
+        goal_url = reverse(
+            'django_lean.experiments.views.record_experiment_goal',
+            args=['test-goal'])
+        with patch(settings, 'LEAN_GOAL_RATE_LIMITS', {'visitor': (2, 60)}):
+            for i in range(4):
+                response = client.get(goal_url)
+                self.assertEquals(200, response.status_code)
+            # Dropped hits only look up the session
+            with self.assertNumQueries(1):
+                client.get(goal_url)
+        self.assertEquals(2, GoalRecord.objects.count())
+        self.assertEquals(3, self.dropped('visitor'))
+
+    def testGoalViewWithUnknownSessions(self):
+        GoalType.objects.create(name='test-goal')
+        goal_url = reverse(
+            'django_lean.experiments.views.record_experiment_goal',
+            args=['test-goal'])
+        with patch(settings, 'LEAN_GOAL_RATE_LIMITS', {'visitor': (2, 60)}):
+            for i in range(5):
+                client = Client(REMOTE_ADDR='10.0.0.2')
+                client.cookies[settings.SESSION_COOKIE_NAME] = 'bogus%d' % i
+                client.get(goal_url)
+        # Unknown session keys are limited by address
+        self.assertEquals(3, self.dropped('visitor'))
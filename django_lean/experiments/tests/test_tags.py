@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
+from __future__ import with_statement
+
 import mox
 
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.template import Context
+from django.http import HttpRequest
+from django.template import Context, Template, TemplateSyntaxError
 from django.test.client import Client
 from django.contrib.auth.models import User
 
+from django_lean import metrics
 from django_lean.experiments.models import Experiment, Participant
 from django_lean.experiments.templatetags.experiments import (
     experiment, clientsideexperiment
@@ -32,11 +37,11 @@ class ExperimentTagsTest(TestCase):
         self.doTestIntegration(
             url=reverse('django_lean.experiments.tests.views.experiment_test',
                         args=[self.experiment.name]),
-            client_factory=lambda i: Client())
+            client_factory=lambda i: Client(), user_type='anonymous')
         self.doTestIntegration(
             url=reverse('django_lean.experiments.tests.views.clientsideexperiment_test',
                         args=[self.other_experiment.name]),
-            client_factory=lambda i: Client())
+            client_factory=lambda i: Client(), user_type='anonymous')
     
     def testIntegrationWithRegisteredUser(self):
         def create_registered_user_client(i):
@@ -52,24 +57,31 @@ class ExperimentTagsTest(TestCase):
         self.doTestIntegration(
             url=reverse('django_lean.experiments.tests.views.experiment_test',
                         args=[self.experiment.name]),
-            client_factory=create_registered_user_client)
+            client_factory=create_registered_user_client,
+            user_type='registered')
         
         # we wrap our factory to ensure that the users are created
         # with new names
         self.doTestIntegration(
             url=reverse('django_lean.experiments.tests.views.clientsideexperiment_test',
                         args=[self.other_experiment.name]),
-            client_factory=lambda i: create_registered_user_client(1000 + i))
+            client_factory=lambda i: create_registered_user_client(1000 + i),
+            user_type='registered')
     
-    def doTestIntegration(self, url, client_factory):
+    def doTestIntegration(self, url, client_factory, user_type):
         confirm_human_url = reverse('django_lean.experiments.views.confirm_human')
         found_control = False
         found_test = False
         for i in range(100):
             client = client_factory(i)
-            response = client.get(confirm_human_url)
+            # Anonymous visitors are not verified before this call
+            with self.assertQueryBudget(
+                'confirm_human view',
+                user_type == 'anonymous' and 'unverified' or user_type):
+                response = client.get(confirm_human_url)
             self.assertEquals(204, response.status_code)
-            response = client.get(url)
+            with self.assertQueryBudget('experiment page view', user_type):
+                response = client.get(url)
             self.assertEquals(200, response.status_code)
             in_test = "test" in response.content.lower()
             in_control = "control" in response.content.lower()
@@ -245,4 +257,104 @@ class ExperimentTagsTest(TestCase):
             self.assertEqual(
                         other_group_id == Participant.CONTROL_GROUP,
                         other_group_name == "control")
-    
+
+    def renderForUser(self, source, user):
+        request = HttpRequest()
+        request.user = user
+        request.session = {}
+        return Template('{% load experiments %}' + source).render(
+            Context({'request': request})).strip()
+
+    def testExperimentElseTag(self):
+        found = set()
+        for i in range(40):
+            user = User.objects.create(username="user%s" % i,
+                                       email="user%s@example.com" % i)
+            with self.assertQueryBudget('Experiment.test', 'registered'):
+                result = self.renderForUser(
+                    '{% experiment test_experiment %}TEST'
+                    '{% else %}CONTROL{% endexperiment %}', user)
+            group = Participant.objects.get(user=user,
+                                            experiment=self.experiment).group
+            self.assertEquals(group == Participant.TEST_GROUP and 'TEST' or
+                              'CONTROL', result)
+            found.add(result)
+            # Without {% else %}, only the test group gets content
+            self.assertEquals(group == Participant.TEST_GROUP and 'TEST' or
+                              '',
+                              self.renderForUser(
+                    '{% experiment test_experiment %}TEST{% endexperiment %}',
+                    user))
+        self.assertEquals(set(['TEST', 'CONTROL']), found)
+
+    def testExperimentGroupTags(self):
+        for i in range(20):
+            user = User.objects.create(username="user%s" % i,
+                                       email="user%s@example.com" % i)
+            group = Experiment.group(self.experiment.name,
+                                     TestUser(username=user.username))
+            self.assertEquals(
+                group == Participant.TEST_GROUP and 'TEST' or 'CONTROL',
+                self.renderForUser(
+                    '{% experiment test_experiment %}\n'
+                    '{% group control %}CONTROL'
+                    '{% group test %}TEST'
+                    '{% endexperiment %}', user))
+            self.assertEquals(
+                group == Participant.TEST_GROUP and 'ALL' or 'OTHER',
+                self.renderForUser(
+                    '{% experiment test_experiment %}'
+                    '{% group test %}ALL'
+                    '{% else %}OTHER'
+                    '{% endexperiment %}', user))
+            self.assertEquals(
+                'ALL',
+                self.renderForUser(
+                    '{% experiment test_experiment %}'
+                    '{% group test control %}ALL'
+                    '{% endexperiment %}', user))
+
+    def testExperimentGroupTagsSyntax(self):
+        for source in ('{% experiment test_experiment %}'
+                       '{% group other %}{% endexperiment %}',
+                       '{% experiment test_experiment %}'
+                       '{% group %}{% endexperiment %}',
+                       '{% experiment test_experiment %}content'
+                       '{% group test %}{% endexperiment %}',
+                       '{% experiment test_experiment %}{% else %}'
+                       '{% group test %}{% endexperiment %}'):
+            self.assertRaises(TemplateSyntaxError, Template,
+                              '{% load experiments %}' + source)
+
+    def testExperimentCacheTag(self):
+        cache.clear()
+        metrics.reset()
+        source = ('{% experimentcache 60 test_experiment fragment page %}'
+                  '{% experiment test_experiment %}TEST {{ user.username }}'
+                  '{% else %}CONTROL {{ user.username }}{% endexperiment %}'
+                  '{% endexperimentcache %}')
+        renders = {}
+        for i in range(20):
+            user = User.objects.create(username="user%s" % i,
+                                       email="user%s@example.com" % i)
+            request = HttpRequest()
+            request.user = user
+            request.session = {}
+            result = Template('{% load experiments %}' + source).render(
+                Context({'request': request, 'user': user, 'page': 1}))
+            group = Participant.objects.get(user=user,
+                                            experiment=self.experiment).group
+            # The first user of each group renders the fragment for the
+            # whole group
+            self.assertEquals(renders.setdefault(group, result), result)
+            self.assertEquals(group == Participant.TEST_GROUP,
+                              result.startswith('TEST'))
+        self.assertEquals(2, len(renders))
+        labels = {'experiment': 'test_experiment', 'fragment': 'fragment'}
+        self.assertEquals(2, metrics.registry.counter(
+                'fragment_cache_misses_total', **labels).value)
+        self.assertEquals(18, metrics.registry.counter(
+                'fragment_cache_hits_total', **labels).value)
+        self.assertRaises(TemplateSyntaxError, Template,
+                          '{% load experiments %}{% experimentcache 60 '
+                          'test_experiment %}{% endexperimentcache %}')
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django_lean.experiments.models import (Experiment, DailyEngagementReport,
+                                            DailyConversionReport,
+                                            ReportWorkUnit)
+from django_lean.experiments.reports import (EngagementReportGenerator,
+                                             ConversionReportGenerator)
+from django_lean.experiments.testsettings import SimpleEngagementCalculator
+from django_lean.experiments.tests.utils import TestCase
+from django_lean.experiments.worker import ReportWorker
+
+
+class FailingGenerator(ConversionReportGenerator):
+    def generate_daily_report_for_experiment(self, experiment, report_date):
+        raise RuntimeError("Cannot generate reports")
+
+
+class TestReportWorker(TestCase):
+    def setUp(self):
+        self.experiment = Experiment(name="test_experiment")
+        self.experiment.save()
+        self.experiment.state = Experiment.ENABLED_STATE
+        self.experiment.save()
+        self.experiment.start_date = (self.experiment.start_date -
+                                      timedelta(days=5))
+        self.experiment.save()
+        self.worker = ReportWorker({
+            'engagement': EngagementReportGenerator(
+                engagement_score_calculator=SimpleEngagementCalculator()),
+            'conversion': ConversionReportGenerator(),
+        })
+
+    def testEnqueueAndProcess(self):
+        self.assertEquals(10, self.worker.enqueue())
+        self.assertEquals(10, ReportWorkUnit.objects.filter(
+                state=ReportWorkUnit.PENDING_STATE).count())
+        # Nothing new until another day closes
+        self.assertEquals(0, self.worker.enqueue())
+
+        self.assertEquals(10, self.worker.process())
+        self.assertEquals(10, ReportWorkUnit.objects.filter(
+                state=ReportWorkUnit.DONE_STATE).count())
+        self.assertEquals(5, DailyEngagementReport.objects.filter(
+                experiment=self.experiment).count())
+        self.assertEquals(5, DailyConversionReport.objects.filter(
+                experiment=self.experiment).count())
+        self.assertEquals(0, self.worker.process())
+
+    def testExistingReportsAreDone(self):
+        ConversionReportGenerator().generate_all_daily_reports()
+        self.assertEquals(5, self.worker.enqueue())
+        self.assertEquals(5, ReportWorkUnit.objects.filter(
+                report_type='conversion',
+                state=ReportWorkUnit.DONE_STATE).count())
+
+    def testResume(self):
+        self.worker.enqueue()
+        # A report was stored, but the worker died before checkpointing
+        unit = ReportWorkUnit.objects.filter(report_type='conversion')[0]
+        ConversionReportGenerator().generate_daily_report_for_experiment(
+            experiment=self.experiment, report_date=unit.date)
+        self.worker.run(interval=0, iterations=1)
+        self.assertEquals(0, ReportWorkUnit.objects.filter(
+                state=ReportWorkUnit.PENDING_STATE).count())
+        self.assertEquals(1, DailyConversionReport.objects.filter(
+                experiment=self.experiment, date=unit.date).count())
+
+    def testFailures(self):
+        worker = ReportWorker({'conversion': FailingGenerator()},
+                              max_attempts=2)
+        worker.enqueue()
+        worker.process()
+        self.assertEquals(5, ReportWorkUnit.objects.filter(
+                state=ReportWorkUnit.PENDING_STATE, attempts=1).count())
+        worker.process()
+        self.assertEquals(5, ReportWorkUnit.objects.filter(
+                state=ReportWorkUnit.FAILED_STATE, attempts=2).count())
@@ -8,7 +8,8 @@ except ImportError:
 
 urlpatterns = patterns('django_lean.experiments.tests.views',
     url(r'^test-experiment/(?P<experiment_name>.*)$', 'experiment_test'),
-    url(r'^test-clientsideexperiment/(?P<experiment_name>.*)$', 'clientsideexperiment_test')
+    url(r'^test-clientsideexperiment/(?P<experiment_name>.*)$', 'clientsideexperiment_test'),
+    url(r'^test-bucket/(?P<experiment_name>.*)$', 'bucket_test'),
 )
 
 urlpatterns += patterns('',
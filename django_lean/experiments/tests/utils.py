@@ -10,11 +10,37 @@ from django.test import TestCase as DjangoTestCase
 from django.utils.importlib import import_module
 from django.utils.functional import LazyObject
 
+from django_lean.experiments.instrumentation import QueryCounter
 from django_lean.experiments.loader import ExperimentLoader
 from django_lean.experiments.models import Participant
 from django_lean.lean_analytics import reset_caches
 
 
+# Maximum number of queries each hot path may run, per type of user:
+# 'unverified' anonymous visitors that did not call confirm_human yet,
+# verified 'anonymous' visitors and 'registered' users. Budgets of views
+# and middleware include the queries of the session and auth middleware.
+QUERY_BUDGETS = {
+    # First check, which enrolls the user
+    'Experiment.test': {'unverified': 1, 'anonymous': 3, 'registered': 3},
+    # Check of an enrolled user
+    'Experiment.test enrolled': {'unverified': 1, 'anonymous': 5,
+                                 'registered': 3},
+    'GoalRecord.record': {'unverified': 0, 'anonymous': 3, 'registered': 0},
+    # Page of the experiment or clientsideexperiment tags of one experiment
+    'experiment page view': {'anonymous': 11, 'registered': 8},
+    # First confirmation, which picks the key of new sessions to tie the
+    # lean_human marker cookie to it
+    'confirm_human view': {'unverified': 4, 'anonymous': 3, 'registered': 3},
+    # Later confirmations, answered from the marker cookie and the session
+    'confirm_human view confirmed': {'unverified': 1, 'anonymous': 1,
+                                     'registered': 1},
+    'record_experiment_goal view': {'unverified': 0, 'anonymous': 4,
+                                    'registered': 1},
+    'TrackRetentionMiddleware': {'anonymous': 0, 'registered': 5},
+    'TrackSigninMiddleware': {'anonymous': 0, 'registered': 7},
+}
+
 def get_session(session_key):
     engine = import_module(settings.SESSION_ENGINE)
     session = engine.SessionStore(session_key)
@@ -33,7 +59,23 @@ def create_user_in_group(experiment, i, group, enrollment_date):
     experiment_participant.save()
     return user
 
-class TestCase(DjangoTestCase):
+class QueryBudgetMixin(object):
+    """
+    Adds the assertQueryBudget context manager to a TestCase, failing when
+    its block runs more queries than QUERY_BUDGETS allows.
+    """
+    @contextmanager
+    def assertQueryBudget(self, operation, user_type):
+        budget = QUERY_BUDGETS[operation][user_type]
+        with QueryCounter() as counter:
+            yield counter
+        if counter.count > budget:
+            self.fail("%s ran %d queries for %s users, over its budget of "
+                      "%d:\n%s" % (operation, counter.count, user_type, budget,
+                                   '\n'.join(q['sql'] for q in counter.queries)))
+
+
+class TestCase(QueryBudgetMixin, DjangoTestCase):
     def _pre_setup(self):
         super(TestCase, self)._pre_setup()
         experiments = getattr(self, 'experiments', [])
@@ -29,5 +29,12 @@ def clientsideexperiment_test(request, experiment_name):
     t = Template(CLIENTSIDEEXPERIMENT_TEMPLATE % {'experiment_name': experiment_name} )
     return HttpResponse(t.render(RequestContext(request)))
 
+def bucket_test(request, experiment_name):
+    """Cacheable version of experiment_test, counting its renders."""
+    bucket_test.renders += 1
+    t = Template(EXPERIMENT_TEMPLATE % {'experiment_name': experiment_name} )
+    return HttpResponse(t.render(RequestContext(request)))
+bucket_test.renders = 0
+
 def dummy404(request):
     return HttpResponse(status=404, content="Not found", content_type="text/plain")
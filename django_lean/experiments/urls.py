@@ -8,5 +8,7 @@ except ImportError:
 
 urlpatterns = patterns('django_lean.experiments.views',
     url(r'^goal/(?P<goal_name>.*)$', 'record_experiment_goal'),
-    url(r'^confirm_human/$', 'confirm_human')
+    url(r'^confirm_human/$', 'confirm_human'),
+    url(r'^assignments/$', 'experiment_assignments'),
+    url(r'^metrics/$', 'metrics_exposition'),
 )
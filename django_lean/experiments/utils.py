@@ -1,10 +1,50 @@
 # -*- coding: utf-8 -*-
+from __future__ import with_statement
+
 import logging
 l = logging.getLogger(__name__)
 
+from datetime import datetime
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+from django_lean.experiments.instrumentation import (count_request_overhead,
+                                                     request_overhead)
 from django_lean.experiments.models import (AnonymousVisitor, Experiment,
                                             Participant)
 
+# Django 1.4 fix
+try:
+    from django.utils.timezone import now
+except ImportError:
+    now = datetime.now
+
+DB_SESSION_ENGINES = ('django.contrib.sessions.backends.db',
+                      'django.contrib.sessions.backends.cached_db')
+
+
+def load_session(session_key):
+    """
+    Returns the data of the session `session_key`, or None if it does not
+    exist or expired. Unlike SessionStore.load(), which saves a new session
+    in that case, it never writes.
+    """
+    if not session_key:
+        return None
+    if settings.SESSION_ENGINE in DB_SESSION_ENGINES:
+        from django.contrib.sessions.models import Session
+        try:
+            session = Session.objects.get(session_key=session_key,
+                                          expire_date__gt=now())
+        except Session.DoesNotExist:
+            return None
+        return session.get_decoded()
+    store = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    if not store.exists(session_key):
+        return None
+    return store.load()
+
 
 class WebUser(object):
     """
@@ -48,6 +88,10 @@ class WebUser(object):
         return anonymous_visitor
 
     def confirm_human(self):
+        with request_overhead():
+            self.__confirm_human()
+
+    def __confirm_human(self):
         self.session['verified_human'] = True
         enrollments = self.session.get('temporary_enrollments', {})
         if not enrollments:
@@ -64,6 +108,7 @@ class WebUser(object):
                 Participant.objects.create(anonymous_visitor=anonymous_visitor,
                                            experiment=experiment,
                                            group=group_id)
+                count_request_overhead('enrollments')
             except:
                 pass
             del self.session['temporary_enrollments'][experiment_name]
@@ -4,15 +4,22 @@ l = logging.getLogger(__name__)
 
 from datetime import date, timedelta
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+                         HttpResponseForbidden)
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
+from django.utils import simplejson
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.views.decorators.cache import never_cache
 
+from django_lean import metrics
 from django_lean.experiments.models import (Experiment, GoalRecord,
-                                            DailyEngagementReport)
+                                            DailyEngagementReport, Participant)
+from django_lean.experiments.ratelimit import allow_goal
 from django_lean.experiments.reports import get_conversion_data
-from django_lean.experiments.utils import WebUser
+from django_lean.experiments.utils import load_session, WebUser
 
 
 experiment_states= {
@@ -32,21 +39,125 @@ TRANSPARENT_1X1_PNG = \
  "\x60\x00\x08\x30\x00\x00\x02\x00\x01\x4f\x6d\x59\xe1\x00\x00\x00"
  "\x00\x49\x45\x4e\x44\xae\x42\x60\x82\x00")
 
+# Marks visitors that confirmed they are human. experiments.js sets it to
+# 'pending' while the confirmation is sent, and the confirm_human view sets
+# it to a marker tied to the session key.
+HUMAN_COOKIE_NAME = 'lean_human'
+HUMAN_SALT = 'django_lean.experiments.views.confirm_human'
+
+def human_marker(session_key):
+    return salted_hmac(HUMAN_SALT, session_key).hexdigest()
+
 @never_cache
 def confirm_human(request):
+    session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    marker = request.COOKIES.get(HUMAN_COOKIE_NAME)
+    if (session_key and marker and
+        constant_time_compare(marker, human_marker(session_key)) and
+        (load_session(session_key) or {}).get('verified_human')):
+        # This session was already confirmed, leave it alone
+        return HttpResponse(status=204)
     experiment_user = WebUser(request)
     experiment_user.confirm_human()
-    return HttpResponse(status=204)
+    # The marker needs the key of new sessions, which SessionMiddleware
+    # saves under it
+    session_key = request.session._get_or_create_session_key()
+    response = HttpResponse(status=204)
+    if settings.SESSION_EXPIRE_AT_BROWSER_CLOSE:
+        max_age = None
+    else:
+        max_age = settings.SESSION_COOKIE_AGE
+    response.set_cookie(HUMAN_COOKIE_NAME,
+                        human_marker(session_key),
+                        max_age=max_age, path='/',
+                        domain=settings.SESSION_COOKIE_DOMAIN)
+    return response
 
 @never_cache
 def record_experiment_goal(request, goal_name):
-    try:
-        GoalRecord.record(goal_name, WebUser(request))
-    except Exception, e:
-        l.warn("unknown goal type '%s': %s" % (goal_name, e))
+    """
+    Records a goal, unless LEAN_GOAL_VIEW_WRITES is False because goals are
+    recorded from the access logs by the ingest_goal_logs command, or the
+    hit is over the rate limits of the ratelimit module.
+    """
+    if not getattr(settings, 'LEAN_GOAL_VIEW_WRITES', True):
+        return HttpResponse(TRANSPARENT_1X1_PNG, content_type="image/png")
+    # Clients can send any session key, so unknown ones are limited by
+    # address
+    session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    session = load_session(session_key)
+    if session is None:
+        visitor = request.META.get('REMOTE_ADDR')
+    else:
+        visitor = session_key
+        if request.session.session_key == session_key:
+            # Spare the session a second lookup
+            request.session._session_cache = session
+    if allow_goal(goal_name, visitor):
+        try:
+            GoalRecord.record(goal_name, WebUser(request))
+        except Exception, e:
+            l.warn("unknown goal type '%s': %s" % (goal_name, e))
     
     return HttpResponse(TRANSPARENT_1X1_PNG, content_type="image/png")
 
+# Upper bound on the experiments of one assignments request
+MAX_ASSIGNMENTS = 50
+
+def experiment_assignments(request):
+    """
+    Returns the groups of the user in the experiments named by the
+    comma-separated `experiments` parameter as a JSON object, e.g.
+    {"experiment_name": "test"}, enrolling the user where needed.
+    Experiments that do not exist are left out.
+
+    The response may be cached privately for LEAN_ASSIGNMENTS_MAX_AGE
+    seconds (60 by default), so that pages served from a shared cache
+    can fetch their client-side experiments with experiments.load().
+    """
+    names = []
+    for value in request.GET.getlist('experiments'):
+        for name in value.split(','):
+            name = name.strip()
+            if name and name not in names:
+                names.append(name)
+    if len(names) > MAX_ASSIGNMENTS:
+        return HttpResponseBadRequest("At most %d experiments can be "
+                                      "requested at once" % MAX_ASSIGNMENTS)
+    assignments = {}
+    if names:
+        experiment_user = WebUser(request)
+        existing = Experiment.objects.filter(name__in=names)
+        for name in existing.values_list('name', flat=True):
+            if Experiment.group(name, experiment_user) == Participant.TEST_GROUP:
+                assignments[name] = "test"
+            else:
+                assignments[name] = "control"
+    response = HttpResponse(simplejson.dumps(assignments),
+                            content_type='application/json')
+    patch_cache_control(response, private=True,
+                        max_age=getattr(settings, 'LEAN_ASSIGNMENTS_MAX_AGE',
+                                        60))
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+@never_cache
+def metrics_exposition(request):
+    """
+    Exposes the metrics in the Prometheus text format, if
+    LEAN_METRICS_EXPOSITION is set, to staff members and to the addresses
+    listed in LEAN_METRICS_ALLOWED_IPS, like those of scrapers.
+    """
+    if not getattr(settings, 'LEAN_METRICS_EXPOSITION', False):
+        raise Http404
+    user = getattr(request, 'user', None)
+    if (request.META.get('REMOTE_ADDR') not in
+        getattr(settings, 'LEAN_METRICS_ALLOWED_IPS', ()) and
+        not (user is not None and user.is_active and user.is_staff)):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.registry.exposition(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
 def list_experiments(request, template_name='experiments/list_experiments.html'):
     """docstring for list_experiments"""
     context_var = {"experiments": Experiment.objects.order_by("-start_date"),
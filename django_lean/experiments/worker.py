@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import logging
+l = logging.getLogger(__name__)
+
+from datetime import timedelta
+from time import sleep
+
+from django.db import transaction
+from django.db.models import Max
+
+from django_lean.experiments.models import Experiment, ReportWorkUnit
+
+# Django 1.6 fix
+atomic = getattr(transaction, 'atomic', None) or transaction.commit_on_success
+
+ONE_DAY = timedelta(days=1)
+
+
+class ReportWorker(object):
+    """
+    Generates daily reports from a durable queue of ReportWorkUnits.
+
+    Each closed day of each experiment is enqueued once per report type,
+    and a unit is marked as done in the same transaction that stores its
+    report, so a worker that gets killed resumes where it left off.
+    """
+    def __init__(self, generators, max_attempts=3):
+        """
+        `generators` maps report type names to report generators.
+        """
+        self.generators = generators
+        self.max_attempts = max_attempts
+
+    def enqueue(self):
+        """
+        Adds work units for the days that closed since the last unit of
+        each experiment and report type. Days which already have a report
+        are enqueued as done. Returns the number of pending units added.
+        """
+        added = 0
+        experiments = Experiment.objects.filter(start_date__isnull=False)
+        for experiment in experiments:
+            for report_type, generator in self.generators.items():
+                units = ReportWorkUnit.objects.filter(experiment=experiment,
+                                                      report_type=report_type)
+                current_date, end_date = generator.report_dates(experiment)
+                last_date = units.aggregate(Max('date'))['date__max']
+                if last_date is not None:
+                    current_date = max(current_date, last_date + ONE_DAY)
+                if current_date > end_date:
+                    continue
+                existing = set(generator.report_model_class.objects.filter(
+                    experiment=experiment,
+                    date__range=(current_date, end_date)
+                ).values_list('date', flat=True))
+                while current_date <= end_date:
+                    if current_date in existing:
+                        state = ReportWorkUnit.DONE_STATE
+                    else:
+                        state = ReportWorkUnit.PENDING_STATE
+                        added += 1
+                    ReportWorkUnit.objects.create(experiment=experiment,
+                                                  report_type=report_type,
+                                                  date=current_date,
+                                                  state=state)
+                    current_date += ONE_DAY
+        return added
+
+    def process(self):
+        """
+        Generates the reports of all pending units, oldest day first.
+        Returns the number of units processed.
+        """
+        units = ReportWorkUnit.objects.filter(
+            state=ReportWorkUnit.PENDING_STATE
+        ).select_related('experiment').order_by('date', 'id')
+        processed = 0
+        for unit in units:
+            self.process_unit(unit)
+            processed += 1
+        return processed
+
+    def process_unit(self, unit):
+        generator = self.generators.get(unit.report_type)
+        unit.attempts += 1
+        try:
+            if generator is None:
+                raise ValueError("Unknown report type %s" % unit.report_type)
+            with atomic():
+                if not generator.report_model_class.objects.filter(
+                    experiment=unit.experiment, date=unit.date).count():
+                    generator.generate_report(experiment=unit.experiment,
+                                              report_date=unit.date)
+                unit.state = ReportWorkUnit.DONE_STATE
+                unit.save()
+        except Exception:
+            l.exception("Failed to generate report %s (attempt %d)" %
+                        (unit, unit.attempts))
+            if unit.attempts >= self.max_attempts:
+                unit.state = ReportWorkUnit.FAILED_STATE
+            unit.save()
+
+    def run(self, interval, iterations=None):
+        """
+        Enqueues and processes work every `interval` seconds, forever or
+        for the given number of `iterations`.
+        """
+        while iterations is None or iterations > 0:
+            added = self.enqueue()
+            processed = self.process()
+            l.info("Enqueued %d and processed %d report units" %
+                   (added, processed))
+            if iterations is not None:
+                iterations -= 1
+                if not iterations:
+                    break
+            sleep(interval)
@@ -1,3 +1,7 @@
+from __future__ import with_statement
+
+from threading import Lock
+
 from django.conf import settings
 from django.core.urlresolvers import get_callable
 
@@ -9,12 +13,43 @@ class IdentificationError(RuntimeError):
 def get_all_analytics_names():
     return getattr(settings, 'LEAN_ANALYTICS', ())
 
+_lock = Lock()
+
 def get_all_analytics():
-    if get_all_analytics.cache is None:
-        names = get_all_analytics_names()
-        get_all_analytics.cache = [get_callable(a)() for a in names]
-    return get_all_analytics.cache
+    """
+    Returns the analytics backends of LEAN_ANALYTICS. They are shared by
+    all threads, so they must not keep per-request state.
+    """
+    analytics = get_all_analytics.cache
+    if analytics is None:
+        with _lock:
+            if get_all_analytics.cache is None:
+                get_all_analytics.cache = _load_analytics()
+            analytics = get_all_analytics.cache
+    return analytics
+
+def _load_analytics():
+    names = get_all_analytics_names()
+    analytics = [get_callable(a)() for a in names]
+    all_async = getattr(settings, 'LEAN_ANALYTICS_ASYNC', False)
+    if all_async or [a for a in analytics if getattr(a, 'batch_size', None)]:
+        from django_lean.lean_analytics.dispatch import AsyncAnalytics
+        # Batches are always submitted by the worker, rather than by the
+        # request filling them.
+        analytics = [
+            AsyncAnalytics(
+                a,
+                queue_size=getattr(settings, 'LEAN_ANALYTICS_QUEUE_SIZE', 1000),
+                timeout=getattr(settings, 'LEAN_ANALYTICS_QUEUE_TIMEOUT', 0)
+            ) if all_async or getattr(a, 'batch_size', None) else a
+            for a in analytics
+        ]
+    return analytics
 
 def reset_caches():
-    get_all_analytics.cache = None
+    with _lock:
+        for analytics in getattr(get_all_analytics, 'cache', None) or ():
+            if hasattr(analytics, 'stop'):
+                analytics.stop()
+        get_all_analytics.cache = None
 reset_caches()
@@ -1,9 +1,97 @@
+from __future__ import with_statement
+
+import logging
+l = logging.getLogger(__name__)
+
+import atexit
+import sys
+from random import random
+from threading import Lock, Thread
+from time import time
+
+from django.conf import settings
+
+from django_lean import metrics
 from django_lean.experiments.models import Participant
 from django_lean.experiments.utils import WebUser
 from django_lean.lean_analytics import IdentificationError
+from django_lean.lean_analytics.breaker import CircuitBreaker
+from django_lean.utils import in_sample
 
 
 class BaseAnalytics(object):
+    """
+    Base class of the analytics backends, which implement _submit() to
+    send an event.
+
+    Backends with supports_batches set implement _prepare_event() and
+    _submit_batch() instead, and their events are sent in batches of
+    LEAN_ANALYTICS_BATCH_SIZE, or of those queued over
+    LEAN_ANALYTICS_BATCH_INTERVAL seconds (10 by default). Batching is off
+    when LEAN_ANALYTICS_BATCH_SIZE is not set. The batching backends of
+    LEAN_ANALYTICS are always wrapped in an AsyncAnalytics, whose worker
+    submits the batches and flushes them when idle. The last batch is
+    flushed when the process exits. Backends limiting the size of their
+    requests set max_batch_size: batches are then submitted, and fall back
+    when they fail, in chunks of that size.
+
+    Calls to the backends go through a circuit breaker, which opens after
+    LEAN_ANALYTICS_BREAKER_FAILURES (5 by default) failed calls or calls
+    slower than `timeout`, LEAN_ANALYTICS_TIMEOUT seconds (5 by default).
+    Backends pass `timeout` to their network calls, so that slow services
+    raise errors. Backends whose client cannot time out set
+    threaded_calls: their calls run in a separate thread, which the caller
+    stops waiting for after `timeout`. Failed events, including those of
+    calls that timed out, are skipped, or spooled if
+    LEAN_ANALYTICS_FALLBACK_SPOOL is set; so are the events sent while the
+    breaker is open, for LEAN_ANALYTICS_BREAKER_RESET seconds (30 by
+    default).
+
+    LEAN_ANALYTICS_SAMPLE_RATES maps event names to the fraction (0 to 1)
+    of visitors whose events are sent. Visitors are sampled by their user
+    or session key, so each one has all or none of the events of a name;
+    the events of new visitors, whose session has no key yet, are sampled
+    one by one.
+    LEAN_ANALYTICS_ALLOWED_PROPERTIES maps event names to the properties
+    that are sent, the '*' entry applying to the other events. Both are
+    applied before the events are queued or batched.
+    """
+    supports_batches = False
+    threaded_calls = False
+    batch_size = None
+    max_batch_size = None
+    sample_rates = {}
+    allowed_properties = None
+    _breaker = None
+
+    def __init__(self, batch_size=None, batch_interval=None, timeout=None):
+        if timeout is None:
+            timeout = getattr(settings, 'LEAN_ANALYTICS_TIMEOUT', 5)
+        self.timeout = timeout
+        self._breaker = CircuitBreaker(
+            self.__class__.__name__,
+            failure_threshold=getattr(settings,
+                                      'LEAN_ANALYTICS_BREAKER_FAILURES', 5),
+            reset_timeout=getattr(settings, 'LEAN_ANALYTICS_BREAKER_RESET', 30))
+        self.sample_rates = getattr(settings, 'LEAN_ANALYTICS_SAMPLE_RATES',
+                                    {})
+        self.allowed_properties = getattr(
+            settings, 'LEAN_ANALYTICS_ALLOWED_PROPERTIES', None)
+        if self.supports_batches:
+            if batch_size is None:
+                batch_size = getattr(settings, 'LEAN_ANALYTICS_BATCH_SIZE',
+                                     None)
+            if batch_interval is None:
+                batch_interval = getattr(settings,
+                                         'LEAN_ANALYTICS_BATCH_INTERVAL', 10)
+            self.batch_size = batch_size
+            self.batch_interval = batch_interval
+            self._batch = []
+            self._batch_started = None
+            self._batch_lock = Lock()
+            if batch_size:
+                atexit.register(self.flush)
+
     def _id_from_session(self, session):
         try:
             return 'Session %s' % session.session_key
@@ -22,19 +110,227 @@ class BaseAnalytics(object):
         return self._id_from_session(experiment_user.session)
 
     def enroll(self, experiment, experiment_user, group_id):
-        self._submit(name='Enrolled In Experiment',
-                     properties={'Experiment': unicode(experiment),
-                                 'Group': dict(Participant.GROUPS)[group_id]},
-                     experiment_user=experiment_user)
+        self._dispatch(name='Enrolled In Experiment',
+                       properties={'Experiment': unicode(experiment),
+                                   'Group': dict(Participant.GROUPS)[group_id]},
+                       experiment_user=experiment_user)
 
     def record(self, goal_record, experiment_user):
-        self._submit(name='Goal Recorded',
-                     properties={'Goal Type': unicode(goal_record.goal_type)},
-                     experiment_user=experiment_user)
+        self._dispatch(name='Goal Recorded',
+                       properties={'Goal Type': unicode(goal_record.goal_type)},
+                       experiment_user=experiment_user)
 
     def event(self, name, properties, request=None):
         if request:
-            self._submit(name, properties, experiment_user=WebUser(request))
+            self._dispatch(name, properties, experiment_user=WebUser(request))
+
+    def _filter(self, name, properties, experiment_user=None):
+        """
+        Returns the allowed `properties` of the event, or None if it is
+        sampled out.
+        """
+        rate = self.sample_rates.get(name)
+        if rate is not None and experiment_user is not None:
+            key = self._sample_key(experiment_user)
+            if key is None:
+                sampled = random() < rate
+            else:
+                sampled = in_sample(key, rate)
+            if not sampled:
+                metrics.increment('analytics_events_sampled_out_total',
+                                  backend=self.__class__.__name__)
+                return None
+        if self.allowed_properties is not None:
+            allowed = self.allowed_properties.get(
+                name, self.allowed_properties.get('*'))
+            if allowed is not None:
+                properties = dict((key, value) for key, value
+                                  in properties.iteritems() if key in allowed)
+        return properties
+
+    def _sample_key(self, experiment_user):
+        """
+        Returns the key sampling the events of `experiment_user`, or None
+        if it has none yet.
+        """
+        if not experiment_user.is_anonymous():
+            pk = getattr(experiment_user.user, 'pk', None)
+            if pk is not None:
+                return 'User %s' % pk
+        session_key = getattr(getattr(experiment_user, 'session', None),
+                              'session_key', None)
+        if session_key:
+            return 'Session %s' % session_key
+        return None
+
+    def _dispatch(self, name, properties, experiment_user=None):
+        """Filters the event, and sends it."""
+        properties = self._filter(name, properties,
+                                  experiment_user=experiment_user)
+        if properties is not None:
+            self._send(name, properties, experiment_user=experiment_user)
+
+    def _send(self, name, properties, experiment_user=None):
+        """Submits the event, or adds it to the current batch."""
+        if not self.batch_size:
+            if not self._call(self._submit, name, properties,
+                              experiment_user=experiment_user):
+                self._fallback(name, properties, experiment_user)
+            return
+        event = self._prepare_event(name, properties,
+                                    experiment_user=experiment_user)
+        if event is None:
+            return
+        now = time()
+        with self._batch_lock:
+            if not self._batch:
+                self._batch_started = now
+            # The event is kept as it was dispatched, for the fallback
+            self._batch.append((event, (name, properties, experiment_user)))
+            if (len(self._batch) < self.batch_size and
+                now - self._batch_started < self.batch_interval):
+                return
+            batch, self._batch = self._batch, []
+        self._submit_batch_safely(batch)
+
+    def flush(self):
+        """Submits the current batch of events, if any."""
+        if not self.batch_size:
+            return
+        with self._batch_lock:
+            batch, self._batch = self._batch, []
+        if batch:
+            self._submit_batch_safely(batch)
+
+    def _submit_batch_safely(self, batch):
+        size = self.max_batch_size or len(batch)
+        dropped = 0
+        for i in range(0, len(batch), size):
+            chunk = batch[i:i + size]
+            if self._call(self._submit_batch, [event for event, dispatched
+                                               in chunk]):
+                continue
+            # Only the events of failed chunks fall back
+            for event, dispatched in chunk:
+                if not self._fallback(*dispatched):
+                    dropped += 1
+        if dropped:
+            metrics.increment('analytics_events_dropped_total', dropped,
+                              backend=self.__class__.__name__)
+
+    def _deliver(self, events):
+        """
+        Submits `events`, a list of (name, properties, experiment_user),
+        right away. Unlike _dispatch(), errors are raised rather than
+        handled by the circuit breaker; this is how spooled events are
+        replayed.
+        """
+        filtered = []
+        for name, properties, experiment_user in events:
+            properties = self._filter(name, properties,
+                                      experiment_user=experiment_user)
+            if properties is not None:
+                filtered.append((name, properties, experiment_user))
+        if not self.supports_batches:
+            for name, properties, experiment_user in filtered:
+                self._submit(name, properties, experiment_user=experiment_user)
+            return
+        batch = [self._prepare_event(name, properties,
+                                     experiment_user=experiment_user)
+                 for name, properties, experiment_user in filtered]
+        batch = [event for event in batch if event is not None]
+        if batch:
+            self._submit_batch(batch)
+
+    def _event_time(self, experiment_user):
+        """
+        Returns the time of an event that happened before it was
+        dispatched, such as a spooled one, or None.
+        """
+        return getattr(experiment_user, 'event_time', None)
+
+    def _call(self, method, *args, **kwargs):
+        """
+        Calls `method` through the circuit breaker. Returns False if the
+        call was skipped, failed, or timed out. With threaded_calls, the
+        caller waits at most `timeout` seconds for `method`.
+        """
+        breaker = self._breaker
+        if breaker is None:
+            method(*args, **kwargs)
+            return True
+        if not breaker.allow():
+            metrics.increment('analytics_calls_skipped_total',
+                              backend=breaker.name)
+            return False
+        start = time()
+        if self.threaded_calls and self.timeout:
+            outcome = self._call_in_thread(method, *args, **kwargs)
+        else:
+            try:
+                method(*args, **kwargs)
+            except Exception:
+                outcome = [sys.exc_info()]
+            else:
+                outcome = [None]
+        if not outcome:
+            metrics.increment('analytics_calls_timed_out_total',
+                              backend=breaker.name)
+            l.warning("Analytics backend %s timed out after %.3fs" %
+                      (breaker.name, self.timeout))
+            breaker.failure()
+            return False
+        if outcome[0] is not None:
+            l.error("Analytics backend %s failed" % breaker.name,
+                    exc_info=outcome[0])
+            breaker.failure()
+            return False
+        if self.timeout and time() - start > self.timeout:
+            # The event was sent, but the service is too slow
+            breaker.failure()
+        else:
+            breaker.success()
+        return True
+
+    def _call_in_thread(self, method, *args, **kwargs):
+        """
+        Calls `method` in a daemon thread, waiting at most `timeout`
+        seconds for it. Returns a list holding None or the exc_info of its
+        error, which is empty if it timed out.
+        """
+        outcome = []
+        def call():
+            try:
+                method(*args, **kwargs)
+            except Exception:
+                outcome.append(sys.exc_info())
+            else:
+                outcome.append(None)
+        thread = Thread(target=call, name='%s call' % self._breaker.name)
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(self.timeout)
+        return outcome
+
+    def _fallback(self, name, properties, experiment_user=None):
+        """
+        Spools an event that could not be submitted, if enabled. Returns
+        whether it was spooled.
+        """
+        if getattr(settings, 'LEAN_ANALYTICS_FALLBACK_SPOOL', False):
+            from django_lean.lean_analytics.spool import spool_event
+            return spool_event(self, name, properties, experiment_user)
+        return False
 
     def _submit(self, name, properties, experiment_user=None):
         raise NotImplementedError()
+
+    def _prepare_event(self, name, properties, experiment_user=None):
+        """
+        Returns the event as it is sent in batches, or None if it should
+        not be sent.
+        """
+        raise NotImplementedError()
+
+    def _submit_batch(self, events):
+        raise NotImplementedError()
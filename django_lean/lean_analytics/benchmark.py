@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Load harness measuring the latency added to requests by the analytics
+backends, in each dispatch mode.
+"""
+from __future__ import with_statement
+
+import logging
+l = logging.getLogger(__name__)
+
+from contextlib import contextmanager
+from math import ceil
+from time import time
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.base import SessionBase
+from django.http import HttpRequest
+
+from django_lean.experiments.models import (Experiment, GoalRecord, GoalType,
+                                            Participant)
+from django_lean.experiments.signals import goal_recorded, user_enrolled
+from django_lean.experiments.utils import WebUser
+from django_lean.lean_analytics import get_all_analytics, reset_caches
+# Connects the signal handlers sending the events to the backends
+from django_lean.lean_analytics import models
+
+
+LOCAL_ANALYTICS = 'django_lean.lean_analytics.local.LocalAnalytics'
+
+# Settings of each dispatch mode, on top of those of the baseline. Batches
+# are always submitted by the worker of an AsyncAnalytics.
+MODES = (
+    ('sync', {}),
+    ('async', {'LEAN_ANALYTICS_ASYNC': True}),
+    ('batched', {'LEAN_ANALYTICS_BATCH_SIZE': 50}),
+)
+CALLS = ('enroll', 'record', 'event')
+
+
+@contextmanager
+def override_settings(**values):
+    """Sets the `values` settings, and the analytics backends they make."""
+    missing = object()
+    originals = dict((name, getattr(settings, name, missing))
+                     for name in values)
+    for name, value in values.items():
+        setattr(settings, name, value)
+    reset_caches()
+    try:
+        yield
+    finally:
+        reset_caches()
+        for name, value in originals.items():
+            if value is missing:
+                delattr(settings, name)
+            else:
+                setattr(settings, name, value)
+
+
+class AnalyticsBenchmarkResult(object):
+    def __init__(self, mode, call, baseline=None):
+        self.mode = mode
+        self.call = call
+        self.baseline = baseline
+        self.durations = []
+
+    def percentile(self, percent):
+        """Returns the nearest-rank `percent` percentile of the durations."""
+        values = sorted(self.durations)
+        rank = int(ceil(percent / 100. * len(values)))
+        return values[max(rank - 1, 0)]
+
+    def added(self):
+        """Returns the median latency added to the baseline."""
+        if self.baseline is None:
+            return 0.0
+        return self.percentile(50) - self.baseline.percentile(50)
+
+    def __unicode__(self):
+        return ('%-14s %-7s %6d   p50 %8.3fms  p90 %8.3fms  p99 %8.3fms'
+                '   added %8.3fms' % (
+                self.mode, self.call, len(self.durations),
+                self.percentile(50) * 1000, self.percentile(90) * 1000,
+                self.percentile(99) * 1000, self.added() * 1000))
+
+
+class AnalyticsBenchmark(object):
+    """
+    Pushes `iterations` enroll, record and event calls through the signal
+    handlers of lean_analytics.models to a LocalAnalytics backend waiting
+    `latency` seconds per submission, in each dispatch mode, and measures
+    how long the callers wait compared to having no backend.
+
+    It does not use the database, and reports how many events reached the
+    backend and how long the queued ones took to drain.
+    """
+    def __init__(self, iterations=1000, latency=0.001, modes=MODES):
+        self.iterations = iterations
+        self.latency = latency
+        self.modes = modes
+        self.experiment = Experiment(name='benchmark-analytics')
+        self.goal_record = GoalRecord(
+            goal_type=GoalType(name='benchmark-analytics-goal'))
+
+    def web_user(self, i):
+        request = HttpRequest()
+        request.user = AnonymousUser()
+        request.session = SessionBase('benchmark%d' % i)
+        request.META['REMOTE_ADDR'] = '127.0.0.1'
+        return WebUser(request)
+
+    def call(self, call, experiment_user):
+        if call == 'enroll':
+            user_enrolled.send(sender=Participant, experiment=self.experiment,
+                               experiment_user=experiment_user,
+                               group_id=Participant.TEST_GROUP)
+        elif call == 'record':
+            goal_recorded.send(sender=GoalRecord, goal_record=self.goal_record,
+                               experiment_user=experiment_user)
+        else:
+            for analytics in get_all_analytics():
+                analytics.event('Benchmark Event', {'Call': 'event'},
+                                request=experiment_user.request)
+
+    def measure(self, mode, baselines=None):
+        results = []
+        for call in CALLS:
+            result = AnalyticsBenchmarkResult(
+                mode, call, baselines and baselines[call])
+            for i in range(self.iterations):
+                experiment_user = self.web_user(i)
+                start = time()
+                self.call(call, experiment_user)
+                result.durations.append(time() - start)
+            results.append(result)
+        return results
+
+    def drain(self):
+        """
+        Waits for the events to reach the backend. Returns their number and
+        the time it took.
+        """
+        start = time()
+        analytics = get_all_analytics()[0]
+        backend = getattr(analytics, 'analytics', analytics)
+        if hasattr(analytics, 'join'):
+            analytics.join()
+            self.workers.append(analytics.thread)
+        backend.flush()
+        return backend.count, time() - start
+
+    def run(self):
+        """
+        Returns a list of AnalyticsBenchmarkResults, and a dict of the
+        number of delivered events and drain time of each mode.
+        """
+        with override_settings(LEAN_ANALYTICS=[],
+                               LEAN_ANALYTICS_FOR_EXPERIMENTS=True):
+            results = self.measure('baseline')
+        baselines = dict((result.call, result) for result in results)
+        delivered = {}
+        self.workers = []
+        for mode, values in self.modes:
+            values = dict(values)
+            values.setdefault('LEAN_ANALYTICS_ASYNC', False)
+            values.setdefault('LEAN_ANALYTICS_BATCH_SIZE', None)
+            with override_settings(LEAN_ANALYTICS=[LOCAL_ANALYTICS],
+                                   LEAN_ANALYTICS_FOR_EXPERIMENTS=True,
+                                   LEAN_ANALYTICS_LOCAL_LATENCY=self.latency,
+                                   LEAN_ANALYTICS_QUEUE_SIZE=len(CALLS) *
+                                                             self.iterations,
+                                   **values):
+                results.extend(self.measure(mode, baselines))
+                delivered[mode] = self.drain()
+                l.info("%s: %d events delivered, drained in %.3fs" %
+                       ((mode,) + delivered[mode]))
+        # Let the stopped workers exit before the interpreter does
+        for worker in self.workers:
+            if worker is not None:
+                worker.join()
+        return results, delivered
@@ -0,0 +1,63 @@
+"""
+Circuit breaker keeping a failing analytics backend from slowing down
+every request that sends it an event.
+"""
+from __future__ import with_statement
+
+import logging
+l = logging.getLogger(__name__)
+
+from threading import Lock
+from time import time
+
+from django_lean import metrics
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `failure_threshold` consecutive failures, so that calls are
+    skipped. After `reset_timeout` seconds, one call is let through: the
+    breaker closes if it succeeds, and opens again otherwise.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = None
+        self._lock = Lock()
+
+    def allow(self):
+        """Returns whether a call may be made."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if (self.state == self.OPEN and
+                time() - self.opened >= self.reset_timeout):
+                # Let one trial call through
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                self.state == self.CLOSED and
+                self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened = time()
+                metrics.increment('analytics_circuit_trips_total',
+                                  backend=self.name)
+                l.warning("Circuit of %s opened after %d failures" %
+                          (self.name, self.failures))
@@ -0,0 +1,156 @@
+"""
+Asynchronous dispatch of analytics events, so that the requests sending
+them do not wait for the remote analytics services.
+
+Set LEAN_ANALYTICS_ASYNC to True to wrap each backend of LEAN_ANALYTICS
+in an AsyncAnalytics. Each one queues up to LEAN_ANALYTICS_QUEUE_SIZE
+events (1000 by default), submitted by a worker thread. When the queue is
+full, events are dropped after waiting LEAN_ANALYTICS_QUEUE_TIMEOUT
+seconds (0 by default). Backends sending batches are always wrapped.
+"""
+from __future__ import with_statement
+
+import logging
+l = logging.getLogger(__name__)
+
+import atexit
+from Queue import Empty, Full, Queue
+from threading import Lock, Thread
+
+from django_lean import metrics
+from django_lean.lean_analytics.base import BaseAnalytics
+
+
+class FrozenSession(object):
+    def __init__(self, session_key):
+        self.session_key = session_key
+
+
+class FrozenRequest(object):
+    def __init__(self, remote_addr):
+        self.META = {}
+        if remote_addr:
+            self.META['REMOTE_ADDR'] = remote_addr
+
+
+class SnapshotUser(object):
+    """
+    The parts of an experiment user that identify it to the analytics
+    backends, as they were when the event was queued: the user, the
+    session key and the remote address.
+    """
+    def __init__(self, experiment_user):
+        self.anonymous = experiment_user.is_anonymous()
+        self.user = experiment_user.user
+        session = experiment_user.session
+        if hasattr(session, 'session_key'):
+            session = FrozenSession(session.session_key)
+        self.session = session
+        self.request = None
+        meta = getattr(experiment_user.request, 'META', None)
+        if meta is not None:
+            self.request = FrozenRequest(meta.get('REMOTE_ADDR'))
+
+    def is_anonymous(self):
+        return self.anonymous
+
+
+class AsyncAnalytics(BaseAnalytics):
+    """
+    Queues the events of the `analytics` backend, which a worker thread
+    submits to it.
+    """
+    def __init__(self, analytics, queue_size=1000, timeout=0):
+        self.analytics = analytics
+        self.queue = Queue(queue_size)
+        self.timeout = timeout
+        self.thread = None
+        self._lock = Lock()
+        self._registered = False
+
+    @property
+    def name(self):
+        return self.analytics.__class__.__name__
+
+    def _filter(self, name, properties, experiment_user=None):
+        # Drop events before they are queued
+        return self.analytics._filter(name, properties,
+                                      experiment_user=experiment_user)
+
+    def _submit(self, name, properties, experiment_user=None):
+        if self.thread is None:
+            self.start()
+        if experiment_user is not None:
+            experiment_user = SnapshotUser(experiment_user)
+        event = (name, dict(properties), experiment_user)
+        try:
+            if self.timeout:
+                self.queue.put(event, timeout=self.timeout)
+            else:
+                self.queue.put_nowait(event)
+        except Full:
+            metrics.increment('analytics_events_dropped_total',
+                              backend=self.name)
+            l.warning("Dropped analytics event %s, the queue of %s is full" %
+                      (name, self.name))
+
+    def run(self):
+        while True:
+            try:
+                event = self.queue.get(
+                    timeout=getattr(self.analytics, 'batch_interval', None))
+            except Empty:
+                # Submit the batch of the backend while the queue is idle
+                self.flush()
+                continue
+            try:
+                if event is None:
+                    self.analytics.flush()
+                    return
+                name, properties, experiment_user = event
+                self.analytics._send(name, properties,
+                                     experiment_user=experiment_user)
+            except Exception:
+                l.exception("Could not submit analytics event to %s" %
+                            self.name)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        try:
+            self.analytics.flush()
+        except Exception:
+            l.exception("Could not submit analytics events to %s" % self.name)
+
+    def start(self):
+        with self._lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.run,
+                                     name='AsyncAnalytics %s' % self.name)
+                self.thread.setDaemon(True)
+                self.thread.start()
+                if not self._registered:
+                    # Submit the queued events when the process exits
+                    atexit.register(self.close)
+                    self._registered = True
+
+    def join(self):
+        """Waits until the queued events were submitted."""
+        self.queue.join()
+
+    def stop(self):
+        """Stops the worker once the queued events were submitted."""
+        with self._lock:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread = None
+
+    def close(self, timeout=10):
+        """
+        Stops the worker, waiting up to `timeout` seconds for it to submit
+        the queued events.
+        """
+        thread = self.thread
+        self.stop()
+        if thread is not None:
+            thread.join(timeout)
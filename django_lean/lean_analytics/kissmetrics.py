@@ -1,3 +1,5 @@
+from copy import copy
+
 from django_kissmetrics.middleware import TrackingMiddleware
 
 from django_lean.lean_analytics import IdentificationError
@@ -5,9 +7,16 @@ from django_lean.lean_analytics.base import BaseAnalytics
 
 
 class KissMetrics(BaseAnalytics):
+    # The KISSmetrics API identifies the user before each event
+    supports_batches = False
+    # The KM client has no timeout
+    threaded_calls = True
+
     def __init__(self, KM=None, middleware=None):
+        BaseAnalytics.__init__(self)
         if middleware is None:
-            self.middleware = TrackingMiddleware()
+            middleware = TrackingMiddleware()
+        self.middleware = middleware
         if KM is None:
             KM = self.middleware.KM
         self.KM = KM
@@ -27,13 +36,27 @@ class KissMetrics(BaseAnalytics):
             raise IdentificationError(e)
 
     def _identify(self, experiment_user):
+        """Returns the identity of `experiment_user`, or None."""
         try:
-            self.KM.identify(self._compute_id(experiment_user))
-            return True
+            return self._compute_id(experiment_user)
         except IdentificationError:
             # Ignore experiment_users who cannot be tied to sessions or users
-            return False
+            return None
+
+    def _client(self):
+        """
+        Returns a KM client for a single event. The KM client holds the
+        identity of the next event, so threads cannot share one.
+        """
+        return copy(self.KM)
 
     def _submit(self, name, properties, experiment_user=None):
-        if self._identify(experiment_user):
-            self.KM.record(action=name, props=properties)
+        identity = self._identify(experiment_user)
+        if identity is not None:
+            client = self._client()
+            client.identify(identity)
+            event_time = self._event_time(experiment_user)
+            if event_time is not None:
+                # Record the event at the time it happened
+                properties = dict(properties, _t=int(event_time), _d=1)
+            client.record(action=name, props=properties)
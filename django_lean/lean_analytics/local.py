@@ -0,0 +1,88 @@
+"""
+Analytics backend recording the events locally, to measure the overhead of
+analytics without calling remote services.
+
+Add LocalAnalytics to LEAN_ANALYTICS to keep the last
+LEAN_ANALYTICS_LOCAL_MAX_EVENTS events (10000 by default) in memory.
+When LEAN_ANALYTICS_LOCAL_ADDRESS is set, as 'host:port' or as the path
+of a Unix socket, each event is also sent to it as a JSON datagram. Each
+submission waits LEAN_ANALYTICS_LOCAL_LATENCY seconds (0 by default), to
+simulate a remote service.
+"""
+from __future__ import with_statement
+
+import socket
+from collections import deque
+from threading import Lock
+from time import sleep, time
+
+from django.conf import settings
+from django.utils import simplejson
+
+from django_lean.lean_analytics import IdentificationError
+from django_lean.lean_analytics.base import BaseAnalytics
+
+
+def parse_address(address):
+    """Returns the socket family and address of `address`."""
+    if ':' in address and not address.startswith('/'):
+        host, port = address.rsplit(':', 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+
+class LocalAnalytics(BaseAnalytics):
+    supports_batches = True
+
+    def __init__(self, latency=None, address=None, max_events=None,
+                 **kwargs):
+        BaseAnalytics.__init__(self, **kwargs)
+        if latency is None:
+            latency = getattr(settings, 'LEAN_ANALYTICS_LOCAL_LATENCY', 0)
+        if address is None:
+            address = getattr(settings, 'LEAN_ANALYTICS_LOCAL_ADDRESS', None)
+        if max_events is None:
+            max_events = getattr(settings, 'LEAN_ANALYTICS_LOCAL_MAX_EVENTS',
+                                 10000)
+        self.latency = latency
+        self.events = deque(maxlen=max_events)
+        self.count = 0
+        self.socket = None
+        if address:
+            family, self.address = parse_address(address)
+            self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self._lock = Lock()
+
+    def _prepare_event(self, name, properties, experiment_user=None):
+        identity = None
+        if experiment_user is not None:
+            try:
+                identity = self._compute_id(experiment_user)
+            except IdentificationError:
+                pass
+        return {'event': name, 'properties': dict(properties),
+                'distinct_id': identity,
+                'time': self._event_time(experiment_user) or time()}
+
+    def _submit(self, name, properties, experiment_user=None):
+        self._submit_batch([self._prepare_event(name, properties,
+                                                experiment_user)])
+
+    def _submit_batch(self, events):
+        if self.latency:
+            sleep(self.latency)
+        with self._lock:
+            self.events.extend(events)
+            self.count += len(events)
+        if self.socket is not None:
+            for event in events:
+                self.socket.sendto(simplejson.dumps(event), self.address)
+
+    def clear(self):
+        with self._lock:
+            self.events.clear()
+            self.count = 0
+
+    def stop(self):
+        if self.socket is not None:
+            self.socket.close()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import logging
+l = logging.getLogger(__name__)
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_lean.lean_analytics.benchmark import AnalyticsBenchmark, MODES
+
+
+class Command(BaseCommand):
+    help = ('benchmark_analytics : Measure the latency added by analytics '
+            'events in the sync, async and batched dispatch modes, with a '
+            'local backend')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--iterations', type='int', default=1000,
+            help='Number of enroll, record and event calls in each mode.'
+        ),
+        make_option(
+            '--latency', type='float', default=0.001, metavar='SECONDS',
+            help='Latency of each submission to the local backend.'
+        ),
+        make_option(
+            '--mode', action='append', dest='modes', metavar='MODE',
+            help=('Only measure MODE; may be given several times. One of %s.'
+                  % '/'.join(name for name, values in MODES))
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if len(args):
+            raise CommandError("This command does not take any arguments")
+        modes = MODES
+        if options.get('modes'):
+            modes = [mode for mode in MODES if mode[0] in options['modes']]
+            unknown = set(options['modes']) - set(name for name, values
+                                                  in modes)
+            if unknown:
+                raise CommandError("Unknown modes: %s" %
+                                   ', '.join(sorted(unknown)))
+        benchmark = AnalyticsBenchmark(iterations=options['iterations'],
+                                       latency=options['latency'],
+                                       modes=modes)
+        results, delivered = benchmark.run()
+        for result in results:
+            print unicode(result)
+        for name, values in modes:
+            count, duration = delivered[name]
+            print '%-14s %6d events delivered, drained in %.3fs' % (
+                name, count, duration)
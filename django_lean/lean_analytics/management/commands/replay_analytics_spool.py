@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import logging
+l = logging.getLogger(__name__)
+
+import os
+from fcntl import LOCK_EX
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import get_callable
+
+from django_lean.lean_analytics.spool import SpoolReplayer
+from django_lean.lockfile import lockfile
+
+
+class Command(BaseCommand):
+    help = ('replay_analytics_spool : Send the analytics events spooled by '
+            'SpoolAnalytics to the backends of LEAN_ANALYTICS_SPOOL_BACKENDS.')
+
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--min-age', type='int', default=3600, metavar='SECONDS',
+            help=('Delete the segments that were sent once they are SECONDS '
+                  'old. They should be older than '
+                  'LEAN_ANALYTICS_SPOOL_SEGMENT_AGE.')
+        ),
+        make_option(
+            '--keep', action='store_true', default=False,
+            help='Keep the segments that were sent.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if len(args):
+            raise CommandError("This command does not take any arguments")
+        directory = getattr(settings, 'LEAN_ANALYTICS_SPOOL_DIRECTORY', None)
+        if not directory:
+            raise CommandError("LEAN_ANALYTICS_SPOOL_DIRECTORY is not set")
+        if not os.path.isdir(directory):
+            return
+        analytics = [get_callable(name)() for name in
+                     getattr(settings, 'LEAN_ANALYTICS_SPOOL_BACKENDS', ())]
+        replayer = SpoolReplayer(directory, analytics,
+                                 min_age=options['min_age'])
+        with lockfile(os.path.join(directory, 'replay.lock'), LOCK_EX,
+                      wait=False):
+            try:
+                sent = replayer.replay(keep=options['keep'])
+            except Exception, e:
+                l.exception("Analytics spool replay failed")
+                raise CommandError("The replay stopped, as a backend "
+                                   "failed: %s" % e)
+        l.info("Replayed %d analytics events" % sent)
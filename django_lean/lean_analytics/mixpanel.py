@@ -1,6 +1,12 @@
 from __future__ import absolute_import
 
+import base64
 import time
+import urllib
+import urllib2
+
+from django.conf import settings
+from django.utils import simplejson
 
 from mixpanel.tasks import EventTracker
 
@@ -8,38 +14,77 @@ from django_lean.lean_analytics import IdentificationError
 from django_lean.lean_analytics.base import BaseAnalytics
 
 
+# Mixpanel accepts at most 50 events per request
+MAX_BATCH_SIZE = 50
+
+
 class Mixpanel(BaseAnalytics):
-    def __init__(self, tracker=None, tracker_class=EventTracker):
+    supports_batches = True
+    max_batch_size = MAX_BATCH_SIZE
+
+    def __init__(self, tracker=None, tracker_class=EventTracker,
+                 batch_size=None, batch_interval=None, timeout=None):
+        BaseAnalytics.__init__(self, batch_size=batch_size,
+                               batch_interval=batch_interval, timeout=timeout)
         if tracker is None:
             tracker = EventTracker()
         self.tracker = tracker
-        self.remote_addr = None
-        self.identity = None
+        # Batches are posted with a timeout, but the tracker has none
+        self.threaded_calls = not self.batch_size
 
     def _identify(self, experiment_user):
-        self.identity = None
-        self.remote_addr = None
-        request = experiment_user.request
-        if hasattr(request, 'META'):
-            self.remote_addr = request.META.get('REMOTE_ADDR', None)
+        """
+        Returns the identity and remote address of `experiment_user`, or
+        None if it cannot be identified.
+        """
         try:
-            self.identity = self._compute_id(experiment_user)
-            return True
+            identity = self._compute_id(experiment_user)
         except IdentificationError:
             # Ignore experiment_users who cannot be tied to sessions or users
-            return False
-
-    def _properties(self, properties):
-        result = {'time': '%d' % time.mktime(time.gmtime())}
-        for key, attr in (('ip', 'remote_addr'), ('distinct_id', 'identity')):
-            if key not in properties:
-                value = getattr(self, attr)
-                if value:
-                    result[key] = value
+            return None
+        remote_addr = None
+        request = experiment_user.request
+        if hasattr(request, 'META'):
+            remote_addr = request.META.get('REMOTE_ADDR', None)
+        return identity, remote_addr
+
+    def _properties(self, properties, identity, remote_addr=None,
+                    event_time=None):
+        if event_time is None:
+            event_time = time.mktime(time.gmtime())
+        result = {'time': '%d' % event_time}
+        for key, value in (('ip', remote_addr), ('distinct_id', identity)):
+            if key not in properties and value:
+                result[key] = value
         result.update(properties)
         return result
 
     def _submit(self, name, properties, experiment_user=None):
-        if self._identify(experiment_user):
-            properties = self._properties(properties)
+        identification = self._identify(experiment_user)
+        if identification is not None:
+            properties = self._properties(
+                properties, *identification,
+                event_time=self._event_time(experiment_user))
             self.tracker.run(event_name=name, properties=properties)
+
+    def _prepare_event(self, name, properties, experiment_user=None):
+        identification = self._identify(experiment_user)
+        if identification is not None:
+            return {'event': name,
+                    'properties': self._properties(
+                        properties, *identification,
+                        event_time=self._event_time(experiment_user))}
+
+    def _submit_batch(self, events):
+        """Sends the events to the batch endpoint of Mixpanel."""
+        url = 'http://%s%s' % (
+            getattr(settings, 'MIXPANEL_API_SERVER', 'api.mixpanel.com'),
+            getattr(settings, 'MIXPANEL_TRACKING_ENDPOINT', '/track/'))
+        token = getattr(settings, 'MIXPANEL_API_TOKEN', None)
+        for event in events:
+            event['properties'].setdefault('token', token)
+        for i in range(0, len(events), MAX_BATCH_SIZE):
+            data = base64.b64encode(
+                simplejson.dumps(events[i:i + MAX_BATCH_SIZE]))
+            urllib2.urlopen(url, urllib.urlencode({'data': data}),
+                            self.timeout).read()
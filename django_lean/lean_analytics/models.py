@@ -1,5 +1,6 @@
 from django.conf import settings
 
+from django_lean.deferred import connect_deferred
 from django_lean.experiments.models import GoalRecord
 from django_lean.experiments.signals import goal_recorded, user_enrolled
 from django_lean.lean_analytics import get_all_analytics
@@ -11,7 +12,8 @@ def analytics_goalrecord(sender, goal_record, experiment_user, *args, **kwargs):
             analytics.record(goal_record=goal_record,
                              experiment_user=experiment_user)
 
-goal_recorded.connect(analytics_goalrecord, sender=GoalRecord)
+connect_deferred(goal_recorded, analytics_goalrecord, sender=GoalRecord,
+                 dispatch_uid='lean_analytics.analytics_goalrecord')
 
 def analytics_enrolled(sender, experiment, experiment_user, group_id,
                        *args, **kwargs):
@@ -21,4 +23,5 @@ def analytics_enrolled(sender, experiment, experiment_user, group_id,
                              experiment_user=experiment_user,
                              group_id=group_id)
 
-user_enrolled.connect(analytics_enrolled)
+connect_deferred(user_enrolled, analytics_enrolled,
+                 dispatch_uid='lean_analytics.analytics_enrolled')
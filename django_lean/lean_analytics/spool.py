@@ -0,0 +1,305 @@
+"""
+Durable outbox of analytics events.
+
+Add SpoolAnalytics to LEAN_ANALYTICS to append the events as JSON lines to
+segment files in LEAN_ANALYTICS_SPOOL_DIRECTORY, instead of sending them
+to remote services while serving requests. The replay_analytics_spool
+command then sends them to the backends of LEAN_ANALYTICS_SPOOL_BACKENDS.
+
+Each process writes its own segments, started every
+LEAN_ANALYTICS_SPOOL_SEGMENT_SIZE bytes (16 MB by default) or
+LEAN_ANALYTICS_SPOOL_SEGMENT_AGE seconds (300 by default). Segments are
+synced to disk every LEAN_ANALYTICS_SPOOL_FSYNC_EVENTS events (100 by
+default) or LEAN_ANALYTICS_SPOOL_FSYNC_INTERVAL seconds (1 by default),
+so a crash of the machine loses at most those events.
+
+With LEAN_ANALYTICS_FALLBACK_SPOOL set, the events skipped by the other
+backends while their circuit breaker is open are spooled too, tagged with
+the backend, and only replayed to that backend.
+"""
+from __future__ import with_statement
+
+import logging
+l = logging.getLogger(__name__)
+
+import os
+from threading import Lock
+from time import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils import simplejson
+
+from django_lean.lean_analytics.base import BaseAnalytics
+from django_lean.lean_analytics.dispatch import FrozenRequest, FrozenSession
+
+
+SEGMENT_SUFFIX = '.jsonl'
+CHECKPOINT = 'checkpoint.json'
+
+
+class Spool(object):
+    """Appends events to the segments of `directory`."""
+    def __init__(self, directory, segment_size=16 * 1024 * 1024,
+                 segment_age=300, fsync_events=100, fsync_interval=1):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.fsync_events = fsync_events
+        self.fsync_interval = fsync_interval
+        self.segment = None
+        self.pid = None
+        self._lock = Lock()
+
+    def open_segment(self):
+        self.close_segment()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Names sort by creation time, and differ between processes
+        self.path = os.path.join(self.directory, '%015d-%d%s' % (
+            time() * 1000, os.getpid(), SEGMENT_SUFFIX))
+        self.segment = open(self.path, 'ab')
+        self.segment_started = self.synced = time()
+        self.unsynced = 0
+
+    def close_segment(self):
+        if self.segment is not None:
+            self.sync()
+            self.segment.close()
+            self.segment = None
+
+    def sync(self):
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.synced = time()
+        self.unsynced = 0
+
+    def append(self, event):
+        line = simplejson.dumps(event, separators=(',', ':')) + '\n'
+        with self._lock:
+            now = time()
+            if (self.segment is None or
+                self.segment.tell() >= self.segment_size or
+                now - self.segment_started >= self.segment_age or
+                self.pid != os.getpid()):
+                self.pid = os.getpid()
+                self.open_segment()
+            self.segment.write(line)
+            self.unsynced += 1
+            if (self.unsynced >= self.fsync_events or
+                now - self.synced >= self.fsync_interval):
+                self.sync()
+            else:
+                # Make the event visible to replay_analytics_spool
+                self.segment.flush()
+
+    def close(self):
+        with self._lock:
+            self.close_segment()
+
+
+class SpooledUser(object):
+    """
+    Experiment user rebuilt from the identity of a spooled event, along
+    with the time of the event.
+    """
+    def __init__(self, identity, event_time=None):
+        self.event_time = event_time
+        self.anonymous = identity.get('anonymous', True)
+        self.user = None
+        if identity.get('user') is not None:
+            self.user = User(pk=identity['user'])
+        self.session = None
+        if 'session' in identity:
+            self.session = FrozenSession(identity['session'])
+        self.request = FrozenRequest(identity.get('ip'))
+
+    def is_anonymous(self):
+        return self.anonymous
+
+
+def get_identity(experiment_user):
+    """Returns what identifies `experiment_user` to the backends."""
+    identity = {'anonymous': experiment_user.is_anonymous()}
+    user = getattr(experiment_user, 'user', None)
+    if getattr(user, 'pk', None) is not None:
+        identity['user'] = user.pk
+    session = getattr(experiment_user, 'session', None)
+    if hasattr(session, 'session_key'):
+        identity['session'] = session.session_key
+    meta = getattr(getattr(experiment_user, 'request', None), 'META', None)
+    if meta and meta.get('REMOTE_ADDR'):
+        identity['ip'] = meta['REMOTE_ADDR']
+    return identity
+
+
+def get_backend_path(analytics):
+    cls = analytics.__class__
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def make_event(name, properties, experiment_user=None, backend=None):
+    event = {'name': name, 'properties': properties, 'time': int(time())}
+    if experiment_user is not None:
+        event['identity'] = get_identity(experiment_user)
+    if backend is not None:
+        event['backend'] = backend
+    return event
+
+
+def get_spool():
+    """Returns a Spool of LEAN_ANALYTICS_SPOOL_DIRECTORY."""
+    return Spool(
+        settings.LEAN_ANALYTICS_SPOOL_DIRECTORY,
+        segment_size=getattr(settings, 'LEAN_ANALYTICS_SPOOL_SEGMENT_SIZE',
+                             16 * 1024 * 1024),
+        segment_age=getattr(settings, 'LEAN_ANALYTICS_SPOOL_SEGMENT_AGE', 300),
+        fsync_events=getattr(settings, 'LEAN_ANALYTICS_SPOOL_FSYNC_EVENTS',
+                             100),
+        fsync_interval=getattr(settings, 'LEAN_ANALYTICS_SPOOL_FSYNC_INTERVAL',
+                               1))
+
+
+_fallback_spool = None
+_fallback_lock = Lock()
+
+def spool_event(analytics, name, properties, experiment_user=None):
+    """
+    Spools an event that the `analytics` backend could not submit. Returns
+    whether it was spooled.
+    """
+    global _fallback_spool
+    if _fallback_spool is None:
+        with _fallback_lock:
+            if _fallback_spool is None:
+                _fallback_spool = get_spool()
+    try:
+        _fallback_spool.append(make_event(name, properties, experiment_user,
+                                          backend=get_backend_path(analytics)))
+    except Exception:
+        l.exception("Could not spool analytics event %s" % name)
+        return False
+    return True
+
+
+class SpoolAnalytics(BaseAnalytics):
+    def __init__(self, spool=None):
+        BaseAnalytics.__init__(self)
+        if spool is None:
+            spool = get_spool()
+        self.spool = spool
+
+    def _submit(self, name, properties, experiment_user=None):
+        try:
+            self.spool.append(make_event(name, properties, experiment_user))
+        except Exception:
+            l.exception("Could not spool analytics event %s" % name)
+
+    def stop(self):
+        self.spool.close()
+
+
+class SpoolReplayer(object):
+    """
+    Sends the spooled events of `directory` to the `analytics` backends,
+    recording how far each segment was sent in a checkpoint file.
+    Segments sent completely are deleted once they are `min_age` seconds
+    old, after which they cannot be written anymore.
+    """
+    def __init__(self, directory, analytics, min_age=3600, chunk_size=100):
+        self.directory = directory
+        self.analytics = analytics
+        self.min_age = min_age
+        self.chunk_size = chunk_size
+        self.checkpoint_path = os.path.join(directory, CHECKPOINT)
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as fp:
+                return simplejson.load(fp)
+        except IOError:
+            return {}
+
+    def save_checkpoint(self, checkpoint):
+        path = self.checkpoint_path + '.tmp'
+        with open(path, 'w') as fp:
+            simplejson.dump(checkpoint, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(path, self.checkpoint_path)
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def load_events(self, lines):
+        """
+        Returns the name, properties, experiment user and backend of the
+        events of `lines`.
+        """
+        events = []
+        for line in lines:
+            try:
+                event = simplejson.loads(line)
+            except ValueError:
+                l.warning("Skipping malformed event in %s" % self.directory)
+                continue
+            experiment_user = None
+            if 'identity' in event:
+                experiment_user = SpooledUser(event['identity'],
+                                              event.get('time'))
+            events.append((event['name'], event['properties'],
+                           experiment_user, event.get('backend')))
+        return events
+
+    def send(self, lines):
+        """
+        Sends the events of `lines` to the backends. Errors are raised,
+        the events being sent at least once to each backend.
+        """
+        events = self.load_events(lines)
+        for analytics in self.analytics:
+            path = get_backend_path(analytics)
+            # Events skipped by a backend are only sent to it
+            analytics._deliver([(name, dict(properties), experiment_user)
+                                for name, properties, experiment_user, backend
+                                in events if backend in (None, path)])
+
+    def replay(self, keep=False):
+        """
+        Sends the new events of all segments, `chunk_size` at a time, and
+        returns their number. When a backend fails, the replay stops at the
+        chunk that failed, which is sent again by the next replay.
+        """
+        checkpoint = self.load_checkpoint()
+        sent = 0
+        now = time()
+        for name in self.segments():
+            path = os.path.join(self.directory, name)
+            offset = checkpoint.get(name, 0)
+            with open(path, 'rb') as fp:
+                fp.seek(offset)
+                while True:
+                    lines = []
+                    line = ''
+                    while len(lines) < self.chunk_size:
+                        line = fp.readline()
+                        if not line.endswith('\n'):
+                            break
+                        lines.append(line)
+                    if lines:
+                        self.send(lines)
+                        offset += sum(map(len, lines))
+                        sent += len(lines)
+                        checkpoint[name] = offset
+                        self.save_checkpoint(checkpoint)
+                    if len(lines) < self.chunk_size:
+                        break
+            if not keep and now - os.path.getmtime(path) >= self.min_age:
+                if line:
+                    l.warning("Dropping the incomplete last event of %s" %
+                              path)
+                os.unlink(path)
+                checkpoint.pop(name, None)
+                self.save_checkpoint(checkpoint)
+        return sent
@@ -1,20 +1,46 @@
 from __future__ import with_statement
 
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from StringIO import StringIO
 from contextlib import contextmanager
 
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser, User
-from django.http import HttpRequest
+from django.core.management.base import CommandError
+from django.http import HttpRequest, HttpResponse
+from django.utils import simplejson
 
+from django_lean import metrics
+from django_lean.deferred import DeferredReceiversMiddleware
 from django_lean.experiments.models import (AnonymousVisitor, Experiment,
                                             GoalRecord, GoalType, Participant)
-from django_lean.experiments.tests.utils import get_session, patch, TestCase
+from django_lean.experiments.signals import goal_recorded
+from django_lean.experiments.tests.utils import (get_session, patch, TestCase,
+                                                 TestUser)
 from django_lean.experiments.utils import StaticUser, WebUser
 from django_lean.lean_analytics import (get_all_analytics,
                                         get_all_analytics_names,
                                         reset_caches,
                                         IdentificationError)
+from django_lean.lean_analytics import base, spool
 from django_lean.lean_analytics.base import BaseAnalytics
+from django_lean.lean_analytics.benchmark import (AnalyticsBenchmark,
+                                                  LOCAL_ANALYTICS)
+from django_lean.lean_analytics.breaker import CircuitBreaker
+from django_lean.lean_analytics.dispatch import AsyncAnalytics, FrozenSession
+from django_lean.lean_analytics.local import LocalAnalytics
+from django_lean.lean_analytics.management.commands import (
+    replay_analytics_spool
+)
+from django_lean.lean_analytics.spool import (Spool, SpoolAnalytics,
+                                              SpoolReplayer)
 
 import mox
 
@@ -44,6 +70,684 @@ class TestAnalytics(TestCase):
             self.assertEqual([a.__class__.__name__ for a in get_all_analytics()],
                              [BaseAnalytics.__name__])
 
+    def test_get_all_analytics_threads(self):
+        base_name = '%s.%s' % (BaseAnalytics.__module__, BaseAnalytics.__name__)
+        results = []
+        with patch(settings, 'LEAN_ANALYTICS', [base_name]):
+            reset_caches()
+            threads = [threading.Thread(
+                    target=lambda: results.append(get_all_analytics()))
+                       for i in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            reset_caches()
+        self.assertEqual(10, len(results))
+        self.assertEqual(1, len(set(id(r) for r in results)))
+
+
+class RecordingAnalytics(BaseAnalytics):
+    def __init__(self, block=None):
+        self.block = block
+        self.events = []
+
+    def _submit(self, name, properties, experiment_user=None):
+        if self.block is not None:
+            self.block.wait()
+        self.events.append((name, properties, self._compute_id(experiment_user),
+                            experiment_user.request.META.get('REMOTE_ADDR'),
+                            threading.currentThread().getName()))
+
+
+class TestAsyncAnalytics(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+
+    def web_user(self):
+        request = HttpRequest()
+        request.user = AnonymousUser()
+        request.session = get_session(None)
+        request.session.save()
+        request.META['REMOTE_ADDR'] = '10.0.0.1'
+        return WebUser(request)
+
+    def test_submit(self):
+        backend = RecordingAnalytics()
+        analytics = AsyncAnalytics(backend)
+        experiment_user = self.web_user()
+        session_key = experiment_user.session.session_key
+        properties = {'Foo': 'Bar'}
+        analytics.event('Event', properties, request=experiment_user.request)
+        # The identity and properties are the ones of the time of the event
+        properties['Foo'] = 'Baz'
+        experiment_user.session.cycle_key()
+        experiment_user.request.META['REMOTE_ADDR'] = '10.0.0.2'
+        analytics.join()
+        analytics.stop()
+        self.assertEqual(
+            [('Event', {'Foo': 'Bar'}, 'Session %s' % session_key,
+              '10.0.0.1', 'AsyncAnalytics RecordingAnalytics')],
+            backend.events)
+
+    def test_full_queue(self):
+        block = threading.Event()
+        backend = RecordingAnalytics(block=block)
+        analytics = AsyncAnalytics(backend, queue_size=1)
+        experiment_user = self.web_user()
+        analytics.event('First', {}, request=experiment_user.request)
+        # Wait for the worker to take the first event
+        while not analytics.queue.empty():
+            time.sleep(0.01)
+        analytics.event('Second', {}, request=experiment_user.request)
+        analytics.event('Dropped', {}, request=experiment_user.request)
+        block.set()
+        analytics.join()
+        analytics.stop()
+        self.assertEqual(['First', 'Second'],
+                         [event[0] for event in backend.events])
+        self.assertEqual(1, metrics.registry.counter(
+                'analytics_events_dropped_total',
+                backend='RecordingAnalytics').value)
+
+    def test_get_all_analytics(self):
+        base_name = '%s.%s' % (BaseAnalytics.__module__, BaseAnalytics.__name__)
+        with patch(settings, 'LEAN_ANALYTICS', [base_name]):
+            with patch(settings, 'LEAN_ANALYTICS_ASYNC', True):
+                reset_caches()
+                analytics = get_all_analytics()
+                self.assertEqual([AsyncAnalytics], [a.__class__ for a in analytics])
+                self.assertEqual(BaseAnalytics, analytics[0].analytics.__class__)
+            reset_caches()
+
+
+class BatchAnalytics(BaseAnalytics):
+    supports_batches = True
+
+    def __init__(self, **kwargs):
+        BaseAnalytics.__init__(self, **kwargs)
+        self.batches = []
+
+    def _prepare_event(self, name, properties, experiment_user=None):
+        if name != 'Ignored':
+            return name
+
+    def _submit_batch(self, events):
+        self.batches.append(events)
+
+
+class TestBatches(TestCase):
+    def test_batch_size(self):
+        analytics = BatchAnalytics(batch_size=2, batch_interval=60)
+        for name in ('First', 'Ignored', 'Second', 'Third'):
+            analytics._dispatch(name, {})
+        self.assertEqual([['First', 'Second']], analytics.batches)
+        analytics.flush()
+        self.assertEqual([['First', 'Second'], ['Third']], analytics.batches)
+        analytics.flush()
+        self.assertEqual(2, len(analytics.batches))
+
+    def test_batch_interval(self):
+        analytics = BatchAnalytics(batch_size=100, batch_interval=0)
+        analytics._dispatch('First', {})
+        self.assertEqual([['First']], analytics.batches)
+
+    def test_opt_out(self):
+        with patch(settings, 'LEAN_ANALYTICS_BATCH_SIZE', 10):
+            self.assertEqual(10, BatchAnalytics().batch_size)
+            self.assertEqual(None, RecordingAnalytics().batch_size)
+            self.assertEqual(None, BaseAnalytics().batch_size)
+        self.assertEqual(None, BatchAnalytics().batch_size)
+
+    def test_max_batch_size(self):
+        analytics = BatchAnalytics(batch_size=5, batch_interval=60)
+        analytics.max_batch_size = 2
+        submit_batch = analytics._submit_batch
+        def fail_second(events):
+            if len(analytics.batches) == 1 and 'Third' in events:
+                raise IOError('Unavailable')
+            submit_batch(events)
+        analytics._submit_batch = fail_second
+        fallen = []
+        analytics._fallback = lambda name, *args: fallen.append(name)
+        for name in ('First', 'Second', 'Third', 'Fourth', 'Fifth'):
+            analytics._dispatch(name, {})
+        self.assertEqual([['First', 'Second'], ['Fifth']], analytics.batches)
+        # The chunks that were sent do not fall back
+        self.assertEqual(['Third', 'Fourth'], fallen)
+
+    def test_async(self):
+        backend = BatchAnalytics(batch_size=2, batch_interval=0.05)
+        analytics = AsyncAnalytics(backend)
+        for name in ('First', 'Second', 'Third'):
+            analytics._dispatch(name, {})
+        analytics.join()
+        # The last event is submitted once the queue is idle
+        for i in range(100):
+            if len(backend.batches) == 2:
+                break
+            time.sleep(0.01)
+        analytics.stop()
+        self.assertEqual([['First', 'Second'], ['Third']], backend.batches)
+
+    def test_get_all_analytics(self):
+        name = '%s.%s' % (BatchAnalytics.__module__, BatchAnalytics.__name__)
+        with patch(settings, 'LEAN_ANALYTICS', [name]):
+            with patch(settings, 'LEAN_ANALYTICS_BATCH_SIZE', 10):
+                reset_caches()
+                # Batches are not submitted by requests
+                self.assertEqual([AsyncAnalytics], [
+                        a.__class__ for a in get_all_analytics()])
+            reset_caches()
+            self.assertEqual([BatchAnalytics], [
+                    a.__class__ for a in get_all_analytics()])
+        reset_caches()
+
+    def test_close(self):
+        backend = BatchAnalytics(batch_size=10, batch_interval=60)
+        analytics = AsyncAnalytics(backend)
+        analytics._dispatch('First', {})
+        analytics.close()
+        self.assertEqual([['First']], backend.batches)
+        self.assertEqual(None, analytics.thread)
+
+
+class TestSpool(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = Spool(self.directory, segment_size=200,
+                           fsync_events=2)
+        self.analytics = SpoolAnalytics(spool=self.spool)
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.directory)
+
+    def web_user(self, user=None):
+        request = HttpRequest()
+        request.user = user or AnonymousUser()
+        request.session = get_session(None)
+        request.session.save()
+        request.META['REMOTE_ADDR'] = '10.0.0.1'
+        return WebUser(request)
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith('.jsonl'))
+
+    def test_replay(self):
+        experiment_user = self.web_user()
+        user = User.objects.create_user('user', 'user@example.com', 'user')
+        for i in range(4):
+            self.analytics.event('Event %d' % i, {'Foo': i},
+                                 request=experiment_user.request)
+        self.analytics.event('Registered', {},
+                             request=self.web_user(user).request)
+        self.assertTrue(len(self.segments()) > 1)
+
+        backend = RecordingAnalytics()
+        replayer = SpoolReplayer(self.directory, [backend])
+        self.assertEqual(5, replayer.replay())
+        session_id = 'Session %s' % experiment_user.session.session_key
+        self.assertEqual(
+            [('Event 0', {'Foo': 0}, session_id, '10.0.0.1'),
+             ('Event 3', {'Foo': 3}, session_id, '10.0.0.1'),
+             ('Registered', {}, 'User %d' % user.pk, '10.0.0.1')],
+            [event[:4] for event in backend.events[0], backend.events[3],
+                                    backend.events[4]])
+
+        # Replays resume from the checkpoint
+        self.assertEqual(0, replayer.replay())
+        self.analytics.event('Event 4', {}, request=experiment_user.request)
+        self.assertEqual(1, replayer.replay())
+        self.assertEqual(6, len(backend.events))
+
+    def test_delete_old_segments(self):
+        experiment_user = self.web_user()
+        self.analytics.event('Event', {}, request=experiment_user.request)
+        self.spool.close()
+        replayer = SpoolReplayer(self.directory, [], min_age=3600)
+        replayer.replay()
+        self.assertEqual(1, len(self.segments()))
+        replayer.min_age = 0
+        replayer.replay(keep=True)
+        self.assertEqual(1, len(self.segments()))
+        replayer.replay()
+        self.assertEqual([], self.segments())
+        self.assertEqual({}, replayer.load_checkpoint())
+
+    def test_command(self):
+        command = replay_analytics_spool.Command()
+        with patch(settings, 'LEAN_ANALYTICS_SPOOL_DIRECTORY', None):
+            self.assertRaises(CommandError, command.handle, min_age=0,
+                              keep=False)
+        backend_name = '%s.%s' % (RecordingAnalytics.__module__,
+                                  RecordingAnalytics.__name__)
+        self.analytics.event('Event', {},
+                             request=self.web_user().request)
+        with patch(settings, 'LEAN_ANALYTICS_SPOOL_DIRECTORY', self.directory):
+            with patch(settings, 'LEAN_ANALYTICS_SPOOL_BACKENDS',
+                       [backend_name]):
+                command.handle(min_age=3600, keep=False)
+        checkpoint = SpoolReplayer(self.directory, []).load_checkpoint()
+        self.assertEqual(self.segments(), checkpoint.keys())
+        self.assertTrue(checkpoint.values()[0] > 0)
+
+    def test_failing_backend(self):
+        experiment_user = self.web_user()
+        for i in range(3):
+            self.analytics.event('Event %d' % i, {},
+                                 request=experiment_user.request)
+        self.spool.close()
+        backend = LocalAnalytics()
+        submit_batch = backend._submit_batch
+        def fail(events):
+            if events[0]['event'] == 'Event 1':
+                raise IOError('Unavailable')
+            submit_batch(events)
+        backend._submit_batch = fail
+        replayer = SpoolReplayer(self.directory, [backend], min_age=0,
+                                 chunk_size=1)
+        self.assertRaises(IOError, replayer.replay)
+        # The events from the failed one on are kept
+        self.assertEqual(['Event 0'],
+                         [event['event'] for event in backend.events])
+        self.assertTrue(self.segments())
+        backend._submit_batch = submit_batch
+        self.assertEqual(2, replayer.replay())
+        self.assertEqual(['Event 0', 'Event 1', 'Event 2'],
+                         [event['event'] for event in backend.events])
+        self.assertEqual([], self.segments())
+
+    def test_event_time(self):
+        self.analytics.event('Event', {}, request=self.web_user().request)
+        self.spool.close()
+        segment = os.path.join(self.directory, self.segments()[0])
+        with open(segment) as fp:
+            event = simplejson.loads(fp.readline())
+        event['time'] -= 3600
+        with open(segment, 'w') as fp:
+            fp.write(simplejson.dumps(event) + '\n')
+        backend = LocalAnalytics()
+        SpoolReplayer(self.directory, [backend]).replay()
+        self.assertEqual(event['time'], backend.events[0]['time'])
+
+
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_trip(self):
+        breaker = CircuitBreaker('Backend', failure_threshold=2,
+                                 reset_timeout=60)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        self.assertEqual(1, metrics.registry.counter(
+                'analytics_circuit_trips_total', backend='Backend').value)
+
+    def test_half_open(self):
+        breaker = CircuitBreaker('Backend', failure_threshold=1,
+                                 reset_timeout=0)
+        breaker.failure()
+        # A single trial call is let through
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests += 1
+        time.sleep(self.server.delay)
+        self.send_response(self.server.status)
+        self.end_headers()
+        self.wfile.write('1')
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeService(HTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients which timed out leave broken pipes
+        pass
+
+
+class HttpAnalytics(BaseAnalytics):
+    """Posts the events to the fake analytics service."""
+    def __init__(self, url, **kwargs):
+        BaseAnalytics.__init__(self, **kwargs)
+        self.url = url
+
+    def _submit(self, name, properties, experiment_user=None):
+        urllib2.urlopen(self.url, 'event=%s' % name, self.timeout).read()
+
+
+class TestCircuitBreakerBackend(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.server = FakeService(('127.0.0.1', 0), FakeServiceHandler)
+        self.server.requests = 0
+        self.server.delay = 0
+        self.server.status = 200
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/track/' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        metrics.reset()
+
+    def analytics(self, **kwargs):
+        with patch(settings, 'LEAN_ANALYTICS_BREAKER_FAILURES', 2):
+            with patch(settings, 'LEAN_ANALYTICS_BREAKER_RESET', 60):
+                return HttpAnalytics(self.url, **kwargs)
+
+    def test_errors(self):
+        self.server.status = 500
+        analytics = self.analytics()
+        for i in range(4):
+            analytics._dispatch('Event', {})
+        # The service is left alone once the breaker is open
+        self.assertEqual(2, self.server.requests)
+        self.assertEqual(1, metrics.registry.counter(
+                'analytics_circuit_trips_total',
+                backend='HttpAnalytics').value)
+        self.assertEqual(2, metrics.registry.counter(
+                'analytics_calls_skipped_total',
+                backend='HttpAnalytics').value)
+
+    def test_timeout(self):
+        self.server.delay = 0.5
+        analytics = self.analytics(timeout=0.1)
+        start = time.time()
+        for i in range(3):
+            analytics._dispatch('Event', {})
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(CircuitBreaker.OPEN, analytics._breaker.state)
+
+    def test_blocking_backend(self):
+        # Threaded calls which cannot time out are not waited for
+        block = threading.Event()
+        with patch(settings, 'LEAN_ANALYTICS_TIMEOUT', 0.05):
+            analytics = self.analytics()
+        analytics.threaded_calls = True
+        analytics._submit = lambda *args, **kwargs: block.wait(5)
+        fallen = []
+        analytics._fallback = lambda name, *args: fallen.append(name)
+        try:
+            start = time.time()
+            analytics._dispatch('First', {})
+            analytics._dispatch('Second', {})
+            self.assertTrue(time.time() - start < 1)
+            self.assertEqual(CircuitBreaker.OPEN, analytics._breaker.state)
+            self.assertEqual(2, metrics.registry.counter(
+                    'analytics_calls_timed_out_total',
+                    backend='HttpAnalytics').value)
+            # The events of calls which timed out fall back
+            self.assertEqual(['First', 'Second'], fallen)
+        finally:
+            block.set()
+
+    def test_inline_calls(self):
+        def no_thread(*args, **kwargs):
+            raise AssertionError("Calls should not start threads")
+        directory = tempfile.mkdtemp()
+        try:
+            spooled = SpoolAnalytics(spool=Spool(directory))
+            with patch(base, 'Thread', no_thread):
+                for analytics in (self.analytics(), LocalAnalytics(),
+                                  spooled):
+                    for i in range(3):
+                        analytics._dispatch('Event', {})
+            spooled.stop()
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(3, self.server.requests)
+
+    def test_recovery(self):
+        self.server.status = 500
+        analytics = self.analytics()
+        analytics._dispatch('Event', {})
+        analytics._dispatch('Event', {})
+        self.server.status = 200
+        analytics._breaker.reset_timeout = 0
+        analytics._dispatch('Event', {})
+        self.assertEqual(CircuitBreaker.CLOSED, analytics._breaker.state)
+        self.assertEqual(3, self.server.requests)
+
+    def test_batches(self):
+        analytics = BatchAnalytics(batch_size=1, batch_interval=60)
+        def fail(events):
+            raise IOError('Unavailable')
+        analytics._submit_batch = fail
+        analytics._dispatch('Event', {})
+        self.assertEqual(1, metrics.registry.counter(
+                'analytics_events_dropped_total',
+                backend='BatchAnalytics').value)
+        directory = tempfile.mkdtemp()
+        fallback = Spool(directory)
+        try:
+            with patch(settings, 'LEAN_ANALYTICS_FALLBACK_SPOOL', True):
+                with patch(spool, '_fallback_spool', fallback):
+                    analytics._dispatch('Spooled', {'Foo': 'Bar'},
+                                        experiment_user=StaticUser())
+            fallback.close()
+            replayed = BatchAnalytics(batch_size=10, batch_interval=60)
+            self.assertEqual(1, SpoolReplayer(directory,
+                                              [replayed]).replay())
+            self.assertEqual([['Spooled']], replayed.batches)
+            self.assertEqual(1, metrics.registry.counter(
+                    'analytics_events_dropped_total',
+                    backend='BatchAnalytics').value)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_fallback_spool(self):
+        directory = tempfile.mkdtemp()
+        fallback = Spool(directory)
+        try:
+            self.server.status = 500
+            analytics = self.analytics()
+            experiment_user = StaticUser()
+            with patch(settings, 'LEAN_ANALYTICS_FALLBACK_SPOOL', True):
+                with patch(spool, '_fallback_spool', fallback):
+                    for name in ('First', 'Second', 'Third'):
+                        analytics._dispatch(name, {'Foo': 'Bar'},
+                                            experiment_user=experiment_user)
+            fallback.close()
+            # Skipped events are only replayed to their backend
+            other = RecordingAnalytics()
+            self.server.status = 200
+            replayed = self.analytics()
+            replayer = SpoolReplayer(directory, [other, replayed])
+            self.assertEqual(3, replayer.replay())
+            self.assertEqual([], other.events)
+            self.assertEqual(5, self.server.requests)
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestLocalAnalytics(TestCase):
+    def web_user(self):
+        request = HttpRequest()
+        request.user = AnonymousUser()
+        request.session = get_session(None)
+        request.session.save()
+        return WebUser(request)
+
+    def test_events(self):
+        analytics = LocalAnalytics(latency=0.05, max_events=2)
+        experiment_user = self.web_user()
+        start = time.time()
+        for name in ('First', 'Second', 'Third'):
+            analytics.event(name, {'Foo': 'Bar'},
+                            request=experiment_user.request)
+        self.assertTrue(time.time() - start >= 0.15)
+        self.assertEqual(3, analytics.count)
+        self.assertEqual(['Second', 'Third'],
+                         [event['event'] for event in analytics.events])
+        self.assertEqual('Session %s' % experiment_user.session.session_key,
+                         analytics.events[0]['distinct_id'])
+
+    def test_socket(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        try:
+            with patch(settings, 'LEAN_ANALYTICS_LOCAL_ADDRESS',
+                       '127.0.0.1:%d' % server.getsockname()[1]):
+                analytics = LocalAnalytics()
+            analytics._dispatch('Event', {'Foo': 'Bar'})
+            analytics.stop()
+            event = simplejson.loads(server.recv(4096))
+        finally:
+            server.close()
+        self.assertEqual('Event', event['event'])
+        self.assertEqual({'Foo': 'Bar'}, event['properties'])
+
+    def test_registered(self):
+        with patch(settings, 'LEAN_ANALYTICS', [LOCAL_ANALYTICS]):
+            with patch(settings, 'LEAN_ANALYTICS_FOR_EXPERIMENTS', True):
+                reset_caches()
+                try:
+                    Experiment.objects.create(
+                        name='local', state=Experiment.ENABLED_STATE)
+                    Experiment.test('local', self.web_user())
+                    analytics = get_all_analytics()[0]
+                    self.assertEqual(
+                        ['Enrolled In Experiment'],
+                        [event['event'] for event in analytics.events])
+                finally:
+                    reset_caches()
+
+    def test_deferred(self):
+        middleware = DeferredReceiversMiddleware()
+        goal_record = GoalRecord(goal_type=GoalType(name='goal'))
+        with patch(settings, 'LEAN_ANALYTICS', [LOCAL_ANALYTICS]):
+            with patch(settings, 'LEAN_ANALYTICS_FOR_EXPERIMENTS', True):
+                reset_caches()
+                try:
+                    request = HttpRequest()
+                    middleware.process_request(request)
+                    goal_recorded.send(sender=GoalRecord,
+                                       goal_record=goal_record,
+                                       experiment_user=TestUser(username='bob'))
+                    response = middleware.process_response(request,
+                                                           HttpResponse())
+                    analytics = get_all_analytics()[0]
+                    self.assertEqual(0, analytics.count)
+                    response.close()
+                    self.assertEqual(['Goal Recorded'],
+                                     [event['event']
+                                      for event in analytics.events])
+                finally:
+                    reset_caches()
+
+
+class TestAnalyticsBenchmark(TestCase):
+    def test_run(self):
+        with self.assertNumQueries(0):
+            results, delivered = AnalyticsBenchmark(iterations=5,
+                                                    latency=0).run()
+        self.assertEqual(12, len(results))
+        self.assertEqual(['baseline', 'sync', 'async', 'batched'],
+                         [result.mode for result in results[::3]])
+        self.assertEqual([5] * 12, [len(result.durations)
+                                    for result in results])
+        for mode, (count, duration) in delivered.items():
+            self.assertEqual(15, count)
+        self.assertEqual([], get_all_analytics())
+
+
+class TestFilters(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+
+    def web_user(self, session_key):
+        request = HttpRequest()
+        request.user = AnonymousUser()
+        request.session = FrozenSession(session_key)
+        return WebUser(request)
+
+    def test_sample_rates(self):
+        with patch(settings, 'LEAN_ANALYTICS_SAMPLE_RATES',
+                   {'Sampled': 0.5, 'Dropped': 0}):
+            analytics = LocalAnalytics()
+        users = [self.web_user('session%d' % i) for i in range(200)]
+        for name in ('Sampled', 'Sampled', 'Dropped', 'Kept'):
+            for experiment_user in users:
+                analytics._dispatch(name, {}, experiment_user=experiment_user)
+        sampled = [event['distinct_id'] for event in analytics.events
+                   if event['event'] == 'Sampled']
+        count = len(sampled) / 2
+        # The same visitors are sampled for each event
+        self.assertEqual(sampled[:count], sampled[count:])
+        self.assertTrue(50 < count < 150)
+        self.assertEqual(200, len([event for event in analytics.events
+                                   if event['event'] == 'Kept']))
+        self.assertEqual(2 * (200 - count) + 200, metrics.registry.counter(
+                'analytics_events_sampled_out_total',
+                backend='LocalAnalytics').value)
+
+    def test_new_visitors(self):
+        # Visitors without a session key do not share a sampling decision
+        with patch(settings, 'LEAN_ANALYTICS_SAMPLE_RATES',
+                   {'Sampled': 0.5, 'Dropped': 0}):
+            analytics = LocalAnalytics()
+        experiment_user = self.web_user(None)
+        for name in ('Sampled', 'Dropped'):
+            for i in range(200):
+                analytics._dispatch(name, {}, experiment_user=experiment_user)
+        self.assertTrue(50 < analytics.count < 150)
+        self.assertEqual(['Sampled'] * analytics.count,
+                         [event['event'] for event in analytics.events])
+
+    def test_allowed_properties(self):
+        with patch(settings, 'LEAN_ANALYTICS_ALLOWED_PROPERTIES',
+                   {'Enrolled In Experiment': ('Experiment',),
+                    '*': ('Foo',)}):
+            analytics = LocalAnalytics()
+        experiment_user = self.web_user('session')
+        analytics.enroll(Experiment(name='experiment'), experiment_user,
+                         Participant.TEST_GROUP)
+        analytics.event('Event', {'Foo': 1, 'Bar': 2},
+                        request=experiment_user.request)
+        self.assertEqual([{'Experiment': 'experiment'}, {'Foo': 1}],
+                         [event['properties'] for event in analytics.events])
+
+    def test_async(self):
+        with patch(settings, 'LEAN_ANALYTICS_SAMPLE_RATES', {'Dropped': 0}):
+            backend = LocalAnalytics()
+        analytics = AsyncAnalytics(backend)
+        analytics._dispatch('Dropped', {},
+                            experiment_user=self.web_user('session'))
+        # Sampled out events are not queued
+        self.assertEqual(None, analytics.thread)
+        self.assertEqual(0, backend.count)
+
 
 #############
 # KISSMETRICS
@@ -133,6 +837,7 @@ else:
             user = User.objects.create_user('user', 'user@example.com', 'user')
             KM = self.mox.CreateMockAnything()
             analytics = KissMetrics(KM=KM)
+            analytics._client = lambda: KM
             with self.web_user(user) as experiment_user:
                 KM.identify(analytics._compute_id(experiment_user))
                 KM.record(action='Enrolled In Experiment',
@@ -147,6 +852,7 @@ else:
         def test_record(self):
             KM = self.mox.CreateMockAnything()
             analytics = KissMetrics(KM=KM)
+            analytics._client = lambda: KM
             with self.web_user(AnonymousUser()) as experiment_user:
                 KM.identify(analytics._id_from_session(experiment_user.session))
                 KM.record(action='Goal Recorded',
@@ -162,6 +868,7 @@ else:
         def test_event(self):
             KM = self.mox.CreateMockAnything()
             analytics = KissMetrics(KM=KM)
+            analytics._client = lambda: KM
             with self.web_user(AnonymousUser()) as experiment_user:
                 KM.identify(analytics._id_from_session(experiment_user.session))
                 KM.record(action='Event', props={'Foo': 'Bar'})
@@ -171,6 +878,36 @@ else:
                                 request=experiment_user.request)
                 self.mox.VerifyAll()
 
+        def test_threads(self):
+            class FakeKM(object):
+                events = []
+                def identify(self, identity):
+                    self.identity = identity
+                def record(self, action, props):
+                    # Let the other threads identify their users
+                    time.sleep(0.01)
+                    self.events.append((self.identity, action))
+            analytics = KissMetrics(KM=FakeKM())
+            def submit(i):
+                request = HttpRequest()
+                request.user = AnonymousUser()
+                request.session = FrozenSession('session%d' % i)
+                analytics._submit('Event %d' % i, {},
+                                  experiment_user=WebUser(request))
+            threads = [threading.Thread(target=submit, args=(i,))
+                       for i in range(10)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # No lock is held while sending
+            self.assertTrue(time.time() - start < 0.1)
+            self.assertEqual(
+                sorted(('Session session%d' % i, 'Event %d' % i)
+                       for i in range(10)),
+                sorted(FakeKM.events))
+
         @contextmanager
         def web_user(self, user):
             session = get_session(None)
@@ -250,14 +987,41 @@ else:
             self.assertRaises(IdentificationError,
                               self.analytics._compute_id, experiment_user)
 
+        def test_batch_chunks(self):
+            posted = []
+            def urlopen(url, data, timeout):
+                posted.append(data)
+                if len(posted) == 2:
+                    raise urllib2.URLError('Unavailable')
+                return StringIO('1')
+            analytics = Mixpanel(batch_size=150, batch_interval=60)
+            fallen = []
+            analytics._fallback = lambda name, *args: fallen.append(name)
+            request = HttpRequest()
+            request.user = AnonymousUser()
+            request.session = FrozenSession('session')
+            with patch(urllib2, 'urlopen', urlopen):
+                for i in range(120):
+                    analytics._dispatch('Event %d' % i, {},
+                                        experiment_user=WebUser(request))
+                analytics.flush()
+            # Only the events of the failed chunk fall back
+            self.assertEqual(3, len(posted))
+            self.assertEqual(['Event %d' % i for i in range(50, 100)], fallen)
+
+        def test_event_time(self):
+            properties = self.analytics._properties({}, 'User 1',
+                                                    event_time=1234567890)
+            self.assertEqual('1234567890', properties['time'])
+            self.assertEqual('User 1', properties['distinct_id'])
+
         def test_identify(self):
             # With anonymous WebUser
             with self.web_user(AnonymousUser()) as experiment_user:
                 self.mox.ReplayAll()
-                self.assertTrue(self.analytics._identify(experiment_user))
                 self.assertEqual(
-                    self.analytics.identity,
-                    'Session %s' % experiment_user.session.session_key
+                    self.analytics._identify(experiment_user),
+                    ('Session %s' % experiment_user.session.session_key, None)
                 )
                 self.mox.VerifyAll()
 
@@ -265,15 +1029,16 @@ else:
             user = User.objects.create_user('user', 'user@example.com', 'user')
             with self.web_user(user) as experiment_user:
                 self.mox.ReplayAll()
-                self.assertTrue(self.analytics._identify(experiment_user))
-                self.assertEqual(self.analytics.identity,
-                                 'User %s' % experiment_user.user.pk)
+                self.assertEqual(self.analytics._identify(experiment_user),
+                                 ('User %s' % experiment_user.user.pk, None))
                 self.mox.VerifyAll()
 
             # With StaticUser
             experiment_user = StaticUser()
-            self.assertFalse(self.analytics._identify(experiment_user))
-            self.assertEqual(self.analytics.identity, None)
+            self.assertEqual(self.analytics._identify(experiment_user), None)
+            # Nothing is kept on the shared instance
+            self.assertFalse(hasattr(self.analytics, 'identity'))
+            self.assertFalse(hasattr(self.analytics, 'remote_addr'))
 
         def test_enroll(self):
             import time
@@ -343,6 +1108,36 @@ else:
                                 request=experiment_user.request)
                 self.mox.VerifyAll()
 
+        def test_threads(self):
+            class FakeKM(object):
+                events = []
+                def identify(self, identity):
+                    self.identity = identity
+                def record(self, action, props):
+                    # Let the other threads identify their users
+                    time.sleep(0.01)
+                    self.events.append((self.identity, action))
+            analytics = KissMetrics(KM=FakeKM())
+            def submit(i):
+                request = HttpRequest()
+                request.user = AnonymousUser()
+                request.session = FrozenSession('session%d' % i)
+                analytics._submit('Event %d' % i, {},
+                                  experiment_user=WebUser(request))
+            threads = [threading.Thread(target=submit, args=(i,))
+                       for i in range(10)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # No lock is held while sending
+            self.assertTrue(time.time() - start < 0.1)
+            self.assertEqual(
+                sorted(('Session session%d' % i, 'Event %d' % i)
+                       for i in range(10)),
+                sorted(FakeKM.events))
+
         @contextmanager
         def web_user(self, user):
             session = get_session(None)
@@ -1,3 +1,4 @@
+from __future__ import with_statement
 from datetime import date, datetime, timedelta
 
 from django.contrib.auth.models import User
@@ -20,7 +21,8 @@ class TestTrackRetentionMiddleware(TestCase):
         self.user = User.objects.create_user('user', 'user@example.com', 'user')
 
     def test_anonymous(self):
-        response = self.client.get(reverse('home'))
+        with self.assertQueryBudget('TrackRetentionMiddleware', 'anonymous'):
+            response = self.client.get(reverse('home'))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(DailyActivity.objects.count(), 0)
 
@@ -28,7 +30,8 @@ class TestTrackRetentionMiddleware(TestCase):
         today = date.today()
         self.assertTrue(self.client.login(username=self.user.username,
                                           password=self.user.username))
-        response = self.client.get(reverse('home'))
+        with self.assertQueryBudget('TrackRetentionMiddleware', 'registered'):
+            response = self.client.get(reverse('home'))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(DailyActivity.objects.count(), 1)
         activity = DailyActivity.objects.all()[0]
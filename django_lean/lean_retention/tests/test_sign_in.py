@@ -1,3 +1,4 @@
+from __future__ import with_statement
 from datetime import datetime, timedelta
 from time import sleep
 
@@ -26,7 +27,8 @@ class TestTrackSigninMiddleware(TestCase):
         settings.LAST_ACTIVITY_WINDOW = self.original_window
 
     def test_anonymous(self):
-        response = self.client.get(reverse('home'))
+        with self.assertQueryBudget('TrackSigninMiddleware', 'anonymous'):
+            response = self.client.get(reverse('home'))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(LastActivity.objects.count(), 0)
         self.assertEqual(SignIn.objects.count(), 0)
@@ -44,7 +46,8 @@ class TestTrackSigninMiddleware(TestCase):
                                           password=self.user.username))
         now = datetime.now()
         # Hit the page
-        response = self.client.get(reverse('home'))
+        with self.assertQueryBudget('TrackSigninMiddleware', 'registered'):
+            response = self.client.get(reverse('home'))
         self.assertEqual(LastActivity.objects.count(), 1)
         self.assertActivity(LastActivity.objects.all()[0],
                             user=self.user, medium='Default', datetime=now)
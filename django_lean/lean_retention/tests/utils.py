@@ -1,8 +1,10 @@
 from django.conf import settings
 from django.test import TestCase as DjangoTestCase
 
+from django_lean.experiments.tests.utils import QueryBudgetMixin
 
-class TestCase(DjangoTestCase):
+
+class TestCase(QueryBudgetMixin, DjangoTestCase):
     middleware = settings.MIDDLEWARE_CLASSES
 
     def _pre_setup(self):
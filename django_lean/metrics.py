@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+In-process metrics: counters and histograms that hot paths update
+cheaply, exposed as text by the experiments `metrics` view and optionally
+pushed to StatsD over UDP.
+
+Settings:
+
+LEAN_METRICS
+    Set to False to turn updates into no-ops. Defaults to True.
+LEAN_METRICS_EXPOSITION
+    Set to True to serve the metrics view to staff members. Defaults to
+    False.
+LEAN_METRICS_ALLOWED_IPS
+    Addresses also allowed to read the metrics view, like those of
+    scrapers. Defaults to ().
+LEAN_METRICS_STATSD
+    (host, port) of a StatsD daemon to push metrics to. Defaults to None.
+LEAN_METRICS_STATSD_PREFIX
+    Prefix of the StatsD metric names. Defaults to 'django_lean'.
+LEAN_METRICS_STATSD_INTERVAL
+    Seconds between pushes to StatsD. Defaults to 10.
+"""
+from __future__ import with_statement
+
+import logging
+l = logging.getLogger(__name__)
+
+import re
+import socket
+from bisect import bisect_left
+from itertools import count
+from threading import Lock, Thread, local
+from time import sleep
+
+from django.conf import settings
+
+
+STRIPES = 16
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 300)
+
+# StatsD packets are kept below the usual safe UDP payload size.
+MAX_PACKET_SIZE = 512
+
+# Thread idents are aligned addresses, so their low bits cannot pick a
+# stripe: threads are given stripes in turn instead.
+_stripes = count()
+_thread = local()
+
+
+def get_stripe():
+    """Returns the stripe of the current thread."""
+    try:
+        return _thread.stripe
+    except AttributeError:
+        _thread.stripe = next(_stripes) % STRIPES
+        return _thread.stripe
+
+
+class Counter(object):
+    """
+    Monotonic counter. Its value is split over lock-striped cells, so that
+    threads updating it rarely contend for the same lock.
+    """
+    type = 'counter'
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self._cells = [0] * STRIPES
+        self._locks = [Lock() for i in range(STRIPES)]
+
+    def inc(self, amount=1):
+        i = get_stripe()
+        with self._locks[i]:
+            self._cells[i] += amount
+
+    @property
+    def value(self):
+        return sum(self._cells)
+
+
+class Histogram(object):
+    """
+    Distribution of observed values over fixed `buckets`, along with their
+    count and sum. Updates are lock-striped like those of Counter.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # Each cell holds the bucket counts, then the overflow count and
+        # the sum of the values.
+        self._cells = [[0] * (len(self.buckets) + 2) for i in range(STRIPES)]
+        self._locks = [Lock() for i in range(STRIPES)]
+
+    def observe(self, value):
+        i = get_stripe()
+        bucket = bisect_left(self.buckets, value)
+        with self._locks[i]:
+            cell = self._cells[i]
+            cell[bucket] += 1
+            cell[-1] += value
+
+    def snapshot(self):
+        """
+        Returns the cumulative counts of each bucket, including the last
+        '+Inf' one, and the sum of the values.
+        """
+        totals = [0] * (len(self.buckets) + 2)
+        for i in range(STRIPES):
+            with self._locks[i]:
+                cell = list(self._cells[i])
+            for j, value in enumerate(cell):
+                totals[j] += value
+        cumulative = []
+        count = 0
+        for value in totals[:-1]:
+            count += value
+            cumulative.append(count)
+        return cumulative, totals[-1]
+
+    @property
+    def count(self):
+        return self.snapshot()[0][-1]
+
+    @property
+    def sum(self):
+        return self.snapshot()[1]
+
+
+class Registry(object):
+    """Holds the metrics, one per name and set of label values."""
+    def __init__(self):
+        self._metrics = {}
+        self._types = {}
+        self._lock = Lock()
+
+    def _get(self, cls, name, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    if self._types.setdefault(name, cls.type) != cls.type:
+                        raise ValueError("%s is a %s" %
+                                         (name, self._types[name]))
+                    metric = cls(name, key[1], **kwargs)
+                    self._metrics[key] = metric
+        return metric
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def histogram(self, name, buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, labels, buckets=buckets)
+
+    def collect(self):
+        """Returns all the metrics, sorted by name and labels."""
+        return [metric for key, metric in sorted(self._metrics.items())]
+
+    def clear(self):
+        with self._lock:
+            self._metrics.clear()
+            self._types.clear()
+
+    def exposition(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        previous = None
+        for metric in self.collect():
+            name = 'django_lean_%s' % metric.name
+            if metric.name != previous:
+                lines.append('# TYPE %s %s' % (name, metric.type))
+                previous = metric.name
+            if metric.type == 'counter':
+                lines.append('%s%s %s' % (name, _format_labels(metric.labels),
+                                          _format_value(metric.value)))
+                continue
+            cumulative, total = metric.snapshot()
+            bounds = [_format_value(b) for b in metric.buckets] + ['+Inf']
+            for bound, count in zip(bounds, cumulative):
+                labels = metric.labels + (('le', bound),)
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels),
+                                                 count))
+            labels = _format_labels(metric.labels)
+            lines.append('%s_sum%s %s' % (name, labels, _format_value(total)))
+            lines.append('%s_count%s %d' % (name, labels, cumulative[-1]))
+        return u''.join(line + u'\n' for line in lines)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return u'{%s}' % u','.join(
+        u'%s="%s"' % (name, unicode(value).replace('\\', '\\\\')
+                                          .replace('"', '\\"')
+                                          .replace('\n', '\\n'))
+        for name, value in labels)
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class StatsdPusher(object):
+    """
+    Pushes the changes of the metrics of a registry to a StatsD daemon at
+    `address` over UDP: counter increments as counters, and the count and
+    sum of histogram observations as counters suffixed with .count and
+    .sum.
+    """
+    def __init__(self, registry, address, prefix='django_lean', interval=10):
+        self.registry = registry
+        self.address = tuple(address)
+        self.prefix = prefix
+        self.interval = interval
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.pushed = {}
+        self.thread = None
+
+    def stat_name(self, name, labels):
+        parts = [self.prefix, name]
+        for label, value in labels:
+            parts.extend((label, value))
+        return '.'.join(re.sub(r'[^\w-]', '_', unicode(part)).encode('utf-8')
+                        for part in parts if part)
+
+    def lines(self):
+        """Returns the StatsD lines for the changes since the last push."""
+        lines = []
+        for metric in self.registry.collect():
+            key = (metric.name, metric.labels)
+            if metric.type == 'counter':
+                values = (('', metric.value),)
+            else:
+                cumulative, total = metric.snapshot()
+                values = (('.count', cumulative[-1]), ('.sum', total))
+            for suffix, value in values:
+                delta = value - self.pushed.get(key + (suffix,), 0)
+                if delta:
+                    lines.append('%s%s:%s|c' % (
+                        self.stat_name(metric.name, metric.labels), suffix,
+                        _format_value(delta)))
+                self.pushed[key + (suffix,)] = value
+        return lines
+
+    def push(self):
+        packet = ''
+        for line in self.lines():
+            if packet and len(packet) + len(line) + 1 > MAX_PACKET_SIZE:
+                self.socket.sendto(packet, self.address)
+                packet = ''
+            packet = packet and '%s\n%s' % (packet, line) or line
+        if packet:
+            self.socket.sendto(packet, self.address)
+
+    def run(self):
+        while self.thread is not None:
+            sleep(self.interval)
+            try:
+                self.push()
+            except Exception:
+                l.exception("Could not push metrics to StatsD at %s:%s" %
+                            self.address)
+
+    def start(self):
+        self.thread = Thread(target=self.run, name='StatsdPusher')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.thread = None
+
+
+registry = Registry()
+_pusher = None
+_pusher_lock = Lock()
+
+
+def _start_pusher():
+    """Starts pushing to StatsD if LEAN_METRICS_STATSD is set."""
+    global _pusher
+    with _pusher_lock:
+        if _pusher is None:
+            address = getattr(settings, 'LEAN_METRICS_STATSD', None)
+            if address:
+                _pusher = StatsdPusher(
+                    registry, address,
+                    prefix=getattr(settings, 'LEAN_METRICS_STATSD_PREFIX',
+                                   'django_lean'),
+                    interval=getattr(settings, 'LEAN_METRICS_STATSD_INTERVAL',
+                                     10))
+                _pusher.start()
+            else:
+                _pusher = False
+
+def increment(name, amount=1, **labels):
+    """Increments the counter `name` with the given label values."""
+    if not getattr(settings, 'LEAN_METRICS', True):
+        return
+    if _pusher is None:
+        _start_pusher()
+    registry.counter(name, **labels).inc(amount)
+
+def observe(name, value, **labels):
+    """Records `value` in the histogram `name` with the given label values."""
+    if not getattr(settings, 'LEAN_METRICS', True):
+        return
+    if _pusher is None:
+        _start_pusher()
+    registry.histogram(name, **labels).observe(value)
+
+def reset():
+    """Clears all metrics and stops pushing them to StatsD."""
+    global _pusher
+    if _pusher:
+        _pusher.stop()
+    _pusher = None
+    registry.clear()
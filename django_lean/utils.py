@@ -1,8 +1,10 @@
 from contextlib import contextmanager
+from hashlib import md5
+from itertools import islice
 
 from django.contrib.sites.models import Site
 from django.core import mail
-from django.db import transaction
+from django.db import connection, transaction
 from django.utils.functional import LazyObject
 
 
@@ -11,6 +13,32 @@ def get_current_site():
         return Site.objects.get_current()
     return None
 
+def bulk_insert(model, fields, rows, batch_size=1000):
+    """
+    Inserts `rows` of values for the `fields` of `model`, in batches of
+    `batch_size` rows.
+
+    Unlike QuerySet.bulk_create(), values are stored as given, so that
+    `auto_now_add` fields can be backdated, and no model instances are
+    built. No signals are sent.
+    """
+    qn = connection.ops.quote_name
+    columns = [qn(model._meta.get_field(f).column) for f in fields]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(model._meta.db_table),
+                                               ', '.join(columns),
+                                               ', '.join(['%s'] * len(columns)))
+    cursor = connection.cursor()
+    rows = iter(rows)
+    count = 0
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        cursor.executemany(sql, batch)
+        count += len(batch)
+    transaction.commit_unless_managed()
+    return count
+
 def in_transaction(test_ignore=True):
     result = transaction.is_managed()
     if test_ignore:
@@ -20,6 +48,20 @@ def in_transaction(test_ignore=True):
     return result
 
 
+def in_sample(key, fraction):
+    """
+    Returns True if `key` falls within the sampled `fraction` (0 to 1) of
+    all keys.
+
+    The decision is made by hashing `key`, so the same key is always
+    either in or out of a given sample, across processes and runs.
+    """
+    if fraction is None or fraction >= 1:
+        return True
+    digest = md5(str(key)).hexdigest()
+    return int(digest[:8], 16) < fraction * 0x100000000
+
+
 @contextmanager
 def patch(namespace, name, function):
     """Patches `namespace`.`name` with `function`."""
@@ -40,12 +40,15 @@ setup(
     packages=[
         'django_lean',
         'django_lean.experiments',
+        'django_lean.experiments.benchmarks',
         'django_lean.experiments.management',
         'django_lean.experiments.management.commands',
         'django_lean.experiments.migrations',
         'django_lean.experiments.templatetags',
         'django_lean.experiments.tests',
         'django_lean.lean_analytics',
+        'django_lean.lean_analytics.management',
+        'django_lean.lean_analytics.management.commands',
         'django_lean.lean_retention',
         'django_lean.lean_retention.migrations',
         'django_lean.lean_retention.tests',